@@ -0,0 +1,210 @@
+"""
+Listing of the NetCDF files in the archive directories of datasets.
+
+Metadata operations on the archive filesystem have a high latency but
+parallelise well, so directories are listed with `os.scandir` by a pool of
+`scan_workers` threads. The file names found are cached per dataset with
+the modification time of the directory, which changes whenever a file is
+added, removed or renamed in it, so a directory is only listed again if its
+modification time has changed (which takes a single stat).
+
+By default the cache only lasts for the life of the process. If
+`scan_cache_file` is set, it is kept in that SQLite database (best on a
+local disk) so that it persists between runs; writes to it are made while
+holding a FileLock, as SQLite's own locking cannot be relied on across hosts
+on shared filesystems.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import logging
+from ..config import get_from_proj_or_workflow
+from .file_lock import FileLock
+from .utils import get_archive_path
+
+LOGGER = logging.getLogger(__file__)
+
+# Max number of parameters in one SQLite query
+QUERY_BATCH_SIZE = 500
+
+# Scanners in use in this process, by project
+_SCANNERS = {}
+_SCANNERS_LOCK = threading.Lock()
+
+
+def scan_dir(directory):
+    "Returns the sorted names of the NetCDF files in `directory`."
+    with os.scandir(directory) as entries:
+        return sorted(
+            entry.name
+            for entry in entries
+            if entry.name.endswith(".nc") and not entry.name.startswith(".")
+        )
+
+
+class ScanCache(object):
+    "File names found in each archive directory, with its modification time."
+
+    def __init__(self, db_file=None, table_name="archive_files"):
+        """
+        :param db_file: (str) Path to the SQLite database file, or None to
+            only cache in memory
+        """
+        self.table_name = table_name
+
+        self._lock = threading.Lock()
+        self._memory = {}
+        self._conn = None
+
+        if db_file:
+            db_dir = os.path.dirname(db_file)
+            if db_dir and not os.path.isdir(db_dir):
+                os.makedirs(db_dir, exist_ok=True)
+
+            self._lock_path = f"{db_file}.lock"
+            self._conn = sqlite3.connect(db_file, timeout=60, check_same_thread=False)
+
+            with self._write_lock(), self._conn:
+                self._conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.table_name} "
+                    "(id TEXT PRIMARY KEY, mtime INTEGER NOT NULL, files TEXT NOT NULL);"
+                )
+
+    def _write_lock(self):
+        return FileLock(self._lock_path, timeout=300, stale_after=120)
+
+    def get_many(self, dataset_ids):
+        "Returns {dataset ID: (mtime, file names)} for those of `dataset_ids` cached."
+        if self._conn is None:
+            with self._lock:
+                return {
+                    dataset_id: self._memory[dataset_id]
+                    for dataset_id in dataset_ids
+                    if dataset_id in self._memory
+                }
+
+        dataset_ids = list(dataset_ids)
+        cached = {}
+
+        for start in range(0, len(dataset_ids), QUERY_BATCH_SIZE):
+            batch = dataset_ids[start : start + QUERY_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT id, mtime, files FROM {self.table_name} "
+                    f"WHERE id IN ({placeholders});",
+                    batch,
+                ).fetchall()
+
+            cached.update(
+                {dataset_id: (mtime, json.loads(files)) for dataset_id, mtime, files in rows}
+            )
+
+        return cached
+
+    def put_many(self, records):
+        "Caches the (dataset ID, mtime, file names) `records`."
+        if not records:
+            return
+
+        if self._conn is None:
+            with self._lock:
+                self._memory.update(
+                    {dataset_id: (mtime, names) for dataset_id, mtime, names in records}
+                )
+            return
+
+        with self._lock, self._write_lock(), self._conn:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table_name} (id, mtime, files) "
+                "VALUES (?, ?, ?);",
+                [(dataset_id, mtime, json.dumps(names)) for dataset_id, mtime, names in records],
+            )
+
+
+class ArchiveScanner(object):
+    def __init__(self, project, cache=None, n_workers=None):
+        """
+        :param project: (str) Project whose archive is scanned
+        :param cache: (ScanCache) Cache of the directory listings (by
+            default, in `scan_cache_file`)
+        :param n_workers: (int) Number of threads listing directories (by
+            default, `scan_workers`)
+        """
+        self._project = project
+
+        if cache is None:
+            cache_file = get_from_proj_or_workflow("scan_cache_file", project)
+            cache = ScanCache(cache_file.format(project=project) if cache_file else None)
+
+        self._cache = cache
+        self._n_workers = n_workers or get_from_proj_or_workflow("scan_workers", project)
+
+    def _list(self, dataset_id, cached):
+        """
+        Returns (directory, file names, updated cache record or None) for a
+        dataset, only listing the directory if it changed since `cached`.
+        """
+        directory = get_archive_path(dataset_id, self._project)
+
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return directory, [], None
+
+        if cached is not None and cached[0] == mtime:
+            return directory, cached[1], None
+
+        names = scan_dir(directory)
+        return directory, names, (dataset_id, mtime, names)
+
+    def scan(self, dataset_ids):
+        """
+        Returns the sorted paths of the NetCDF files of each of `dataset_ids`,
+        as a dictionary keyed on dataset ID. Datasets without an archive
+        directory have no files.
+        """
+        dataset_ids = list(dict.fromkeys(dataset_ids))
+        cached = self._cache.get_many(dataset_ids)
+
+        n_workers = max(1, min(self._n_workers, len(dataset_ids)))
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            listings = list(
+                executor.map(
+                    lambda dataset_id: self._list(dataset_id, cached.get(dataset_id)),
+                    dataset_ids,
+                )
+            )
+
+        updated = [record for _, _, record in listings if record is not None]
+        self._cache.put_many(updated)
+
+        if len(dataset_ids) > 1:
+            LOGGER.info(
+                f"Scanned {len(dataset_ids)} archive directories "
+                f"({len(updated)} listed, the others unchanged)"
+            )
+
+        return {
+            dataset_id: [os.path.join(directory, name) for name in names]
+            for dataset_id, (directory, names, _) in zip(dataset_ids, listings)
+        }
+
+    def list_nc_files(self, dataset_id):
+        "Returns the sorted paths of the NetCDF files of the dataset."
+        return self.scan([dataset_id])[dataset_id]
+
+
+def get_archive_scanner(project):
+    "Returns the archive scanner of the project, shared within this process."
+    with _SCANNERS_LOCK:
+        if project not in _SCANNERS:
+            _SCANNERS[project] = ArchiveScanner(project)
+
+        return _SCANNERS[project]
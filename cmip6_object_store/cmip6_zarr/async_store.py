@@ -0,0 +1,192 @@
+"""
+Asyncio variant of CaringoStore, built directly on aiobotocore.
+
+The operations of CaringoStore (exists, create_bucket, find, delete, chmod,
+set_permissions, set_bucket_policy) are coroutines here, so that they can
+be fanned out concurrently over thousands of buckets or objects from a
+single process, e.g. when cleaning out or setting permissions on a whole
+project. Concurrency is bounded by the size of the HTTP connection pool.
+"""
+
+import asyncio
+import json
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from botocore.exceptions import ClientError
+
+from ..config import CONFIG
+from .caringo_store import PUBLIC_READ_POLICY
+from .retry_policy import with_async_retries
+
+# Maximum number of keys per DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
+NOT_FOUND_CODES = ("404", "NoSuchBucket", "NoSuchKey")
+
+
+def _split_path(path):
+    bucket, _, prefix = path.strip("/").partition("/")
+    return bucket, prefix
+
+
+class AsyncCaringoStore(object):
+    """
+    Use as an async context manager, which opens and closes the client:
+
+        async with AsyncCaringoStore(creds) as store:
+            await store.gather(store.delete, buckets)
+    """
+
+    def __init__(self, creds, max_concurrency=50):
+        self._creds = creds
+        self._max_concurrency = max_concurrency
+        self._client_creator = None
+        self._client = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        session = get_session()
+
+        self._client_creator = session.create_client(
+            "s3",
+            endpoint_url=CONFIG["store"]["endpoint_url"],
+            aws_access_key_id=self._creds["token"],
+            aws_secret_access_key=self._creds["secret"],
+            config=AioConfig(max_pool_connections=self._max_concurrency),
+        )
+        self._client = await self._client_creator.__aenter__()
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._client_creator.__aexit__(*exc_info)
+        self._client = None
+
+    async def _call(self, method, **kwargs):
+        async with self._semaphore:
+            return await getattr(self._client, method)(**kwargs)
+
+    async def _exists(self, path):
+        bucket, prefix = _split_path(path)
+
+        try:
+            if not prefix:
+                await self._call("head_bucket", Bucket=bucket)
+                return True
+
+            response = await self._call(
+                "list_objects_v2", Bucket=bucket, Prefix=prefix, MaxKeys=1
+            )
+            return response.get("KeyCount", 0) > 0
+
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] in NOT_FOUND_CODES:
+                return False
+            raise
+
+    @with_async_retries()
+    async def exists(self, path):
+        return await self._exists(path)
+
+    @with_async_retries()
+    async def create_bucket(self, bucket_id):
+        # Not `exists`, as the whole operation is already retried
+        if not await self._exists(bucket_id):
+            await self._call("create_bucket", Bucket=bucket_id)
+
+    mkdir = create_bucket
+
+    @with_async_retries()
+    async def find(self, path):
+        "Returns the keys of all objects under `path`."
+        bucket, prefix = _split_path(path)
+        keys = []
+
+        paginator = self._client.get_paginator("list_objects_v2")
+
+        async with self._semaphore:
+            async for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                keys.extend(item["Key"] for item in page.get("Contents", []))
+
+        return keys
+
+    @with_async_retries()
+    async def _delete_keys(self, bucket, keys):
+        await self._call(
+            "delete_objects",
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+        )
+
+    @with_async_retries()
+    async def _delete_bucket(self, bucket):
+        await self._call("delete_bucket", Bucket=bucket)
+
+    async def delete(self, path):
+        """
+        Deletes all objects under `path`, in batches, and then the bucket
+        itself if `path` is a bucket.
+        """
+        bucket, prefix = _split_path(path)
+
+        try:
+            keys = await self.find(path)
+
+            await asyncio.gather(
+                *[
+                    self._delete_keys(bucket, keys[i : i + DELETE_BATCH_SIZE])
+                    for i in range(0, len(keys), DELETE_BATCH_SIZE)
+                ]
+            )
+
+            if not prefix:
+                await self._delete_bucket(bucket)
+        except Exception as exc:
+            raise Exception(f"Cannot delete bucket: {path}") from exc
+
+    @with_async_retries()
+    async def chmod(self, bucket, key, permission="public-read"):
+        await self._call("put_object_acl", Bucket=bucket, Key=key, ACL=permission)
+
+    async def set_permissions(self, data_path, permission="public-read"):
+        "Sets the ACL of every object under `data_path` concurrently."
+        bucket, _ = _split_path(data_path)
+        keys = await self.find(data_path)
+
+        await asyncio.gather(*[self.chmod(bucket, key, permission) for key in keys])
+
+    @with_async_retries()
+    async def set_bucket_policy(self, bucket_id, policy=PUBLIC_READ_POLICY):
+        await self._call(
+            "put_bucket_policy", Bucket=bucket_id, Policy=json.dumps(policy)
+        )
+
+    async def gather(self, operation, paths, *args):
+        """
+        Runs `operation` for each of `paths` concurrently. Returns a
+        dictionary of {path: exception} for those that failed.
+        """
+        results = await asyncio.gather(
+            *[operation(path, *args) for path in paths], return_exceptions=True
+        )
+
+        return {
+            path: result
+            for path, result in zip(paths, results)
+            if isinstance(result, Exception)
+        }
+
+
+def run_on_buckets(creds, operation_name, buckets, *args):
+    """
+    Runs the named AsyncCaringoStore operation (e.g. "delete" or
+    "set_bucket_policy") on all `buckets` from synchronous code. Returns a
+    dictionary of {bucket: exception} for those that failed.
+    """
+
+    async def _run():
+        async with AsyncCaringoStore(creds) as store:
+            return await store.gather(getattr(store, operation_name), buckets, *args)
+
+    return asyncio.run(_run())
@@ -1,14 +1,21 @@
+import glob
 import os
 
 import pandas as pd
 
 from .. import logging
 from ..config import CONFIG
+from .batch_index import BATCH_INDEX, BatchIndex, write_batch_index
+from .batch_planner import log_batch_summary, plan_batches, summarise_batches
 from .utils import create_dir
 from .results_store import get_results_store
 
 LOGGER = logging.getLogger(__file__)
 
+# Table of the batch, number of files, volume and predicted runtime of every
+# dataset in the run version
+BATCH_TABLE = "batches.csv"
+
 
 class BatchManager(object):
     def __init__(self, project, exclude_done=True):
@@ -24,23 +31,111 @@ class BatchManager(object):
         self._version_dir = os.path.join(data_dir, run_version)
         create_dir(self._version_dir)
 
+        self._batch_table_path = os.path.join(self._version_dir, BATCH_TABLE)
+        self._batch_table = None
+
+        self._batch_index_path = os.path.join(self._version_dir, BATCH_INDEX)
+        self._batch_index = None
+
+    def _get_batch_index(self):
+        "Returns the batch index, or None if this run version does not have one."
+        if self._batch_index is None and os.path.isfile(self._batch_index_path):
+            self._batch_index = BatchIndex(self._batch_index_path)
+
+        return self._batch_index
+
+    def get_batch_rows(self, batch_numbers):
+        "Returns the rows of the batch table for the given batches."
+        index = self._get_batch_index()
+        if index:
+            return index.get_rows(batch_numbers)
+
+        df = self.get_batch_table()
+        return df[df.index.isin(batch_numbers)]
+
+    def get_batch_table(self):
+        """
+        Returns the batch table as a DataFrame indexed on batch number. Falls
+        back to reading the batch text files of older run versions, which
+        have no table.
+        """
+        if self._batch_table is None:
+            if os.path.isfile(self._batch_table_path):
+                df = pd.read_csv(self._batch_table_path, index_col="batch")
+            else:
+                records = [
+                    (self.batch_file_to_batch_number(batch_file), dataset_id)
+                    for batch_file in self.get_batch_files()
+                    for dataset_id in open(batch_file).read().strip().split()
+                ]
+                df = pd.DataFrame(
+                    records, columns=["batch", "dataset_id"]
+                ).set_index("batch")
+
+            self._batch_table = df
+
+        return self._batch_table
+
+    def get_batch_numbers(self):
+        index = self._get_batch_index()
+        if index:
+            return index.get_batch_numbers()
+
+        return [int(num) for num in sorted(self.get_batch_table().index.unique())]
+
     def get_batch_files(self):
-        batch_files = []
+        return sorted(glob.glob(os.path.join(self._version_dir, "batch_*.txt")))
 
-        for batch_file in sorted(os.listdir(self._version_dir)):
+    def get_batches(self):
+        for _, batch in self.get_batch_table().groupby(level="batch"):
+            yield list(batch["dataset_id"])
 
-            batch_file_path = os.path.join(self._version_dir, batch_file)
-            batch_files.append(batch_file_path)
+    def get_batch(self, batch_number):
+        index = self._get_batch_index()
+        if index:
+            return index.get_batch(batch_number)
 
-        return batch_files
+        df = self.get_batch_table()
+        return list(df.loc[df.index == batch_number, "dataset_id"])
 
-    def get_batches(self):
-        for batch_file_path in self.get_batch_files():
-            yield open(batch_file_path).read().strip().split()
+    def get_datasets_in_batches(self, batch_numbers):
+        return list(self.get_batch_rows(batch_numbers)["dataset_id"])
 
-    def get_batch(self, batch_number):
-        batch_file_path = self.get_batch_files()[batch_number - 1]
-        return open(batch_file_path).read().strip().split()
+    def get_batch_totals(self, batch_number):
+        """
+        Returns the number of datasets, files and volume of a batch, or None
+        if they are not in the batch table.
+        """
+        batch = self.get_batch_rows([batch_number])
+
+        if not {"num_files", "size_mb"}.issubset(batch.columns):
+            return None
+
+        return {
+            "n_datasets": len(batch),
+            "num_files": int(batch["num_files"].sum()),
+            "size_mb": float(batch["size_mb"].sum()),
+        }
+
+    def get_predicted_runtimes(self, batch_numbers):
+        "Returns the predicted runtime (in seconds) of each batch, if known."
+        df = self.get_batch_rows(batch_numbers)
+
+        if "predicted_runtime" not in df:
+            return {}
+
+        runtimes = df.groupby(level="batch")["predicted_runtime"].sum()
+        return {num: runtimes[num] for num in batch_numbers if num in runtimes.index}
+
+    def get_batches_for_datasets(self, dataset_ids):
+        "Returns the numbers of the batches that contain any of `dataset_ids`."
+        index = self._get_batch_index()
+        if index:
+            return index.get_batches_for_datasets(dataset_ids)
+
+        df = self.get_batch_table()
+        batch_numbers = df.index[df["dataset_id"].isin(dataset_ids)].unique()
+        return [int(num) for num in sorted(batch_numbers)]
 
     def batch_file_to_batch_number(self, batch_file):
         return int(os.path.basename(batch_file).split("_")[-1].split(".")[0])
@@ -54,10 +149,22 @@ class BatchManager(object):
 
         LOGGER.debug(f"Wrote batch file: {batch_file}")
 
+    def _write_batch_files(self, df):
+        "Exports the batch table as one text file of dataset IDs per batch."
+        for batch_file in self.get_batch_files():
+            os.remove(batch_file)
+
+        for batch_number, batch in df.groupby("batch"):
+            self._write_batch(batch_number, batch["dataset_id"])
+
     def create_batches(self):
         # Read in all datasets
         datasets_file = CONFIG["datasets"]["datasets_file"]
-        df = pd.read_csv(datasets_file, skipinitialspace=True)
+        df = pd.read_csv(
+            datasets_file,
+            skipinitialspace=True,
+            usecols=lambda col: col in ("dataset_id", "num_files", "size_mb"),
+        )
 
         total_volume = df["size_mb"].sum()
         max_volume = CONFIG["workflow"]["max_volume"]
@@ -69,38 +176,28 @@ class BatchManager(object):
             )
 
         self._datasets = list(df["dataset_id"])
-        # Convert batch volume limit to MB for unit consistency
-        batch_volume_limit = CONFIG["workflow"]["batch_volume_limit"] * (2 ** 10)
-
-        # Loop through grouping them into batches of approx batch_size
-        # - write each batch to text file in versioned data directory
-        current_size, current_batch, batch_count = 0, [], 1
 
         LOGGER.info(f"{len(df)} total datasets")
         if self._exclude_done:
-            successful_runs = set(self._results_store.get_successful_runs())
+            successful_runs = self._results_store.get_successful_runs()
             LOGGER.info(f"ignoring {len(successful_runs)} already processed")
-        
-        for _, row in df.iterrows():
-
-            dataset_id = row.dataset_id
-            LOGGER.debug(f"dataset: {dataset_id}")
-            if self._exclude_done and dataset_id in successful_runs:
-                LOGGER.debug(f"already done: {dataset_id}")
-                continue
-            
-            current_batch.append(row.dataset_id)
-            current_size += row.size_mb
-
-            if current_size >= batch_volume_limit:
-                self._write_batch(batch_count, current_batch)
-
-                # Reset variables
-                current_size, current_batch = 0, []
-                batch_count += 1
-
-        # Write last one if not written
-        if current_batch:
-            self._write_batch(batch_count, current_batch)
-
-        LOGGER.info(f"Wrote {batch_count} batch files.")
+            df = df[~df["dataset_id"].isin(successful_runs)]
+
+        df = plan_batches(df, self._project)
+
+        columns = [
+            col
+            for col in ("batch", "dataset_id", "num_files", "size_mb", "predicted_runtime")
+            if col in df
+        ]
+        df[columns].to_csv(self._batch_table_path, index=False)
+        write_batch_index(self._batch_index_path, df)
+        self._batch_table, self._batch_index = None, None
+
+        batch_count = df["batch"].max() if len(df) else 0
+        LOGGER.info(f"Wrote {batch_count} batches to: {self._batch_table_path}")
+        log_batch_summary(summarise_batches(df))
+
+        if CONFIG["workflow"]["write_batch_files"]:
+            self._write_batch_files(df)
+            LOGGER.info(f"Wrote {batch_count} batch files.")
@@ -0,0 +1,102 @@
+"""
+On-disk index of the batch table, so that the datasets in a batch (or the
+batches that some datasets are in) can be looked up without reading the
+whole table or the batch files.
+
+The index is a SQLite database indexed on both batch number and dataset ID.
+It is written once, by `create_batches`, and opened read-only and immutable
+so that many array jobs can read it at once on a shared filesystem without
+taking any locks.
+"""
+
+import os
+import sqlite3
+
+import pandas as pd
+
+BATCH_INDEX = "batch_index.sqlite"
+
+COLUMNS = ("batch", "dataset_id", "num_files", "size_mb", "predicted_runtime")
+
+# Max number of dataset IDs per query (SQLite limits the number of parameters)
+MAX_PARAMS = 900
+
+
+def write_batch_index(path, df):
+    """
+    Writes the columns of the batch table `df` to a new index at `path`,
+    replacing any existing index in one step.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+
+    try:
+        with conn:
+            df[[col for col in COLUMNS if col in df]].to_sql(
+                "batches", conn, index=False
+            )
+            conn.execute("CREATE INDEX batches_batch ON batches (batch);")
+            conn.execute("CREATE INDEX batches_dataset_id ON batches (dataset_id);")
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, path)
+
+
+class BatchIndex(object):
+    def __init__(self, path):
+        self._conn = sqlite3.connect(
+            f"file:{path}?mode=ro&immutable=1", uri=True, check_same_thread=False
+        )
+
+    def _query(self, query, params=()):
+        return self._conn.execute(query, params).fetchall()
+
+    def get_batch_numbers(self):
+        rows = self._query("SELECT DISTINCT batch FROM batches ORDER BY batch;")
+        return [row[0] for row in rows]
+
+    def get_batch(self, batch_number):
+        rows = self._query(
+            "SELECT dataset_id FROM batches WHERE batch=? ORDER BY rowid;",
+            (int(batch_number),),
+        )
+        return [row[0] for row in rows]
+
+    def _select_in(self, select, column, values):
+        "Yields queries (and their parameters) for `select` where `column` is in `values`."
+        values = list(values)
+
+        for i in range(0, len(values), MAX_PARAMS):
+            chunk = values[i : i + MAX_PARAMS]
+            placeholders = ",".join("?" * len(chunk))
+            yield f"{select} WHERE {column} IN ({placeholders}) ORDER BY rowid;", chunk
+
+    def get_batches_for_datasets(self, dataset_ids):
+        batch_numbers = set()
+
+        for query, params in self._select_in(
+            "SELECT batch FROM batches", "dataset_id", dataset_ids
+        ):
+            batch_numbers.update(row[0] for row in self._query(query, params))
+
+        return sorted(batch_numbers)
+
+    def get_rows(self, batch_numbers):
+        "Returns the rows of the given batches, as a DataFrame indexed on batch."
+        frames = [
+            pd.read_sql_query(query, self._conn, params=params, index_col="batch")
+            for query, params in self._select_in(
+                "SELECT * FROM batches", "batch", [int(num) for num in batch_numbers]
+            )
+        ]
+
+        if not frames:
+            return pd.read_sql_query(
+                "SELECT * FROM batches LIMIT 0;", self._conn, index_col="batch"
+            )
+
+        return pd.concat(frames)
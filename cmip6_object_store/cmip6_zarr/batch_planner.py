@@ -0,0 +1,261 @@
+"""
+Planning of which datasets go in each batch.
+
+Two strategies are available, set by `batch_strategy` in config.ini:
+
+ - "sequential": datasets are taken in the order of the datasets file, and
+            each batch holds approx `batch_volume_limit` of data.
+ - "binpack": datasets are packed, largest first, into the least loaded
+            batch that they fit in, so that every batch stays within the
+            limits on volume (`batch_volume_limit`), number of files
+            (`batch_file_limit`) and predicted runtime
+            (`batch_runtime_limit`), and the batches are as even as possible.
+
+The runtime of a dataset is predicted with a linear model of its number of
+files and volume. The coefficients are fitted to the runtimes recorded for
+previous batches, or taken from config.ini until there are enough of them.
+"""
+
+import glob
+import heapq
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from .. import logging
+from ..config import CONFIG
+
+LOGGER = logging.getLogger(__file__)
+
+BATCH_STRATEGIES = ("sequential", "binpack")
+
+# Per-dataset features that runtime is modelled on, and the config.ini
+# setting of the default coefficient (in seconds) of each
+RUNTIME_FEATURES = {
+    "n_datasets": "runtime_per_dataset",
+    "num_files": "runtime_per_file",
+    "size_mb": "runtime_per_mb",
+}
+
+
+def duration_to_seconds(duration):
+    "Converts a duration given as 'hh:mm:ss' to seconds."
+    hours, minutes, seconds = [int(item) for item in duration.split(":")]
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def get_runtimes_dir(project):
+    return os.path.join(CONFIG["log"]["log_base_dir"], project, "batch_runtimes")
+
+
+def write_runtime(project, batch_number, duration, totals):
+    """
+    Records how long a batch took to run, with the total of each feature
+    over its datasets, for fitting the runtime model.
+    """
+    runtimes_dir = get_runtimes_dir(project)
+    if not os.path.isdir(runtimes_dir):
+        os.makedirs(runtimes_dir, exist_ok=True)
+
+    record = dict(totals, batch=batch_number, duration=duration)
+
+    with open(os.path.join(runtimes_dir, f"batch_{batch_number:04d}.json"), "w") as writer:
+        json.dump(record, writer, indent=4)
+
+
+def read_runtimes(project):
+    "Returns a DataFrame of all the batch runtimes recorded for the project."
+    records = []
+
+    for runtime_file in sorted(glob.glob(os.path.join(get_runtimes_dir(project), "*.json"))):
+        with open(runtime_file) as reader:
+            records.append(json.load(reader))
+
+    return pd.DataFrame(records, columns=["batch", "duration"] + list(RUNTIME_FEATURES))
+
+
+class RuntimeModel(object):
+    """
+    Predicts runtime (in seconds) as a weighted sum of the number of
+    datasets, number of files and volume (in MB).
+    """
+
+    def __init__(self, coeffs):
+        self.coeffs = coeffs
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            {
+                feature: float(CONFIG["workflow"][setting])
+                for feature, setting in RUNTIME_FEATURES.items()
+            }
+        )
+
+    @classmethod
+    def fit(cls, runtimes):
+        """
+        Fits the coefficients to recorded batch runtimes, by least squares.
+        Coefficients that come out negative are set to zero.
+        """
+        features = list(RUNTIME_FEATURES)
+        runtimes = runtimes.dropna(subset=features + ["duration"])
+
+        X = runtimes[features].to_numpy(dtype=float)
+        y = runtimes["duration"].to_numpy(dtype=float)
+        coeffs = np.linalg.lstsq(X, y, rcond=None)[0].clip(min=0)
+
+        return cls(dict(zip(features, coeffs)))
+
+    @classmethod
+    def for_project(cls, project):
+        """
+        Returns the model fitted to the runtimes recorded for the project, or
+        the default model if there are too few of them.
+        """
+        runtimes = read_runtimes(project).dropna()
+
+        if len(runtimes) <= len(RUNTIME_FEATURES):
+            LOGGER.info(
+                f"Using default runtime model: only {len(runtimes)} batch runtimes recorded"
+            )
+            return cls.from_config()
+
+        model = cls.fit(runtimes)
+        LOGGER.info(f"Fitted runtime model to {len(runtimes)} batches: {model.coeffs}")
+        return model
+
+    def predict(self, df):
+        "Returns the predicted runtime of each dataset (row) of `df`."
+        runtime = pd.Series(self.coeffs["n_datasets"], index=df.index)
+
+        for feature in ("num_files", "size_mb"):
+            if feature in df:
+                runtime += self.coeffs[feature] * df[feature]
+
+        return runtime
+
+
+def plan_sequential(df, volume_limit):
+    """
+    Returns the batch number of each dataset, putting each one in the batch
+    that the volume of all the datasets before it falls in. Numbers skipped
+    by datasets larger than the limit are closed up.
+    """
+    volume_before = df["size_mb"].cumsum() - df["size_mb"]
+    batch_index = (volume_before // volume_limit).to_numpy()
+    return np.unique(batch_index, return_inverse=True)[1] + 1
+
+
+def plan_binpack(df, limits):
+    """
+    Returns the batch number of each dataset, packing them so that the total
+    of each column in `limits` ({column: limit}) stays within its limit.
+
+    Datasets are taken largest first (relative to the limits), and each one
+    goes in the least loaded batch, if it fits, or else in a new batch.
+    Datasets that are larger than a limit on their own get a batch each.
+    """
+    if not len(df):
+        return np.zeros(0, dtype=int)
+
+    columns = list(limits)
+    sizes = df[columns].to_numpy(dtype=float) / np.array([limits[col] for col in columns])
+
+    # Start with the fewest batches that could hold everything
+    n_batches = max(1, int(math.ceil(sizes.sum(axis=0).max())))
+    loads = [np.zeros(len(columns)) for _ in range(n_batches)]
+    heap = [(0.0, index) for index in range(n_batches)]
+
+    assigned = np.empty(len(df), dtype=int)
+
+    for row in np.argsort(-sizes.max(axis=1), kind="stable"):
+        _, index = heapq.heappop(heap)
+        new_load = loads[index] + sizes[row]
+
+        if (new_load <= 1).all() or not loads[index].any():
+            loads[index] = new_load
+            heapq.heappush(heap, (new_load.max(), index))
+        else:
+            heapq.heappush(heap, (loads[index].max(), index))
+
+            index = len(loads)
+            loads.append(sizes[row].copy())
+            heapq.heappush(heap, (sizes[row].max(), index))
+
+        assigned[row] = index
+
+    # Number batches in the order of their first dataset
+    _, first_rows, inverse = np.unique(assigned, return_index=True, return_inverse=True)
+    order = np.argsort(np.argsort(first_rows, kind="stable"), kind="stable")
+    return order[inverse] + 1
+
+
+def get_limits(df):
+    "Returns the limits for bin packing, in the units of the columns of `df`."
+    workflow = CONFIG["workflow"]
+
+    # Convert batch volume limit to MB for unit consistency
+    limits = {
+        "size_mb": workflow["batch_volume_limit"] * (2 ** 10),
+        "predicted_runtime": duration_to_seconds(workflow["batch_runtime_limit"]),
+    }
+
+    if "num_files" in df:
+        limits["num_files"] = workflow["batch_file_limit"]
+
+    return limits
+
+
+def plan_batches(df, project, strategy=None):
+    """
+    Returns a copy of the datasets DataFrame `df` with the predicted runtime
+    and batch number of each dataset, planned with the given strategy (or
+    `batch_strategy` from config.ini).
+    """
+    strategy = strategy or CONFIG["workflow"]["batch_strategy"]
+
+    if strategy not in BATCH_STRATEGIES:
+        raise ValueError(f"unsupported batch strategy {strategy}")
+
+    df = df.assign(predicted_runtime=RuntimeModel.for_project(project).predict(df))
+
+    if strategy == "binpack":
+        batches = plan_binpack(df, get_limits(df))
+    else:
+        batches = plan_sequential(df, CONFIG["workflow"]["batch_volume_limit"] * (2 ** 10))
+
+    return df.assign(batch=batches).sort_values("batch", kind="stable")
+
+
+def summarise_batches(df):
+    "Returns the number of datasets, files, volume and predicted runtime per batch."
+    columns = [col for col in ("num_files", "size_mb", "predicted_runtime") if col in df]
+
+    summary = df.groupby("batch")[columns].sum()
+    summary.insert(0, "n_datasets", df.groupby("batch").size())
+    return summary
+
+
+def log_batch_summary(summary):
+    "Logs the spread of predicted runtime across batches, and any that are too long."
+    if not len(summary):
+        return
+
+    runtime = summary["predicted_runtime"] / 3600
+    LOGGER.info(
+        f"Predicted batch runtime (hours): min {runtime.min():.2f}, "
+        f"median {runtime.median():.2f}, max {runtime.max():.2f}"
+    )
+
+    max_duration = duration_to_seconds(CONFIG["workflow"]["max_duration"])
+    too_long = summary.index[summary["predicted_runtime"] > max_duration]
+
+    if len(too_long):
+        LOGGER.warning(
+            f"{len(too_long)} batches are predicted to exceed the max duration "
+            f"of {CONFIG['workflow']['max_duration']}: {list(too_long)}"
+        )
@@ -1,36 +1,129 @@
+import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import s3fs
-from retry import retry
 
 from ..config import CONFIG
+from .retry_policy import with_retries
 
-retry_count = CONFIG["workflow"]["retries"]
+# Grants anonymous read and list access to everything in a bucket
+PUBLIC_READ_POLICY = {
+    "Version": "2008-10-17",
+    "Id": "Read All Policy",
+    "Statement": [
+        {
+            "Sid": "Read-only and list bucket access for Everyone",
+            "Effect": "Allow",
+            "Principal": {"anonymous": ["*"]},
+            "Action": ["GetObject", "ListBucket"],
+            "Resource": "*",
+        }
+    ],
+}
+
+
+# Filesystems and stores shared by everything in this process, keyed on
+# (endpoint, anon, token, secret) so that their HTTP connection pools are
+# reused across datasets
+_FILESYSTEMS = {}
+_STORES = {}
+_CACHE_LOCK = threading.RLock()
+
+
+def _cache_key(creds, anon, endpoint_url):
+    creds = creds or {}
+    return (endpoint_url, anon, creds.get("token"), creds.get("secret"))
+
+
+def get_filesystem(creds=None, anon=False, endpoint_url=None):
+    """
+    Returns the shared s3fs filesystem for the endpoint and credentials,
+    creating it on first use.
+    """
+    endpoint_url = endpoint_url or CONFIG["store"]["endpoint_url"]
+    key = _cache_key(creds, anon, endpoint_url)
+
+    with _CACHE_LOCK:
+        if key not in _FILESYSTEMS:
+            fs_kwargs = {} if anon else {"secret": creds["secret"], "key": creds["token"]}
+
+            _FILESYSTEMS[key] = s3fs.S3FileSystem(
+                anon=anon,
+                client_kwargs={"endpoint_url": endpoint_url},
+                config_kwargs={"max_pool_connections": 50},
+                skip_instance_cache=True,
+                **fs_kwargs,
+            )
+
+        return _FILESYSTEMS[key]
+
+
+def get_caringo_store(creds):
+    "Returns the shared CaringoStore for the credentials."
+    key = _cache_key(creds, False, CONFIG["store"]["endpoint_url"])
+
+    with _CACHE_LOCK:
+        if key not in _STORES:
+            _STORES[key] = CaringoStore(creds)
+
+        return _STORES[key]
+
+
+def _close_filesystem(fs):
+    """
+    Closes the HTTP session of an s3fs filesystem, if it opened one. s3fs
+    only does this when the filesystem is garbage collected.
+    """
+    s3creator = getattr(fs, "_s3creator", None)
+
+    if s3creator is not None:
+        s3fs.S3FileSystem.close_session(fs.loop, s3creator)
+
+
+def clear_store_cache():
+    "Closes and forgets all shared filesystems and stores."
+    with _CACHE_LOCK:
+        filesystems = list(_FILESYSTEMS.values())
+        _FILESYSTEMS.clear()
+        _STORES.clear()
+
+    for fs in filesystems:
+        _close_filesystem(fs)
+
+
+def _forget_store_cache():
+    """
+    Forgets all shared filesystems and stores without closing them. Called
+    in child processes after a fork, as connections and event loops belong
+    to the parent.
+    """
+    global _CACHE_LOCK
+
+    _CACHE_LOCK = threading.RLock()
+    _FILESYSTEMS.clear()
+    _STORES.clear()
+
+
+os.register_at_fork(after_in_child=_forget_store_cache)
 
 
 class CaringoStore(object):
     def __init__(self, creds):
         self._creds = creds
-        endpoint_url = CONFIG["store"]["endpoint_url"]
-
-        self._fs = s3fs.S3FileSystem(
-            anon=False,
-            secret=self._creds["secret"],
-            key=self._creds["token"],
-            client_kwargs={"endpoint_url": endpoint_url},
-            config_kwargs={"max_pool_connections": 50},
-        )
+        self._fs = get_filesystem(creds)
 
-    @retry(tries=retry_count, delay=3)
+    @with_retries()
     def create_bucket(self, bucket_id):
         if not self._fs.exists(bucket_id):
             self._fs.mkdir(bucket_id)
 
-    @retry(tries=retry_count, delay=3)
+    @with_retries()
     def exists(self, bucket_id):
         return self._fs.exists(bucket_id)
 
-    @retry(tries=retry_count, delay=3)
+    @with_retries()
     def delete(self, bucket_id):
         try:
             self._fs.delete(bucket_id, recursive=True)
@@ -40,15 +133,58 @@ class CaringoStore(object):
     def list(self):
         return self._fs.ls(".")
 
-    @retry(tries=retry_count, delay=3)
+    @with_retries()
     def get_store_map(self, data_path):
         return s3fs.S3Map(root=data_path, s3=self._fs)
 
-    @retry(tries=retry_count, delay=3)
-    def set_permissions(self, data_path, permission="public-read"):
-        for dr, _, files in self._fs.walk(data_path):
-            for item in files:
-                _path = os.path.join(dr, item)
+    @with_retries()
+    def _find(self, data_path):
+        "Returns {path: info} of every object under `data_path`."
+        self._fs.invalidate_cache(data_path)
+        return self._fs.find(data_path, detail=True)
+
+    @with_retries()
+    def _chmod(self, path, permission):
+        self._fs.chmod(path, permission)
+
+    def set_permissions(self, data_path, permission="public-read", n_workers=None):
+        """
+        Sets the ACL of every object under `data_path`. The objects are listed
+        once and the ACLs are then applied concurrently by a pool of
+        `n_workers` threads, retrying each object separately. Returns the
+        listing ({path: info}), so that it can be reused.
+        """
+        n_workers = n_workers or CONFIG["workflow"]["permission_workers"]
+        objects = self._find(data_path)
+        paths = list(objects)
+        failures = []
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = {
+                executor.submit(self._chmod, path, permission): path for path in paths
+            }
 
-                if self._fs.isfile(_path):
-                    self._fs.chmod(_path, permission)
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    failures.append(futures[future])
+
+        if failures:
+            raise Exception(
+                f"Failed to set permissions on {len(failures)} of {len(paths)} "
+                f"objects under {data_path}, e.g.: {failures[0]}"
+            )
+
+        return objects
+
+    @with_retries()
+    def set_bucket_policy(self, bucket_id, policy=PUBLIC_READ_POLICY):
+        """
+        Applies a bucket policy in a single call, instead of setting the ACL
+        of each object. Only suitable for buckets that contain nothing but
+        our own data.
+        """
+        self._fs.call_s3(
+            "put_bucket_policy", Bucket=bucket_id, Policy=json.dumps(policy)
+        )
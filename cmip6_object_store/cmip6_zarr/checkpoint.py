@@ -0,0 +1,92 @@
+"""
+Checkpoints for resumable Zarr writes.
+
+The progress of a write is recorded in a small JSON object inside the Zarr
+store itself, listing the regions (blocks of time steps) that have been
+written completely. A re-run of a failed conversion, or of one killed by the
+LOTUS time limit, then only writes the regions that are missing. The
+checkpoint is only used if it was made with the same write plan (its
+"signature"); otherwise the store is written from scratch.
+"""
+
+import json
+
+import zarr
+
+CHECKPOINT_KEY = ".checkpoint.json"
+
+
+class WriteCheckpoint(object):
+    def __init__(self, store_map, signature):
+        self._store_map = store_map
+        # Normalise to what will be read back from JSON
+        self._signature = json.loads(json.dumps(signature))
+        self._done = set()
+
+    @property
+    def n_done(self):
+        return len(self._done)
+
+    def resume(self):
+        """
+        Loads the progress recorded in the store. Returns True if a checkpoint
+        for the same write plan was found.
+        """
+        try:
+            content = json.loads(self._store_map[CHECKPOINT_KEY])
+        except KeyError:
+            return False
+
+        if content.get("signature") != self._signature:
+            return False
+
+        self._done = set(content["done"])
+        return True
+
+    def start(self):
+        self._done = set()
+        self._save()
+
+    def is_done(self, region):
+        return region in self._done
+
+    def mark_done(self, region):
+        self._done.add(region)
+        self._save()
+
+    def clear(self):
+        if CHECKPOINT_KEY in self._store_map:
+            del self._store_map[CHECKPOINT_KEY]
+
+    def _save(self):
+        content = {"signature": self._signature, "done": sorted(self._done)}
+        self._store_map[CHECKPOINT_KEY] = json.dumps(content).encode("utf-8")
+
+
+def _get_dims(array):
+    dims = array.attrs.get("_ARRAY_DIMENSIONS")
+
+    if dims is None:
+        dims = getattr(getattr(array, "metadata", None), "dimension_names", None)
+
+    return list(dims or [])
+
+
+def truncate_dim(store_map, dim, length):
+    """
+    Resizes every array in the Zarr store that has dimension `dim` so that
+    it has `length` items along it, discarding anything written after the
+    last checkpoint.
+    """
+    group = zarr.open_group(store_map, mode="r+")
+
+    for _, array in group.arrays():
+        dims = _get_dims(array)
+        if dim not in dims:
+            continue
+
+        shape = list(array.shape)
+        shape[dims.index(dim)] = length
+
+        if tuple(shape) != tuple(array.shape):
+            array.resize(shape)
@@ -0,0 +1,165 @@
+"""
+Content checksums of the Zarr stores, so that they can be verified without
+re-reading the NetCDF files in the archive.
+
+As each block of a variable (a Zarr chunk, or a shard if sharded) is
+written, a hash of its decoded values is recorded in a manifest, which is
+saved as a small JSON object inside the Zarr store. The digest of the
+manifest is also recorded in the results DB, so that a lost or altered
+manifest is detected. Verification re-reads each block from the store,
+hashes it and compares it with the manifest.
+
+Only the variables written as dask arrays are hashed, and not those of
+object type (such as times decoded to cftime objects).
+"""
+
+import hashlib
+import json
+import threading
+
+import dask
+import numpy as np
+
+from .pipeline import iter_chunk_regions
+
+MANIFEST_KEY = ".checksums.json"
+HASH_ALGORITHM = "blake2b"
+
+
+def hash_values(values):
+    """
+    Returns the hex digest of an array of decoded values. All NaNs hash the
+    same, as missing values are decoded to NaN from the fill value.
+    """
+    values = np.ascontiguousarray(values)
+
+    if values.dtype.kind in "fc":
+        values = np.where(np.isnan(values), np.nan, values).astype(values.dtype)
+
+    digest = hashlib.new(HASH_ALGORITHM, digest_size=16)
+    digest.update(f"{values.dtype.str}{values.shape}".encode("utf-8"))
+    digest.update(values.tobytes())
+
+    return digest.hexdigest()
+
+
+def is_hashed(variable):
+    "Returns True if the blocks of `variable` are hashed when written."
+    return variable.chunks is not None and variable.dtype.kind != "O"
+
+
+def region_to_key(region):
+    return ",".join(f"{region_slice.start}:{region_slice.stop}" for region_slice in region.values())
+
+
+def key_to_region(key, dims):
+    slices = [slice(*[int(index) for index in item.split(":")]) for item in key.split(",")]
+    return dict(zip(dims, slices))
+
+
+def iter_block_hashes(ds, offsets=None):
+    """
+    Yields (name, dims, region, digest) for each block of the hashed
+    variables of `ds`, where the digest is a dask delayed object. Regions
+    are shifted by `offsets` ({dim: start}), the position of `ds` in the
+    store.
+    """
+    offsets = offsets or {}
+
+    for name, variable in ds.variables.items():
+        if not is_hashed(variable):
+            continue
+
+        blocks = variable.data.to_delayed().ravel()
+
+        for block, region in zip(blocks, iter_chunk_regions(variable)):
+            region = {
+                dim: slice(item.start + offsets.get(dim, 0), item.stop + offsets.get(dim, 0))
+                for dim, item in region.items()
+            }
+            yield name, variable.dims, region, dask.delayed(hash_values)(block)
+
+
+class ChecksumManifest(object):
+    "Hashes of the blocks of each variable in a Zarr store."
+
+    def __init__(self, variables=None):
+        # {name: {"dims": [...], "blocks": {region key: digest}}}
+        self._variables = variables or {}
+        self._lock = threading.Lock()
+
+    @property
+    def n_blocks(self):
+        return sum(len(content["blocks"]) for content in self._variables.values())
+
+    def add(self, name, dims, region, digest):
+        with self._lock:
+            content = self._variables.setdefault(name, {"dims": list(dims), "blocks": {}})
+            content["blocks"][region_to_key(region)] = digest
+
+    def add_values(self, name, dims, region, values):
+        "Hashes and adds a block of decoded values, unless of object type."
+        if values.dtype.kind != "O":
+            self.add(name, dims, region, hash_values(values))
+
+    def add_blocks(self, ds, offsets=None, delayed_obj=None, **compute_kwargs):
+        """
+        Computes `delayed_obj` (such as a delayed write of `ds`) and the
+        hashes of the blocks of `ds` together, so that each block is only
+        read once, and adds the hashes. `compute_kwargs` (such as the
+        scheduler) are passed to `dask.compute`.
+        """
+        blocks = list(iter_block_hashes(ds, offsets))
+        _, digests = dask.compute(
+            delayed_obj, [digest for *_, digest in blocks], **compute_kwargs
+        )
+
+        for (name, dims, region, _), digest in zip(blocks, digests):
+            self.add(name, dims, region, digest)
+
+    def iter_blocks(self):
+        "Yields (name, region, digest) for each block in the manifest."
+        for name, content in sorted(self._variables.items()):
+            for key, digest in content["blocks"].items():
+                yield name, key_to_region(key, content["dims"]), digest
+
+    def to_json(self):
+        with self._lock:
+            return json.dumps(
+                {"algorithm": HASH_ALGORITHM, "variables": self._variables}, sort_keys=True
+            )
+
+    def digest(self):
+        "Returns a digest of the whole manifest, to record in the results DB."
+        content = hashlib.new(HASH_ALGORITHM, self.to_json().encode("utf-8")).hexdigest()
+        return json.dumps({"digest": content, "n_blocks": self.n_blocks})
+
+    def save(self, store_map):
+        store_map[MANIFEST_KEY] = self.to_json().encode("utf-8")
+
+    def resume(self, store_map):
+        """
+        Adds the hashes saved in the store by an earlier (partial) write.
+        Returns True if a manifest was found.
+        """
+        manifest = load_manifest(store_map)
+        if manifest is None:
+            return False
+
+        with self._lock:
+            self._variables.update(manifest._variables)
+
+        return True
+
+
+def load_manifest(store_map):
+    "Returns the manifest saved in the store, or None if there is none."
+    try:
+        content = json.loads(store_map[MANIFEST_KEY])
+    except KeyError:
+        return None
+
+    if content.get("algorithm") != HASH_ALGORITHM:
+        raise ValueError(f"unsupported checksum algorithm {content.get('algorithm')}")
+
+    return ChecksumManifest(content["variables"])
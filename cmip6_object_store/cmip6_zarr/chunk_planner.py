@@ -0,0 +1,163 @@
+"""
+Plans the Zarr chunk shape of every variable in a dataset.
+
+The main variable is chunked so that each chunk is no larger than the
+configured chunk size in bytes. The order in which dimensions are split
+depends on the access pattern that the store is optimised for:
+
+ - "map": keep whole fields together and split along time first, then
+          along the remaining dimensions in the order they are declared
+          (e.g. plev, lat, lon) if a single time step is still too big.
+ - "timeseries": keep the time axis whole for as long as possible and
+          split the other dimensions first.
+
+Coordinate and bounds variables take the chunk length of the main variable
+for any dimension they share with it, and are not split otherwise.
+
+For Zarr format 3, chunks can also be grouped into shards, each written as
+a single object. Shards are made of whole chunks, up to the configured
+shard size, grouping chunks along the dimensions in the same order as they
+are split.
+"""
+
+import math
+
+import numpy as np
+
+TIME_DIM = "time"
+ACCESS_PATTERNS = ("map", "timeseries")
+
+
+def _split_order(dims, access_pattern):
+    others = [dim for dim in dims if dim != TIME_DIM]
+    time = [TIME_DIM] if TIME_DIM in dims else []
+
+    if access_pattern == "map":
+        return time + others
+    elif access_pattern == "timeseries":
+        return others + time
+    else:
+        raise ValueError(f"unsupported access pattern {access_pattern}")
+
+
+def plan_var_chunks(dims, shape, itemsize, chunk_size_bytes, access_pattern="map"):
+    """
+    Returns a dictionary of {dim: chunk_length} for an array of the given
+    dimensions, shape and item size in bytes, so that no chunk exceeds
+    `chunk_size_bytes`. Chunk lengths are balanced so that the chunks along a
+    split dimension are (almost) equal in size.
+    """
+    chunks = dict(zip(dims, shape))
+
+    for dim in _split_order(dims, access_pattern):
+        n_bytes = itemsize * int(np.prod(list(chunks.values())))
+        if n_bytes <= chunk_size_bytes:
+            break
+
+        size = chunks[dim]
+        if size == 0:
+            continue
+
+        other_bytes = n_bytes // size
+        max_length = max(1, chunk_size_bytes // other_bytes)
+
+        n_chunks = math.ceil(size / max_length)
+        chunks[dim] = math.ceil(size / n_chunks)
+
+    return chunks
+
+
+def plan_chunks(ds, var_id, chunk_size_bytes, access_pattern="map", sizes=None):
+    """
+    Returns a chunk spec {var_name: {dim: chunk_length}} for every variable
+    (data, coordinate and bounds variables) in the Xarray dataset `ds`, based
+    on the main variable `var_id`.
+
+    `sizes` can be used to override the length of dimensions in `ds`, e.g.
+    when `ds` only holds the first file of a multi-file dataset.
+    """
+    dim_sizes = dict(ds.sizes)
+    dim_sizes.update(sizes or {})
+
+    var = ds[var_id]
+    shape = [dim_sizes[dim] for dim in var.dims]
+
+    main_chunks = plan_var_chunks(
+        var.dims, shape, var.dtype.itemsize, chunk_size_bytes, access_pattern
+    )
+
+    chunk_plan = {}
+
+    for name, variable in ds.variables.items():
+        chunk_plan[name] = {
+            dim: main_chunks.get(dim, dim_sizes[dim]) for dim in variable.dims
+        }
+
+    return chunk_plan
+
+
+def plan_shards(ds, var_id, chunk_plan, shard_size_bytes, access_pattern="map", sizes=None):
+    """
+    Returns a shard spec {var_name: {dim: shard_length}} for every variable
+    in the chunk plan, grouping whole chunks of the main variable `var_id`
+    into shards of no more than `shard_size_bytes`. Other variables take the
+    shard length of the main variable for any dimension they share with it.
+    """
+    dim_sizes = dict(ds.sizes)
+    dim_sizes.update(sizes or {})
+
+    var = ds[var_id]
+    chunks = chunk_plan[var_id]
+
+    chunk_bytes = var.dtype.itemsize * int(np.prod(list(chunks.values())))
+    n_chunks = max(1, int(shard_size_bytes // max(chunk_bytes, 1)))
+
+    main_shards = dict(chunks)
+
+    for dim in _split_order(var.dims, access_pattern):
+        if n_chunks == 1:
+            break
+
+        if chunks[dim] == 0:
+            continue
+
+        n_along_dim = min(n_chunks, math.ceil(dim_sizes[dim] / chunks[dim]))
+        main_shards[dim] = chunks[dim] * n_along_dim
+        n_chunks //= n_along_dim
+
+    return {
+        name: {dim: main_shards.get(dim, length) for dim, length in spec.items()}
+        for name, spec in chunk_plan.items()
+    }
+
+
+def apply_chunk_plan(ds, chunk_plan, shard_plan=None):
+    """
+    Returns a copy of `ds` chunked according to `chunk_plan`. Index
+    coordinates cannot be chunked with dask in Xarray, so their chunk shape
+    is set in the encoding used when writing to Zarr.
+
+    If a `shard_plan` is given, the Zarr chunk and shard shapes are set in
+    the encoding and the dask chunks are whole shards, so that each shard
+    is written by a single task.
+    """
+    chunked_ds = ds.copy()
+    data_vars, coords = {}, {}
+
+    for name, spec in chunk_plan.items():
+        variable = chunked_ds.variables[name]
+        dask_spec = spec
+
+        if shard_plan is not None and variable.dims:
+            dask_spec = shard_plan[name]
+            variable.encoding["chunks"] = tuple(spec[dim] for dim in variable.dims)
+            variable.encoding["shards"] = tuple(dask_spec[dim] for dim in variable.dims)
+
+        if name in chunked_ds.indexes:
+            variable.encoding["chunks"] = tuple(spec[dim] for dim in variable.dims)
+        elif name in chunked_ds.coords:
+            coords[name] = variable.chunk(dask_spec)
+        else:
+            data_vars[name] = variable.chunk(dask_spec)
+
+    return chunked_ds.assign_coords(coords).assign(data_vars)
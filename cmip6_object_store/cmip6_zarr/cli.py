@@ -8,14 +8,22 @@ import shutil
 import sys
 
 from cmip6_object_store import CONFIG, logging
+from cmip6_object_store.cmip6_zarr.async_store import run_on_buckets
 from cmip6_object_store.cmip6_zarr.batch import BatchManager
-from cmip6_object_store.cmip6_zarr.caringo_store import CaringoStore
+from cmip6_object_store.cmip6_zarr.codec_benchmark import benchmark_codecs, summarise_benchmark
 from cmip6_object_store.cmip6_zarr.compare import compare_zarrs_with_ncs
-from cmip6_object_store.cmip6_zarr.results_store import get_results_store, get_verification_store
-from cmip6_object_store.cmip6_zarr.task import TaskManager
+from cmip6_object_store.cmip6_zarr.conversion_stats import get_stats_table, summarise_stats
+from cmip6_object_store.cmip6_zarr.results_store import (
+    get_results_store,
+    get_stats_store,
+    get_verification_store,
+    sync_results,
+)
+from cmip6_object_store.cmip6_zarr.task import QueueWorker, TaskManager
 from cmip6_object_store.cmip6_zarr.intake_cat import create_intake_catalogue
 from cmip6_object_store.cmip6_zarr.utils import (
     get_credentials,
+    get_zarr_path,
     get_zarr_url,
 )
 
@@ -36,6 +44,14 @@ def _add_arg_parser_run(parser):
               "Batch number will be taken from SLURM_ARRAY_TASK_ID environment variable."),
     )
 
+    group.add_argument(
+        "--queue-worker",
+        action="store_true",
+        required=False,
+        help=("Not for interactive use. \n"
+              "Converts datasets claimed from the work queue until it is empty."),
+    )
+
     group.add_argument(
         "-b",
         "--batches",
@@ -66,6 +82,23 @@ def _add_arg_parser_run(parser):
         help="Mode to run in, either 'lotus' (default) or 'local'.",
     )
 
+    parser.add_argument(
+        "-q",
+        "--queue",
+        action="store_true",
+        help="Queue the datasets and have workers claim them until all are done, "
+        "instead of running a fixed batch per job.",
+    )
+
+    parser.add_argument(
+        "-n",
+        "--n-workers",
+        type=int,
+        default=None,
+        required=False,
+        help="Number of queue workers to start (default: queue_workers in config).",
+    )
+
 
 def _range_to_list(range_string, sep):
     start, end = [int(val) for val in range_string.split(sep)]
@@ -104,7 +137,20 @@ def parse_args_run(args):
 def run_main(args):
     project, batches, datasets, run_mode = parse_args_run(args)
 
-    tm = TaskManager(project, batches=batches, datasets=datasets, run_mode=run_mode)
+    if args.queue_worker:
+        QueueWorker(project).run()
+        return
+
+    scheduling = "queue" if args.queue else "static"
+
+    tm = TaskManager(
+        project,
+        batches=batches,
+        datasets=datasets,
+        run_mode=run_mode,
+        scheduling=scheduling,
+        n_workers=args.n_workers,
+    )
     tm.run_tasks()
 
 
@@ -139,10 +185,13 @@ def _add_arg_parser_intake(parser):
     _add_arg_parser_project(parser, description="to create intake catalog for")
     parser.add_argument("--limit", type=int,
                         help="maximum number of datasets to include")
+    parser.add_argument("--full", action="store_true",
+                        help="rebuild the catalog instead of only adding the "
+                        "datasets that are not in it yet")
 
 def intake_main(args):
     project = parse_args_project(args)
-    create_intake_catalogue(project, limit=args.limit)
+    create_intake_catalogue(project, limit=args.limit, full=args.full)
     
     
 def _add_arg_parser_clean(parser):
@@ -189,11 +238,57 @@ def clean_main(args):
 
     if buckets_to_delete:
         LOGGER.warning("Starting to delete buckets from Object Store!")
-        caringo_store = CaringoStore(creds=get_credentials())
-
         for bucket in buckets_to_delete:
             LOGGER.warning(f"DELETING BUCKET: {bucket}")
-            caringo_store.delete(bucket)
+
+        failures = run_on_buckets(get_credentials(), "delete", buckets_to_delete)
+
+        for bucket, exc in failures.items():
+            LOGGER.error(f"Failed to delete bucket {bucket}: {exc}")
+
+
+def _add_arg_parser_permissions(parser):
+
+    _add_arg_parser_project(parser, description="to set permissions for")
+
+    parser.add_argument(
+        "-b",
+        "--buckets",
+        default=[],
+        nargs="*",
+        help="Buckets to make public (defaults to all buckets with "
+        "successfully converted datasets)",
+    )
+
+    parser.add_argument(
+        "--policy",
+        action="store_true",
+        help="Set a public-read bucket policy instead of per-object ACLs",
+    )
+
+
+def permissions_main(args):
+    project = parse_args_project(args)
+    buckets = args.buckets
+
+    if not buckets:
+        results_store = get_results_store(project)
+        buckets = sorted(
+            {
+                get_zarr_path(dataset_id, project)[0]
+                for dataset_id in results_store.get_successful_runs()
+            }
+        )
+
+    operation = "set_bucket_policy" if args.policy else "set_permissions"
+    print(f"Setting permissions on {len(buckets)} buckets ({operation})...")
+
+    failures = run_on_buckets(get_credentials(), operation, buckets)
+
+    for bucket, exc in failures.items():
+        print(f"FAILED for {bucket}: {exc}")
+
+    print(f"\nSet permissions on {len(buckets) - len(failures)} of {len(buckets)} buckets.")
 
 
 def _add_arg_parser_list(parser):
@@ -231,7 +326,13 @@ def verify_main(args):
     results_store = get_results_store(project)
     verified_store = get_verification_store(project)
     
-    successes, out_of = compare_zarrs_with_ncs(project, dataset_id=args.dataset)
+    successes, out_of = compare_zarrs_with_ncs(
+        project,
+        n_to_test=args.n_to_test,
+        dataset_id=args.dataset,
+        checksums=args.checksums,
+        n_workers=args.workers,
+    )
     print(f"\nVerified {successes} out of {out_of} datasets.")
 
     print("\n\nResults of all verifications so far:")
@@ -260,6 +361,119 @@ def show_errors_main(args):
     print(f"\nFound {len(errors)} errors.")
 
 
+def _add_arg_parser_stats(parser):
+
+    _add_arg_parser_project(parser, description="to report conversion stats for")
+
+    parser.add_argument(
+        "-d",
+        "--dataset",
+        type=str,
+        default=None,
+        required=False,
+        help="Show the stats of a single dataset ID",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default=None,
+        required=False,
+        help="CSV file to write the stats of all datasets to",
+    )
+
+
+def stats_main(args):
+    project = parse_args_project(args)
+    df = get_stats_table(get_stats_store(project))
+
+    if df.empty:
+        print("No stats recorded yet.")
+        return
+
+    if args.dataset:
+        print(df.loc[args.dataset].to_string())
+        return
+
+    if args.output:
+        df.to_csv(args.output)
+        print(f"Wrote stats of {len(df)} datasets to: {args.output}")
+
+    print(f"Stats of {int(df['ok'].sum())} successful conversions "
+          f"({int((df['ok'] == 0).sum())} failed):\n")
+    print(summarise_stats(df).to_string(float_format=lambda value: f"{value:.2f}"))
+
+
+def _add_arg_parser_benchmark_codecs(parser):
+
+    _add_arg_parser_project(parser, description="to benchmark codecs on")
+
+    parser.add_argument(
+        "-c",
+        "--codecs",
+        type=str,
+        nargs="+",
+        default=None,
+        required=False,
+        help="Codec specs to compare (defaults to 'benchmark_codecs' in the config)",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--datasets",
+        type=str,
+        nargs="+",
+        default=None,
+        required=False,
+        help="Dataset IDs to benchmark on (defaults to choosing a sample)",
+    )
+
+    parser.add_argument(
+        "-n",
+        "--n-datasets",
+        type=int,
+        default=3,
+        required=False,
+        help="Number of datasets to sample from the datasets file",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default=None,
+        required=False,
+        help="CSV file to write the results for each dataset to",
+    )
+
+
+def benchmark_codecs_main(args):
+    project = parse_args_project(args)
+    df = benchmark_codecs(
+        project, specs=args.codecs, dataset_ids=args.datasets, n_datasets=args.n_datasets
+    )
+
+    if df.empty:
+        print("No datasets found to benchmark.")
+        return
+
+    if args.output:
+        df.to_csv(args.output)
+        print(f"Wrote benchmark results to: {args.output}")
+
+    n_datasets = df.index.get_level_values("dataset_id").nunique()
+    print(f"Codecs benchmarked on {n_datasets} datasets "
+          "(throughputs in MB/s of uncompressed data):\n")
+    print(summarise_benchmark(df).to_string(float_format=lambda value: f"{value:.2f}"))
+
+
+def sync_results_main(args):
+    project = parse_args_project(args)
+    n_results = sync_results(project)
+    print(f"Pushed {n_results} local results to the central database.")
+
+
 def main():
     """Console script for cmip6_object_store."""
     main_parser = argparse.ArgumentParser()
@@ -278,6 +492,10 @@ def main():
     _add_arg_parser_clean(clean_parser)
     clean_parser.set_defaults(func=clean_main)
 
+    permissions_parser = subparsers.add_parser("set-permissions")
+    _add_arg_parser_permissions(permissions_parser)
+    permissions_parser.set_defaults(func=permissions_main)
+
     list_parser = subparsers.add_parser("list")
     _add_arg_parser_list(list_parser)
     list_parser.set_defaults(func=list_main)
@@ -294,6 +512,32 @@ def main():
         help="Single dataset ID to verify (defaults to choosing a sample)"
     )
 
+    verify_parser.add_argument(
+        "-n",
+        "--n-to-test",
+        type=int,
+        default=5,
+        required=False,
+        help="Number of datasets to sample from those not yet verified",
+    )
+
+    verify_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        required=False,
+        help="Number of datasets verified concurrently "
+        "(defaults to 'verify_dataset_workers' in the config)",
+    )
+
+    verify_parser.add_argument(
+        "--checksums",
+        action="store_true",
+        help="Check the Zarr files against the checksums recorded when they were "
+        "written, instead of reading the NetCDF files",
+    )
+
     verify_parser.set_defaults(func=verify_main)
 
     intake_parser = subparsers.add_parser("create-intake")
@@ -304,6 +548,18 @@ def main():
     _add_arg_parser_project(show_errors_parser)
     show_errors_parser.set_defaults(func=show_errors_main)
 
+    stats_parser = subparsers.add_parser("stats")
+    _add_arg_parser_stats(stats_parser)
+    stats_parser.set_defaults(func=stats_main)
+
+    benchmark_parser = subparsers.add_parser("benchmark-codecs")
+    _add_arg_parser_benchmark_codecs(benchmark_parser)
+    benchmark_parser.set_defaults(func=benchmark_codecs_main)
+
+    sync_parser = subparsers.add_parser("sync-results")
+    _add_arg_parser_project(sync_parser, description="to push local SQLite results for")
+    sync_parser.set_defaults(func=sync_results_main)
+
     args = main_parser.parse_args()
     args.func(args)
 
@@ -0,0 +1,171 @@
+"""
+Benchmark of candidate codec specs (see encoding) on sample datasets, to
+choose the `codecs` that minimise the size of the store and read latency.
+
+The main variable of each sample dataset is read from its first NetCDF
+file in the archive, chunked as it would be converted, and written with
+each codec spec to an in-memory store and read back. Encoding and decoding
+run on the synchronous dask scheduler, so the throughputs are per core.
+"""
+
+import random
+import time
+import uuid
+import warnings
+
+import dask
+import fsspec
+import pandas as pd
+import xarray as xr
+
+from .. import logging
+from ..config import CONFIG, get_from_proj_or_workflow
+from .archive_scanner import get_archive_scanner
+from .chunk_planner import TIME_DIM, apply_chunk_plan, plan_chunks
+from .encoding import get_codecs
+from .pipeline import METADATA_NAMES
+from .utils import get_var_id
+
+LOGGER = logging.getLogger(__file__)
+
+MB = 2 ** 20
+
+
+def sample_dataset_ids(n, seed=None):
+    "Returns `n` dataset IDs chosen at random from the datasets file."
+    df = pd.read_csv(
+        CONFIG["datasets"]["datasets_file"], skipinitialspace=True, usecols=["dataset_id"]
+    )
+    dataset_ids = list(df["dataset_id"])
+
+    return random.Random(seed).sample(dataset_ids, min(n, len(dataset_ids)))
+
+
+def load_sample(dataset_id, project, sample_mb):
+    """
+    Returns the main variable of the dataset, from its first NetCDF file,
+    as a chunked dataset of at most `sample_mb` MB (and at least one time
+    step) loaded into memory. Returns None if there are no files.
+    """
+    nc_files = get_archive_scanner(project).list_nc_files(dataset_id)
+    if not nc_files:
+        return None
+
+    var_id = get_var_id(dataset_id, project=project)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        ds = xr.open_dataset(nc_files[0], use_cftime=True)
+
+    variable = ds[var_id].variable
+
+    if TIME_DIM in variable.dims:
+        step_bytes = variable.nbytes / variable.sizes[TIME_DIM]
+        n_times = max(1, int(sample_mb * MB // step_bytes))
+        variable = variable.isel({TIME_DIM: slice(0, n_times)})
+
+    sample = xr.Dataset({var_id: variable.load()})
+    ds.close()
+
+    chunk_size_bytes = get_from_proj_or_workflow("chunk_size", project) * MB
+    access_pattern = get_from_proj_or_workflow("access_pattern", project)
+    chunk_plan = plan_chunks(sample, var_id, chunk_size_bytes, access_pattern)
+
+    return apply_chunk_plan(sample, chunk_plan)
+
+
+def benchmark_sample(sample, specs, zarr_format=None):
+    """
+    Writes the dataset `sample` with each codec spec to an in-memory store
+    (in the Zarr format given, or the zarr default) and reads it back.
+    Returns a DataFrame of the compression ratio and the encode and decode
+    throughputs (in MB of raw data per second) of each.
+    """
+    (var_id,) = sample.data_vars
+    raw_mb = sample[var_id].nbytes / MB
+    rows = []
+
+    for spec in specs:
+        store_map = fsspec.get_mapper(f"memory://codec-benchmark/{uuid.uuid4().hex}")
+        codecs = get_codecs(spec, sample[var_id].dtype, zarr_format)
+
+        encoded = sample.copy()
+        encoded.variables[var_id].encoding.update(codecs or {})
+
+        with dask.config.set(scheduler="synchronous"):
+            start = time.perf_counter()
+            encoded.to_zarr(
+                store_map, mode="w", consolidated=False, zarr_format=zarr_format
+            )
+            encode_time = time.perf_counter() - start
+
+            stored_mb = sum(
+                len(store_map[key])
+                for key in store_map
+                if key.startswith(f"{var_id}/") and key.split("/")[-1] not in METADATA_NAMES
+            ) / MB
+
+            start = time.perf_counter()
+            xr.open_zarr(store_map, consolidated=False)[var_id].load()
+            decode_time = time.perf_counter() - start
+
+        store_map.fs.rm(store_map.root, recursive=True)
+
+        rows.append(
+            {
+                "codecs": spec,
+                "raw_mb": raw_mb,
+                "stored_mb": stored_mb,
+                "ratio": raw_mb / stored_mb if stored_mb else float("nan"),
+                "encode_mb_s": raw_mb / encode_time,
+                "decode_mb_s": raw_mb / decode_time,
+            }
+        )
+
+    return pd.DataFrame(rows)
+
+
+def benchmark_codecs(project, specs=None, dataset_ids=None, n_datasets=3, sample_mb=None):
+    """
+    Benchmarks the codec specs (by default, `benchmark_codecs`) on the
+    datasets given, or on `n_datasets` datasets sampled from the datasets
+    file. Returns a DataFrame with a row per dataset and codec spec.
+    """
+    specs = specs or get_from_proj_or_workflow("benchmark_codecs", project)
+    sample_mb = sample_mb or get_from_proj_or_workflow("benchmark_sample_size", project)
+    dataset_ids = dataset_ids or sample_dataset_ids(n_datasets)
+    zarr_format = get_from_proj_or_workflow("zarr_format", project)
+
+    results = []
+
+    for dataset_id in dataset_ids:
+        sample = load_sample(dataset_id, project, sample_mb)
+
+        if sample is None:
+            LOGGER.warning(f"No NetCDF files found, skipping: {dataset_id}")
+            continue
+
+        LOGGER.info(f"Benchmarking {len(specs)} codec specs on: {dataset_id}")
+        results.append(benchmark_sample(sample, specs, zarr_format).assign(dataset_id=dataset_id))
+
+    if not results:
+        return pd.DataFrame()
+
+    return pd.concat(results, ignore_index=True).set_index(["dataset_id", "codecs"])
+
+
+def summarise_benchmark(df):
+    """
+    Returns the overall compression ratio and the median encode and decode
+    throughputs of each codec spec, best compression first.
+    """
+    by_codecs = df.groupby(level="codecs")
+    summary = pd.DataFrame(
+        {
+            "ratio": by_codecs["raw_mb"].sum() / by_codecs["stored_mb"].sum(),
+            "encode_mb_s": by_codecs["encode_mb_s"].median(),
+            "decode_mb_s": by_codecs["decode_mb_s"].median(),
+        }
+    )
+
+    return summary.sort_values("ratio", ascending=False)
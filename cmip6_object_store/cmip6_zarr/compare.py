@@ -1,131 +1,518 @@
 """
 Code to compare that Zarr files (in Caringo) have the same content
 as the NetCDF files they came from.
+
+Every NetCDF file of a dataset is compared with the matching time steps of
+the Zarr store, in blocks of one Zarr chunk (or shard) along time. Blocks
+are compared concurrently by `verify_workers` threads or processes
+(`verify_pool`), with at most two blocks per worker in memory at once, and
+the comparison stops at the first difference.
+
+With `checksums`, the NetCDF files are not read: each block of the Zarr
+store is re-hashed and compared with the checksum manifest recorded when it
+was written (see checksums), which is itself checked against the digest in
+the results DB.
 """
 
-import glob
+import itertools
+import multiprocessing
 import random
+import threading
+import time
 import traceback
 import warnings
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 
+import numpy as np
 import xarray as xr
 
-from cmip6_object_store.cmip6_zarr.results_store import get_results_store, get_verification_store
+from cmip6_object_store.config import get_from_proj_or_workflow
+from cmip6_object_store.cmip6_zarr.archive_scanner import get_archive_scanner
+from cmip6_object_store.cmip6_zarr.checksums import hash_values, load_manifest
+from cmip6_object_store.cmip6_zarr.chunk_planner import TIME_DIM
+from cmip6_object_store.cmip6_zarr.results_store import (
+    get_checksum_store,
+    get_results_store,
+    get_verification_store,
+)
 
 from cmip6_object_store.cmip6_zarr.utils import (
-    get_archive_path,
+    get_read_store_map,
     get_var_id,
     read_zarr,
 )
 
+VERIFY_POOLS = ("thread", "process")
+
+MAX_OPEN_DATASETS = 8
+
+
+class _OpenDataset(object):
+    def __init__(self, ds):
+        self.ds = ds
+        self.n_users = 1
+        self.dropped = False
+
+
+class OpenDatasets(object):
+    """
+    Datasets opened by the verify workers of this process, most recently
+    used last, so that the blocks of a file are not each opened again.
+    Entries are keyed on the dataset being verified, and are dropped when
+    they are evicted or when the verification of that dataset ends. A
+    dropped dataset is closed once no worker is still using it.
+    """
+
+    def __init__(self, max_size=MAX_OPEN_DATASETS):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @contextmanager
+    def open(self, dataset_id, name, opener):
+        "Yields the dataset opened by `opener`, reusing it while it is cached."
+        key = (dataset_id, name)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry.n_users += 1
+
+        if entry is None:
+            entry = _OpenDataset(opener())
+
+            with self._lock:
+                # Another worker may have opened it at the same time
+                dropped = [self._entries.pop(key)] if key in self._entries else []
+                self._entries[key] = entry
+
+                while len(self._entries) > self._max_size:
+                    dropped.append(self._entries.popitem(last=False)[1])
+
+            self._drop(dropped)
+
+        try:
+            yield entry.ds
+        finally:
+            self._release(entry)
+
+    def _drop(self, entries):
+        with self._lock:
+            for entry in entries:
+                entry.dropped = True
+            unused = [entry for entry in entries if not entry.n_users]
+
+        for entry in unused:
+            entry.ds.close()
+
+    def _release(self, entry):
+        with self._lock:
+            entry.n_users -= 1
+            unused = entry.dropped and not entry.n_users
+
+        if unused:
+            entry.ds.close()
+
+    def clear(self, dataset_id=None):
+        "Drops the datasets opened to verify `dataset_id` (or all of them)."
+        with self._lock:
+            keys = [key for key in self._entries if dataset_id in (None, key[0])]
+            dropped = [self._entries.pop(key) for key in keys]
+
+        self._drop(dropped)
+
+
+_OPEN_DATASETS = OpenDatasets()
+
 
-def compare_zarrs_with_ncs(project, n_to_test=5, dataset_id=None):
+def stratified_sample(dataset_ids, n, facets, seed=None):
     """
-    Randomly selects some datasets and checks that the contents
-    of a NetCDF files in the archive matches that in a Zarr file
-    in the Caringo object store.
+    Returns up to `n` of `dataset_ids`, spread as evenly as possible across
+    strata: the groups of datasets with the same values of `facets`
+    (indices of the facets in the dataset ID). The strata, in random order,
+    take turns to give a dataset chosen at random until there are `n`.
+    """
+    rng = random.Random(seed)
+    strata = {}
+
+    for dataset_id in sorted(dataset_ids):
+        facet_values = dataset_id.split(".")
+        strata.setdefault(tuple(facet_values[i] for i in facets), []).append(dataset_id)
+
+    groups = list(strata.values())
+    rng.shuffle(groups)
+
+    for group in groups:
+        rng.shuffle(group)
+
+    interleaved = [
+        dataset_id
+        for row in itertools.zip_longest(*groups)
+        for dataset_id in row
+        if dataset_id is not None
+    ]
+    return interleaved[:n]
+
+
+def get_unverified(project, verification_store=None):
+    "Returns the IDs of the datasets converted but not yet verified."
+    verification_store = verification_store or get_verification_store(project)
+    converted = set(get_results_store(project).get_successful_runs())
+
+    return sorted(converted - set(verification_store.get_successful_runs()))
+
+
+def compare_zarrs_with_ncs(
+    project, n_to_test=5, dataset_id=None, checksums=False, n_workers=None, seed=None
+):
+    """
+    Selects a sample of the datasets not yet verified, stratified across
+    the `verify_strata` facets, and checks that the contents of the NetCDF
+    files in the archive match those of the Zarr files in the Caringo
+    object store. Datasets are verified concurrently by `n_workers` threads
+    (by default, `verify_dataset_workers`), which share the
+    `verify_workers` block workers between them, so that no more than that
+    many connections to the store are open at once.
 
     This logs its outputs for use elsewhere.
 
     If a dataset ID is passed in, this will check the specified single
     dataset ID instead of a random sample (and n_to_test is ignored)
-    """
-    tested = []
 
-    successes, failures = 0, 0
+    If `checksums` is True, the Zarr files are checked against the
+    checksums recorded when they were written instead.
 
+    Returns the number of datasets verified successfully and the number
+    verified.
+    """
+    verify = _verify_checksums if checksums else _compare_dataset
     verification_store = get_verification_store(project)
 
-    if dataset_id == None:
-        print(f"\nVerifying up to {n_to_test} datasets for: {project}...")
-        results_store = get_results_store(project)
-        dataset_ids = results_store.get_successful_runs()
-        force = False
+    if dataset_id is None:
+        unverified = get_unverified(project, verification_store)
+        facets = [int(facet) for facet in get_from_proj_or_workflow("verify_strata", project)]
+        sample = stratified_sample(unverified, n_to_test, facets, seed=seed)
+        print(
+            f"\nVerifying {len(sample)} of {len(unverified)} unverified datasets "
+            f"for: {project}..."
+        )
     else:
         print(f"\nComparing single dataset {dataset_id} for: {project}...")
-        n_to_test = 1
-        dataset_ids = [dataset_id]
-        force = True
-    
-    while len(tested) < n_to_test:
-        dataset_id = random.choice(dataset_ids)
-        if not force:
-            if dataset_id in tested or verification_store.ran_successfully(dataset_id):
-                continue
-
-        print(f"==========================\nVerifying: {dataset_id}")
-        try:
-            _compare_dataset(dataset_id, project)
-            verification_store.insert_success(dataset_id)
-            successes += 1
-            print(f"Comparison succeeded for: {dataset_id}")
-        except Exception as exc:
-            verification_store.insert_failure(dataset_id, f'failed: {exc}')
-            failures += 1
-            tb = traceback.format_exc()
-            print(f"FAILED comparison for {dataset_id}: traceback was\n\n: {tb}")
+        sample = [dataset_id]
 
-        tested.append(dataset_id)
+    n_workers = n_workers or get_from_proj_or_workflow("verify_dataset_workers", project)
+    n_block_workers = max(
+        1, get_from_proj_or_workflow("verify_workers", project) // n_workers
+    )
+    successes, n_blocks = 0, 0
+    start = time.perf_counter()
 
-    total = successes + failures
-    return (successes, total)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {}
 
+        for dataset_id in sample:
+            print(f"==========================\nVerifying: {dataset_id}")
+            futures[executor.submit(verify, dataset_id, project, n_block_workers)] = dataset_id
 
-def _get_nc_file(dataset_id, project):
-    archive_dir = get_archive_path(dataset_id, project)
+        # Results are recorded from this thread only
+        for future in as_completed(futures):
+            dataset_id = futures[future]
 
-    nc_files = glob.glob(f"{archive_dir}/*.nc")
-    if not nc_files:
-        return None
+            try:
+                n_blocks += future.result()
+                verification_store.insert_success(dataset_id)
+                successes += 1
+                print(f"Comparison succeeded for: {dataset_id}")
+            except Exception as exc:
+                verification_store.insert_failure(dataset_id, f'failed: {exc}')
+                tb = traceback.format_exc()
+                print(f"FAILED comparison for {dataset_id}: traceback was\n\n: {tb}")
 
-    return nc_files[0]
+    duration = time.perf_counter() - start
 
+    if sample:
+        print(
+            f"\nVerified {len(sample)} datasets ({n_blocks} blocks) in {duration:.1f} s: "
+            f"{len(sample) / duration * 3600:.1f} datasets/hour, "
+            f"{n_blocks / duration:.1f} blocks/s"
+        )
 
-def _compare_dataset(dataset_id, project):
-    nc_file = _get_nc_file(dataset_id, project)
-    if not nc_file:
-        return False
+    return (successes, len(sample))
 
-    print(f"\nWorking on: {dataset_id}")
+
+def _get_nc_files(dataset_id, project):
+    return get_archive_scanner(project).list_nc_files(dataset_id)
+
+
+def _open_nc(nc_file, **kwargs):
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        nc_subset = xr.open_dataset(nc_file)
+        return xr.open_dataset(nc_file, use_cftime=True, **kwargs)
+
+
+def _open_zarr(dataset_id, project):
+    # Without dask, so that only the chunks of each block are read
+    return read_zarr(dataset_id, project, use_cftime=True, chunks=None)
+
+
+def _values_equal(a, b):
+    if a.shape != b.shape:
+        return False
+
+    if a.dtype.kind in "fc":
+        return np.array_equal(a, b, equal_nan=True)
+
+    return np.array_equal(a, b)
+
+
+def iter_blocks(n_times, offset, block_length):
+    """
+    Yields (nc_slice, zarr_slice) pairs covering the `n_times` time steps of
+    a NetCDF file that starts at `offset` in the Zarr store, split wherever
+    a new block of `block_length` time steps starts in the store.
+    """
+    start = 0
+
+    while start < n_times:
+        zarr_start = offset + start
+        stop = min(n_times, (zarr_start // block_length + 1) * block_length - offset)
+
+        yield slice(start, stop), slice(zarr_start, offset + stop)
+        start = stop
+
+
+def compare_block(dataset_id, project, nc_file, names, nc_slice, zarr_slice):
+    """
+    Compares the variables `names` over time steps `nc_slice` of a NetCDF
+    file with time steps `zarr_slice` of the Zarr store. Returns a
+    description of the first difference, or None if there is none.
+    """
+    with _OPEN_DATASETS.open(dataset_id, nc_file, lambda: _open_nc(nc_file)) as nc_ds:
+        with _OPEN_DATASETS.open(
+            dataset_id, "zarr", lambda: _open_zarr(dataset_id, project)
+        ) as zarr_ds:
+            return _compare_variables(nc_ds, zarr_ds, nc_file, names, nc_slice, zarr_slice)
+
+
+def _compare_variables(nc_ds, zarr_ds, nc_file, names, nc_slice, zarr_slice):
+    for name in names:
+        zarr_var = zarr_ds[name].isel({TIME_DIM: zarr_slice})
+        nc_var = nc_ds[name]
+
+        if TIME_DIM in nc_var.dims:
+            nc_var = nc_var.isel({TIME_DIM: nc_slice})
+        else:
+            # Variables without a time axis may have been given one when
+            # the files were combined
+            nc_var = nc_var.expand_dims({TIME_DIM: zarr_var.sizes[TIME_DIM]})
+
+        nc_var = nc_var.transpose(*zarr_var.dims)
+
+        if not _values_equal(nc_var.values, zarr_var.values):
+            return (
+                f'"{name}" differs in time steps {nc_slice.start}-{nc_slice.stop} '
+                f"of {nc_file}"
+            )
+
+    return None
+
+
+def _get_executor(project, n_workers=None, pool_type=None):
+    n_workers = n_workers or get_from_proj_or_workflow("verify_workers", project)
+    pool_type = pool_type or get_from_proj_or_workflow("verify_pool", project)
 
-    zarr_ds = read_zarr(dataset_id, project)
-    zarr_subset = zarr_ds.sel(time=slice(nc_subset.time[0], nc_subset.time[-1]))
+    if pool_type not in VERIFY_POOLS:
+        raise ValueError(f"unsupported verify pool {pool_type}")
 
-    result = nc_subset.identical(zarr_subset)
+    if pool_type == "thread":
+        return ThreadPoolExecutor(max_workers=n_workers), n_workers
 
-    print(f"Testing: {dataset_id}")
-    print(f"\tResult: {result}")
+    executor = ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+    return executor, n_workers
 
+
+def _check_blocks(futures, message):
+    for future in futures:
+        difference = future.result()
+
+        if difference:
+            raise Exception(f"{message}: {difference}")
+
+
+def _run_blocks(dataset_id, project, func, tasks, message, n_workers=None, pool_type=None):
+    """
+    Runs `func(*task)` for each of `tasks` (of one dataset) in the verify
+    pool and raises an exception at the first that returns a difference.
+    Returns the number of tasks run. The datasets opened for the tasks are
+    closed when they are done.
+    """
+    executor, n_workers = _get_executor(project, n_workers, pool_type)
+    # At most two blocks per worker are in memory at once
+    max_pending = 2 * n_workers
+    pending, n_blocks = set(), 0
+
+    try:
+        for task in tasks:
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                _check_blocks(done, message)
+
+            pending.add(executor.submit(func, *task))
+            n_blocks += 1
+
+        _check_blocks(as_completed(pending), message)
+    finally:
+        executor.shutdown(cancel_futures=True)
+        _OPEN_DATASETS.clear(dataset_id)
+
+    return n_blocks
+
+
+def _compare_metadata(nc_ds, zarr_ds, var_id):
     for prop in ("data_vars", "coords"):
         a, b = [
             sorted(list(_.keys()))
-            for _ in (getattr(nc_subset, prop), getattr(zarr_subset, prop))
+            for _ in (getattr(nc_ds, prop), getattr(zarr_ds, prop))
         ]
         print(f'\nComparing "{prop}": {a} \n------------\n {b}')
         assert a == b
 
-    a, b = nc_subset.time.values, zarr_subset.time.values
-    assert list(a) == list(b)
-    print("Times are identical")
+    a_var, b_var = nc_ds[var_id], zarr_ds[var_id]
+
+    for attr in ("units", "long_name"):
+        a, b = getattr(a_var, attr), getattr(b_var, attr)
+        print(f"{attr}: {a} VS {b}")
+        assert a == b
+
+
+def _compare_dataset(dataset_id, project, n_workers=None, pool_type=None):
+    """
+    Compares every NetCDF file of the dataset with the Zarr store, block by
+    block, and raises an exception at the first difference. Returns the
+    number of blocks compared.
+    """
+    nc_files = _get_nc_files(dataset_id, project)
+    if not nc_files:
+        raise Exception(f"No NetCDF files found for: {dataset_id}")
 
+    print(f"\nWorking on: {dataset_id}")
     var_id = get_var_id(dataset_id, project=project)
-    a_var, b_var = nc_subset[var_id], zarr_subset[var_id]
+    zarr_ds = _open_zarr(dataset_id, project)
 
-    a_min, a_max = float(a_var.min()), float(a_var.max())
-    b_min, b_max = float(b_var.min()), float(b_var.max())
+    first_ds = _open_nc(nc_files[0])
+    _compare_metadata(first_ds, zarr_ds, var_id)
 
-    assert a_min == b_min
-    print("Minima are identical")
+    # Variables without a time axis in the store are only compared once
+    names = [name for name in first_ds.variables if TIME_DIM in zarr_ds[name].dims]
+    static_names = [name for name in first_ds.variables if name not in names]
 
-    assert a_max == b_max
-    print("Maxima are identical")
+    for name in static_names:
+        assert _values_equal(first_ds[name].values, zarr_ds[name].values), name
+    first_ds.close()
 
-    for attr in ("units", "long_name"):
-        a, b = getattr(a_var, attr), getattr(b_var, attr)
-        print(f"{attr}: {a} VS {b}")
-        assert a == b
+    if TIME_DIM not in zarr_ds[var_id].dims:
+        print("All values are identical")
+        return 1
+
+    # Blocks are whole Zarr chunks (or shards) along time
+    encoding = zarr_ds[var_id].encoding
+    block_shape = encoding.get("shards") or encoding["chunks"]
+    block_length = block_shape[zarr_ds[var_id].dims.index(TIME_DIM)]
+
+    offsets, n_times = [], 0
+
+    for nc_file in nc_files:
+        with _open_nc(nc_file, decode_times=False) as nc_ds:
+            offsets.append(n_times)
+            n_times += nc_ds.sizes[TIME_DIM]
 
-    return result
+    assert n_times == zarr_ds.sizes[TIME_DIM], "Number of time steps differs"
+
+    tasks = (
+        (dataset_id, project, nc_file, names, nc_slice, zarr_slice)
+        for nc_file, offset, n_file_times in zip(
+            nc_files, offsets, offsets[1:] + [n_times]
+        )
+        for nc_slice, zarr_slice in iter_blocks(n_file_times - offset, offset, block_length)
+    )
+
+    n_blocks = _run_blocks(
+        dataset_id,
+        project,
+        compare_block,
+        tasks,
+        "Zarr does not match NetCDF",
+        n_workers,
+        pool_type,
+    )
+
+    print(f"All values are identical in {n_blocks} blocks")
+    return n_blocks
+
+
+def _load_manifest(dataset_id, project):
+    return load_manifest(get_read_store_map(dataset_id, project))
+
+
+def check_block_hash(dataset_id, project, name, region, digest):
+    """
+    Hashes the values of variable `name` in `region` of the Zarr store.
+    Returns a description of the difference if the hash is not `digest`,
+    or None.
+    """
+    with _OPEN_DATASETS.open(
+        dataset_id, "zarr", lambda: _open_zarr(dataset_id, project)
+    ) as zarr_ds:
+        values = zarr_ds[name].isel(region).values
+
+    if hash_values(values) != digest:
+        extent = ", ".join(f"{dim} {item.start}-{item.stop}" for dim, item in region.items())
+        return f'"{name}" differs in {extent}'
+
+    return None
+
+
+def _verify_checksums(dataset_id, project, n_workers=None, pool_type=None):
+    """
+    Re-hashes every block of the Zarr store listed in its checksum manifest
+    and raises an exception at the first that differs. Returns the number
+    of blocks checked.
+    """
+    manifest = _load_manifest(dataset_id, project)
+    if manifest is None:
+        raise Exception(f"No checksum manifest found for: {dataset_id}")
+
+    recorded = get_checksum_store(project).get_result(dataset_id)
+    if recorded != manifest.digest():
+        raise Exception(f"Checksum manifest does not match the results DB for: {dataset_id}")
+
+    print(f"\nChecking {manifest.n_blocks} checksums of: {dataset_id}")
+
+    tasks = (
+        (dataset_id, project, name, region, digest)
+        for name, region, digest in manifest.iter_blocks()
+    )
+    n_blocks = _run_blocks(
+        dataset_id,
+        project,
+        check_block_hash,
+        tasks,
+        "Zarr does not match checksums",
+        n_workers,
+        pool_type,
+    )
+
+    print(f"All checksums match in {n_blocks} blocks")
+    return n_blocks
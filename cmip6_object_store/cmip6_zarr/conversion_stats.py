@@ -0,0 +1,112 @@
+"""
+Runtime and resource accounting for the conversion of a dataset: the time
+spent in each phase, the bytes read from the archive, the bytes and objects
+written to the store and the peak memory (RSS) of the process.
+
+The stats are stored as compact JSON in the stats table of the results
+backend, keyed on dataset ID, and summarised by the `stats` CLI command to
+help size `memory`, `max_duration` and the batch volume limits.
+"""
+
+import json
+import resource
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+PHASES = ("open", "plan", "write", "permissions", "finalise")
+
+MB = 2 ** 20
+
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS of this process, so that it can be measured per
+    dataset (Linux only; elsewhere the peak is for the life of the process).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as writer:
+            writer.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_rss_mb():
+    try:
+        with open("/proc/self/status") as reader:
+            for line in reader:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ConversionStats(object):
+    """
+    Accumulates the stats of converting one dataset. When datasets are
+    converted concurrently in threads, the peak RSS is that of the whole
+    process.
+    """
+
+    def __init__(self):
+        self.timings = dict.fromkeys(PHASES, 0.0)
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.objects_written = 0
+
+        self._start = time.time()
+        reset_peak_rss()
+
+    @contextmanager
+    def phase(self, name):
+        "Adds the time spent in the `with` block to the phase `name`."
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            self.timings[name] += time.time() - start
+
+    def to_dict(self, success):
+        stats = {"ok": int(success)}
+        stats.update({phase: round(duration, 2) for phase, duration in self.timings.items()})
+        stats.update(
+            {
+                "total": round(time.time() - self._start, 2),
+                "read_mb": round(self.bytes_read / MB, 1),
+                "written_mb": round(self.bytes_written / MB, 1),
+                "objects": self.objects_written,
+                "peak_rss_mb": round(get_peak_rss_mb(), 1),
+            }
+        )
+        return stats
+
+    def to_json(self, success):
+        return json.dumps(self.to_dict(success), separators=(",", ":"))
+
+
+def get_stats_table(stats_store):
+    "Returns a DataFrame of all the stats in the store, indexed on dataset ID."
+    records = {
+        dataset_id: json.loads(stats)
+        for dataset_id, stats in stats_store.get_all_results().items()
+    }
+
+    df = pd.DataFrame.from_dict(records, orient="index")
+    df.index.name = "dataset_id"
+    return df
+
+
+def summarise_stats(df):
+    """
+    Returns percentiles of each stat over the successful conversions, and
+    the throughput in MB read per second.
+    """
+    df = df[df["ok"] == 1].drop(columns="ok")
+    df = df.assign(read_mb_per_s=df["read_mb"] / df["total"].where(df["total"] > 0))
+
+    return df.describe(percentiles=[0.5, 0.9, 0.99]).T
@@ -0,0 +1,175 @@
+"""
+Compressor and filter settings for the variables written to Zarr.
+
+Codecs are given as a spec string: a chain of codecs joined by "+", each
+one a numcodecs codec ID followed by its arguments, e.g.
+
+    blosc,cname=zstd,clevel=5,shuffle=1
+    delta+zstd,level=3
+
+Filters (only lossless ones are allowed) come first and there can be at
+most one compressor. Filters are skipped for variables whose data type they
+do not apply to. "none" writes uncompressed data and "default" leaves
+the choice to zarr.
+
+The spec of each variable is taken from `variable_codecs` (a dictionary
+keyed on variable name) and otherwise from `codecs`, both of which can be
+set per project.
+"""
+
+import numcodecs
+import numcodecs.zarr3
+import numpy as np
+import zarr
+from zarr.abc.codec import ArrayArrayCodec
+from zarr.codecs import BloscCodec, GzipCodec, ZstdCodec
+
+from ..config import get_from_proj_or_workflow
+
+DEFAULT, NONE = "default", "none"
+
+LOSSLESS_FILTERS = ("delta", "shuffle")
+
+# The kinds of data type that each filter is applied to: delta is only
+# lossless for integers (and times are encoded by xarray itself)
+FILTER_KINDS = {"delta": "iu", "shuffle": "iuf"}
+
+BLOSC_SHUFFLES = {0: "noshuffle", 1: "shuffle", 2: "bitshuffle"}
+
+# Codecs that zarr implements natively for Zarr format 3
+_ZARR3_CODECS = {"blosc": BloscCodec, "zstd": ZstdCodec, "gzip": GzipCodec}
+
+_NUMCODECS_ZARR3 = {
+    codec.codec_name.split(".")[-1]: codec
+    for codec in vars(numcodecs.zarr3).values()
+    if isinstance(codec, type) and hasattr(codec, "codec_name")
+}
+
+
+def _parse_value(value):
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+
+    return value
+
+
+def parse_codec_spec(spec):
+    """
+    Parses a codec spec into a list of (codec ID, arguments) tuples, with
+    the filters first. Returns None for "default" and [] for "none".
+    """
+    spec = spec.strip().lower()
+
+    if spec == DEFAULT:
+        return None
+    if spec == NONE:
+        return []
+
+    codecs = []
+
+    for item in spec.split("+"):
+        codec_id, *args = item.split(",")
+        kwargs = dict(arg.split("=", 1) for arg in args)
+        codecs.append((codec_id, {key: _parse_value(value) for key, value in kwargs.items()}))
+
+    compressors = [codec_id for codec_id, _ in codecs if codec_id not in LOSSLESS_FILTERS]
+
+    if len(compressors) > 1:
+        raise ValueError(f"more than one compressor in codec spec: {spec}")
+    if compressors and codecs[-1][0] != compressors[0]:
+        raise ValueError(f"filters must come before the compressor in codec spec: {spec}")
+
+    for codec_id, _ in codecs:
+        if codec_id not in LOSSLESS_FILTERS + tuple(numcodecs.registry.codec_registry):
+            raise ValueError(f"unknown codec {codec_id} in codec spec: {spec}")
+
+    return codecs
+
+
+def _fill_dtype_args(codec_id, kwargs, dtype):
+    "Adds the arguments of filters that depend on the data type."
+    kwargs = dict(kwargs)
+
+    if codec_id == "delta":
+        kwargs.setdefault("dtype", dtype.str)
+    elif codec_id == "shuffle":
+        kwargs.setdefault("elementsize", dtype.itemsize)
+
+    return kwargs
+
+
+def _to_zarr3_codec(codec_id, kwargs):
+    if codec_id == "blosc" and "shuffle" in kwargs:
+        kwargs = dict(kwargs)
+        shuffle = kwargs.pop("shuffle")
+
+        # Other values (AUTOSHUFFLE) leave the choice to the codec
+        if shuffle in BLOSC_SHUFFLES:
+            kwargs["shuffle"] = BLOSC_SHUFFLES[shuffle]
+
+    if codec_id in _ZARR3_CODECS:
+        return _ZARR3_CODECS[codec_id](**kwargs)
+
+    return _NUMCODECS_ZARR3[codec_id](**kwargs)
+
+
+def get_codecs(spec, dtype, zarr_format=None):
+    """
+    Returns the Zarr encoding of a codec spec for data of type `dtype`, as
+    a dictionary of "filters" and "compressors", or None for "default".
+    """
+    codecs = parse_codec_spec(spec)
+    if codecs is None:
+        return None
+
+    zarr_format = zarr_format or zarr.config.get("default_zarr_format")
+    dtype = np.dtype(dtype)
+
+    filters, compressors = [], []
+
+    for codec_id, kwargs in codecs:
+        if codec_id in LOSSLESS_FILTERS and dtype.kind not in FILTER_KINDS[codec_id]:
+            continue
+
+        kwargs = _fill_dtype_args(codec_id, kwargs, dtype)
+
+        if zarr_format == 2:
+            codec = numcodecs.get_codec({"id": codec_id, **kwargs})
+            is_filter = codec_id in LOSSLESS_FILTERS
+        else:
+            # Zarr format 3 applies byte-level codecs (including shuffle)
+            # after the array is serialised, so they go with the compressor
+            codec = _to_zarr3_codec(codec_id, kwargs)
+            is_filter = isinstance(codec, ArrayArrayCodec)
+
+        (filters if is_filter else compressors).append(codec)
+
+    return {"filters": filters or None, "compressors": compressors or None}
+
+
+def get_variable_spec(name, project):
+    "Returns the codec spec of variable `name` in the project."
+    variable_codecs = get_from_proj_or_workflow("variable_codecs", project)
+    return variable_codecs.get(name, get_from_proj_or_workflow("codecs", project))
+
+
+def apply_codecs(ds, project, zarr_format=None):
+    """
+    Returns a copy of `ds` with the codecs configured for each variable set
+    in its encoding, alongside the encoding read from the NetCDF files (such
+    as the time units) and the chunk shape. Variables using the zarr default
+    are left as they are. The Zarr format defaults to `zarr_format`.
+    """
+    zarr_format = zarr_format or get_from_proj_or_workflow("zarr_format", project)
+    ds = ds.copy()
+
+    for name, variable in ds.variables.items():
+        codecs = get_codecs(get_variable_spec(name, project), variable.dtype, zarr_format)
+
+        if codecs is not None:
+            variable.encoding.update(codecs)
+
+    return ds
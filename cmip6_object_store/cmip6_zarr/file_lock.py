@@ -0,0 +1,86 @@
+"""
+Lock file that can be shared by processes on different hosts.
+
+The lock is taken by creating the lock file exclusively, which (unlike
+fcntl/flock locks) also works on shared filesystems such as GPFS and NFS.
+A lock file left behind by a process that died is broken once it is older
+than `stale_after` seconds.
+"""
+
+import os
+import socket
+import time
+
+from .. import logging
+
+LOGGER = logging.getLogger(__file__)
+
+
+class FileLock(object):
+    def __init__(self, path, timeout=10, stale_after=600, poll_interval=0.1):
+        """
+        :param path: (str) Path of the lock file
+        :param timeout: (float) Seconds to wait for the lock before giving up
+        :param stale_after: (float) Age (in seconds) after which an existing
+            lock file is assumed to be abandoned
+        """
+        self._path = path
+        self._timeout = timeout
+        self._stale_after = stale_after
+        self._poll_interval = poll_interval
+
+        self.state = "UNLOCKED"
+
+    def _try_create(self):
+        try:
+            fd = os.open(self._path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        with os.fdopen(fd, "w") as writer:
+            writer.write(f"{socket.gethostname()}:{os.getpid()}\n")
+
+        return True
+
+    def _break_if_stale(self):
+        try:
+            age = time.time() - os.path.getmtime(self._path)
+        except FileNotFoundError:
+            return
+
+        if age > self._stale_after:
+            LOGGER.warning(f"Breaking stale lock ({age:.0f} seconds old): {self._path}")
+
+            try:
+                os.remove(self._path)
+            except FileNotFoundError:
+                pass
+
+    def acquire(self):
+        start = time.time()
+
+        while not self._try_create():
+            self._break_if_stale()
+
+            if time.time() - start > self._timeout:
+                raise Exception(f"Could not obtain file lock on {self._path}")
+
+            time.sleep(self._poll_interval)
+
+        self.state = "LOCKED"
+
+    def release(self):
+        if self.state == "LOCKED":
+            try:
+                os.remove(self._path)
+            except FileNotFoundError:
+                pass
+
+        self.state = "UNLOCKED"
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
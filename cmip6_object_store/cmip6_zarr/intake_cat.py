@@ -1,3 +1,15 @@
+"""
+Creation of the intake-esm catalogue (a JSON description and a CSV file
+with a row per dataset) of the Zarr files converted so far.
+
+By default the CSV catalogue is updated incrementally: as the row of a
+dataset depends only on its (versioned) dataset ID, rows are only made for
+the datasets converted successfully that are not yet in the catalogue, and
+the rows of those no longer converted are dropped, so the archive directory
+is only listed for the new datasets. With `full`, the catalogue is rebuilt
+from scratch.
+"""
+
 import os
 from functools import wraps
 from time import time
@@ -13,6 +25,7 @@ from cmip6_object_store.cmip6_zarr.utils import (
     read_zarr,
 )
 
+from cmip6_object_store.cmip6_zarr.archive_scanner import get_archive_scanner
 from cmip6_object_store.cmip6_zarr.results_store import get_results_store
 
 
@@ -31,13 +44,35 @@ def timer(f):
     return wrap
 
 
+HEADERS = [
+    "mip_era",
+    "activity_id",
+    "institution_id",
+    "source_id",
+    "experiment_id",
+    "member_id",
+    "table_id",
+    "variable_id",
+    "grid_label",
+    "version",
+    "dcpp_start_year",
+    "time_range",
+    "zarr_path",
+    "nc_path",
+]
+
+# Columns that make up the dataset ID
+N_FACET_COLUMNS = 10
+
+
 class IntakeCatalogue:
-    def __init__(self, project, limit=None):
+    def __init__(self, project, limit=None, full=False):
         self._iconf = CONFIG["intake"]
         self._project = project
         self._results_store = get_results_store(self._project)
         self._limit = limit
-        
+        self._full = full
+
     def create(self):
         self._create_json()
         self._create_csv()
@@ -67,51 +102,77 @@ class IntakeCatalogue:
     def _create_csv(self):
 
         csv_catalog = self._iconf["csv_catalog"].format(project=self._project)
+        dataset_ids = self._results_store.get_successful_runs()
+        previous_df = None if self._full else self._read_previous(csv_catalog)
 
-        # if os.path.isfile(csv_catalog):
-        #     raise FileExistsError(f'File already exists: {csv_catalog}')
+        if previous_df is None:
+            print(f"{len(dataset_ids)} datasets")
+            zarr_cat_as_df = self._get_zarr_df(list(dataset_ids)[: self._limit])
+        else:
+            zarr_cat_as_df = self._update_zarr_df(previous_df, dataset_ids)
 
-        # Read in Zarr catalogue
-        zarr_cat_as_df = self._get_zarr_df()
-        zarr_cat_as_df.to_csv(csv_catalog, index=False)
+        tmp_catalog = f"{csv_catalog}.tmp"
+        zarr_cat_as_df.to_csv(tmp_catalog, index=False)
+        os.replace(tmp_catalog, csv_catalog)
 
         LOGGER.info(
             f"Wrote {len(zarr_cat_as_df)} records to CSV catalog file:\n {csv_catalog}"
         )
 
+    def _read_previous(self, csv_catalog):
+        """
+        Returns the previous CSV catalogue as a DataFrame, or None if there is
+        none or it has other columns.
+        """
+        if not os.path.isfile(csv_catalog):
+            return None
+
+        df = pd.read_csv(csv_catalog, dtype=str, keep_default_na=False)
+
+        if list(df.columns) != HEADERS:
+            LOGGER.warning("CSV catalog has other columns, rebuilding it")
+            return None
+
+        return df
+
     @timer
-    def _get_zarr_df(self):
-        # Read in Zarr results store and convert to DataFrame, and return
-        dataset_ids = self._results_store.get_successful_runs()
-        print(f"{len(dataset_ids)} datasets")
-
-        headers = [
-            "mip_era",
-            "activity_id",
-            "institution_id",
-            "source_id",
-            "experiment_id",
-            "member_id",
-            "table_id",
-            "variable_id",
-            "grid_label",
-            "version",
-            "dcpp_start_year",
-            "time_range",
-            "zarr_path",
-            "nc_path",
-        ]
+    def _update_zarr_df(self, previous_df, dataset_ids):
+        """
+        Returns the previous catalogue without the datasets that are no
+        longer successful and with rows for the successful `dataset_ids`
+        that it does not have yet, up to the limit on the number of rows.
+        """
+        facets = previous_df.iloc[:, :N_FACET_COLUMNS].itertuples(index=False)
+        previous_ids = pd.Series([".".join(row) for row in facets], dtype=object)
+        dataset_ids = set(dataset_ids)
+
+        keep = previous_ids.isin(dataset_ids).to_numpy()
+        new_ids = sorted(dataset_ids - set(previous_ids))
+        print(
+            f"{len(dataset_ids)} datasets: {len(new_ids)} new and "
+            f"{(~keep).sum()} removed"
+        )
 
-        rows = []
+        kept_df = previous_df[keep]
 
-        for row, dataset_id in enumerate(dataset_ids):
+        if self._limit is not None:
+            kept_df = kept_df[: self._limit]
+            new_ids = new_ids[: self._limit - len(kept_df)]
 
-            if self._limit is not None and row == self._limit:
-                break
+        return pd.concat([kept_df, self._get_zarr_df(new_ids)], ignore_index=True)
+
+    @timer
+    def _get_zarr_df(self, dataset_ids):
+        "Returns the catalogue rows of `dataset_ids` as a DataFrame."
+        # The archive directories are listed in parallel up front
+        nc_files = get_archive_scanner(self._project).scan(dataset_ids)
+        rows = []
+
+        for dataset_id in dataset_ids:
 
             items = dataset_id.split(".")
             dcpp_start_year = self._get_dcpp_start_year(dataset_id)
-            temporal_range = self._get_temporal_range(dataset_id)
+            temporal_range = self._get_temporal_range(dataset_id, nc_files[dataset_id])
 
             zarr_url = get_zarr_url(dataset_id, self._project)
             nc_path = get_archive_path(dataset_id, self._project) + "/*.nc"
@@ -119,7 +180,7 @@ class IntakeCatalogue:
             items.extend([dcpp_start_year, temporal_range, zarr_url, nc_path])
             rows.append(items[:])
 
-        return pd.DataFrame(rows, columns=headers)
+        return pd.DataFrame(rows, columns=HEADERS)
 
     def _get_dcpp_start_year(self, dataset_id):
         member_id = dataset_id.split(".")[5]
@@ -129,14 +190,11 @@ class IntakeCatalogue:
 
         return member_id.split("-")[0][1:]
 
-    def _get_temporal_range(self, dataset_id):
+    def _get_temporal_range(self, dataset_id, nc_files):
+        "Returns the time range of the dataset, from the names of its NetCDF files."
         try:
-            nc_files = os.listdir(get_archive_path(dataset_id, self._project))
-            nc_files = [
-                fn for fn in nc_files if not fn.startswith(".") and fn.endswith(".nc")
-            ]
-
-            time_ranges = [fn.split(".")[-2].split("_")[-1].split("-") for fn in nc_files]
+            file_names = [os.path.basename(nc_file) for nc_file in nc_files]
+            time_ranges = [fn.split(".")[-2].split("_")[-1].split("-") for fn in file_names]
             start = f"{min(int(tr[0]) for tr in time_ranges)}"
             if len(start) == 4:
                 start += "01"
@@ -161,8 +219,8 @@ class IntakeCatalogue:
         return time_range
 
 
-def create_intake_catalogue(project, limit=None):
-    cat = IntakeCatalogue(project, limit=limit)
+def create_intake_catalogue(project, limit=None, full=False):
+    cat = IntakeCatalogue(project, limit=limit, full=full)
     cat.create()
 
 
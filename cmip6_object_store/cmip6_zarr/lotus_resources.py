@@ -0,0 +1,188 @@
+"""
+Estimates of the memory and walltime that each batch needs on LOTUS, so
+that batches can be submitted in separate job arrays per resource class
+instead of all asking for the global `memory` and `max_duration`.
+
+ - Walltime is the runtime predicted for the batch by the runtime model
+   (see batch_planner), times `runtime_safety_factor`.
+ - Memory is modelled per dataset as a base amount plus a multiple of the
+   data in flight: `write_workers` chunks of (at most) `chunk_size` MB, or
+   shards of `shard_size` MB if sharded, for each of the `dataset_workers`
+   datasets converted at once. The model is fitted to the peak memory
+   recorded in the conversion stats, once there are enough of them, and
+   multiplied by `memory_safety_factor`.
+
+Each batch is then given the smallest of the `memory_classes` and
+`duration_classes` that fits.
+"""
+
+import math
+
+import numpy as np
+
+from .. import logging
+from ..config import CONFIG, get_from_proj_or_workflow
+from .batch_planner import RuntimeModel, duration_to_seconds
+from .conversion_stats import get_stats_table
+from .results_store import get_stats_store
+
+LOGGER = logging.getLogger(__file__)
+
+# Minimum number of conversion stats needed to fit the memory model
+MIN_STATS = 10
+
+MEMORY_UNITS = {"M": 1, "G": 2 ** 10, "T": 2 ** 20}
+
+
+def memory_to_mb(memory):
+    "Converts a SLURM memory request such as '16G' to MB."
+    return float(memory[:-1]) * MEMORY_UNITS[memory[-1].upper()]
+
+
+def seconds_to_duration(seconds):
+    "Converts seconds to a duration given as 'hh:mm:ss'."
+    seconds = int(math.ceil(seconds))
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class MemoryModel(object):
+    "Predicts the peak memory (in MB) of converting a dataset."
+
+    def __init__(self, base_mb, per_chunk_mb):
+        self.base_mb = base_mb
+        self.per_chunk_mb = per_chunk_mb
+
+    @staticmethod
+    def _in_flight_mb(size_mb, project):
+        "Returns the MB of each dataset held in memory at once while writing."
+        # Whole shards are written at once, if sharded
+        chunk_size = get_from_proj_or_workflow(
+            "shard_size", project
+        ) or get_from_proj_or_workflow("chunk_size", project)
+        write_workers = get_from_proj_or_workflow("write_workers", project)
+
+        return np.minimum(size_mb, chunk_size) * write_workers
+
+    @classmethod
+    def for_project(cls, project):
+        """
+        Returns the model fitted to the peak memory recorded in the
+        conversion stats of the project, or the default model (from
+        config.ini) if there are too few of them.
+        """
+        default = cls(
+            CONFIG["workflow"]["base_memory"], CONFIG["workflow"]["memory_per_chunk"]
+        )
+
+        try:
+            stats = get_stats_table(get_stats_store(project))
+        except Exception as exc:
+            LOGGER.warning(
+                f"Could not read conversion stats ({exc}), using default memory model"
+            )
+            return default
+
+        if stats.empty or (stats["ok"] == 1).sum() < MIN_STATS:
+            return default
+
+        stats = stats[stats["ok"] == 1]
+        X = np.column_stack(
+            [np.ones(len(stats)), cls._in_flight_mb(stats["read_mb"].to_numpy(), project)]
+        )
+        coefficients, _, rank, _ = np.linalg.lstsq(
+            X, stats["peak_rss_mb"].to_numpy(dtype=float), rcond=None
+        )
+
+        # The data in flight is the same for all datasets larger than a
+        # chunk, so cannot be told apart from the base memory if those are
+        # all there is
+        if rank < X.shape[1]:
+            LOGGER.warning(
+                f"Data in flight does not vary across the {len(stats)} conversions, "
+                "using default memory model"
+            )
+            return default
+
+        base_mb, per_chunk_mb = coefficients.clip(min=0)
+
+        LOGGER.info(
+            f"Fitted memory model to {len(stats)} conversions: base {base_mb:.0f} MB, "
+            f"{per_chunk_mb:.2f} x data in flight"
+        )
+        return cls(base_mb, per_chunk_mb)
+
+    def predict(self, size_mb, project):
+        return self.base_mb + self.per_chunk_mb * self._in_flight_mb(size_mb, project)
+
+
+def _smallest_fitting(classes, value, to_number):
+    "Returns the smallest of `classes` that is at least `value`, or the largest."
+    for resource_class in sorted(classes, key=to_number):
+        if to_number(resource_class) >= value:
+            return resource_class
+
+    return max(classes, key=to_number)
+
+
+def estimate_batch_resources(batch_rows, project):
+    """
+    Returns the (memory, duration) resource class for each batch in the
+    batch table rows `batch_rows`, as a dictionary keyed on batch number.
+    Returns an empty dictionary if the rows do not have the dataset sizes.
+    """
+    if "size_mb" not in batch_rows:
+        return {}
+
+    if "predicted_runtime" not in batch_rows:
+        batch_rows = batch_rows.assign(
+            predicted_runtime=RuntimeModel.for_project(project).predict(batch_rows)
+        )
+
+    workflow = CONFIG["workflow"]
+    memory_classes = workflow["memory_classes"]
+    duration_classes = workflow["duration_classes"]
+
+    memory_model = MemoryModel.for_project(project)
+    dataset_workers = get_from_proj_or_workflow("dataset_workers", project)
+
+    rows = batch_rows.assign(
+        memory_mb=memory_model.predict(batch_rows["size_mb"].to_numpy(), project)
+    )
+    by_batch = rows.groupby(level="batch")
+
+    # The largest datasets are assumed to be converted at the same time
+    memory_mb = by_batch["memory_mb"].apply(
+        lambda memory: memory.nlargest(dataset_workers).sum()
+    ) * workflow["memory_safety_factor"]
+    runtime = by_batch["predicted_runtime"].sum() * workflow["runtime_safety_factor"]
+
+    resources = {}
+
+    for batch in memory_mb.index:
+        memory = _smallest_fitting(memory_classes, memory_mb[batch], memory_to_mb)
+        duration = _smallest_fitting(
+            duration_classes, runtime[batch], duration_to_seconds
+        )
+
+        if (
+            memory_to_mb(memory) < memory_mb[batch]
+            or duration_to_seconds(duration) < runtime[batch]
+        ):
+            LOGGER.warning(
+                f"Batch {batch} may need more than the largest resource class: "
+                f"{memory_mb[batch]:.0f} MB for {seconds_to_duration(runtime[batch])}"
+            )
+
+        resources[int(batch)] = (memory, duration)
+
+    return resources
+
+
+def group_batches_by_resources(resources):
+    "Returns the sorted batch numbers of each (memory, duration) class."
+    groups = {}
+
+    for batch, resource_class in sorted(resources.items()):
+        groups.setdefault(resource_class, []).append(batch)
+
+    return groups
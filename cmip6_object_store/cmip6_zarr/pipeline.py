@@ -0,0 +1,242 @@
+"""
+Pipelined writing of a chunked dataset to Zarr, so that reading from disk,
+encoding (and compressing) and uploading to the object store overlap
+instead of happening in lockstep for each chunk:
+
+ - reader threads load one Zarr chunk of a variable at a time from the
+   (lazily opened) dataset
+ - a process pool encodes each chunk into the bytes of its Zarr object(s),
+   by writing it to an in-memory store that holds only the metadata
+ - a thread pool uploads the encoded objects to the store
+
+Back-pressure keeps memory bounded: a reader must take one of
+`max_chunks` slots before loading a chunk, and the slot is only given back
+once the chunk has been uploaded (or has failed), so no more than
+`max_chunks` chunks are held in memory by the pipeline at once.
+"""
+
+import itertools
+import multiprocessing
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import fsspec
+import xarray as xr
+import zarr
+
+from .. import logging
+from .retry_policy import with_retries
+
+LOGGER = logging.getLogger(__file__)
+
+METADATA_NAMES = (".zgroup", ".zattrs", ".zarray", ".zmetadata", "zarr.json")
+
+# In-memory stores holding the metadata of the datasets being encoded by
+# this (encoder) process, keyed on write ID, most recently used last
+_ENCODER_STORES = OrderedDict()
+MAX_ENCODER_STORES = 4
+
+
+def _is_metadata(key):
+    return key.split("/")[-1] in METADATA_NAMES
+
+
+def iter_chunk_regions(variable):
+    "Yields the region ({dim: slice}) of each dask chunk of `variable`."
+    starts = [list(itertools.accumulate((0,) + chunks[:-1])) for chunks in variable.chunks]
+
+    for index in itertools.product(*[range(len(chunks)) for chunks in variable.chunks]):
+        yield {
+            dim: slice(starts[i][j], starts[i][j] + variable.chunks[i][j])
+            for i, (dim, j) in enumerate(zip(variable.dims, index))
+        }
+
+
+def _get_encoder_store(write_id, metadata):
+    if write_id in _ENCODER_STORES:
+        _ENCODER_STORES.move_to_end(write_id)
+        return _ENCODER_STORES[write_id]
+
+    if len(_ENCODER_STORES) >= MAX_ENCODER_STORES:
+        _, old_store = _ENCODER_STORES.popitem(last=False)
+        old_store.clear()
+
+    store = fsspec.get_mapper(f"memory://encoder/{write_id}")
+    store.update(metadata)
+    _ENCODER_STORES[write_id] = store
+    return store
+
+
+def encode_chunk(write_id, metadata, name, variable, region):
+    """
+    Encodes a chunk of a variable (loaded in memory) into Zarr objects, and
+    returns them as {key: bytes}. The chunk is written with xarray to an
+    in-memory store holding only the metadata of the dataset, so it is
+    encoded exactly as a region write to the object store would be.
+    """
+    store = _get_encoder_store(write_id, metadata)
+
+    xr.Dataset({name: variable}).to_zarr(
+        store, mode="r+", region=region, consolidated=False
+    )
+
+    return {key: store.pop(key) for key in list(store) if key not in metadata}
+
+
+@with_retries()
+def _upload(store_map, chunks):
+    for key, data in chunks.items():
+        store_map[key] = data
+
+
+class ChunkPipeline(object):
+    def __init__(self, n_readers=2, n_encoders=4, n_uploaders=16, max_chunks=8):
+        """
+        :param n_readers: (int) Number of threads reading chunks
+        :param n_encoders: (int) Number of processes encoding chunks
+        :param n_uploaders: (int) Number of threads uploading chunks
+        :param max_chunks: (int) Max number of chunks in the pipeline at once
+        """
+        self._n_readers = n_readers
+        self._n_encoders = n_encoders
+        self._max_chunks = max_chunks
+
+        # The encoder pool is started on first use, and may be shared by
+        # writes from several threads
+        self._encoders = None
+        self._encoders_lock = threading.Lock()
+        self._uploaders = ThreadPoolExecutor(max_workers=n_uploaders)
+
+    def _get_encoders(self):
+        with self._encoders_lock:
+            if self._encoders is None:
+                self._encoders = ProcessPoolExecutor(
+                    max_workers=self._n_encoders,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+
+            return self._encoders
+
+    def _drop_encoders(self, encoders):
+        """
+        Shuts down a broken encoder pool, so that the next write starts a new
+        one (unless another write has already replaced it).
+        """
+        with self._encoders_lock:
+            if self._encoders is encoders:
+                self._encoders = None
+
+        encoders.shutdown(cancel_futures=True)
+
+    def close(self):
+        with self._encoders_lock:
+            encoders, self._encoders = self._encoders, None
+
+        if encoders is not None:
+            encoders.shutdown()
+
+        self._uploaders.shutdown()
+
+    def write(self, ds, store_map, zarr_format=None, checksums=None):
+        """
+        Writes the chunked dataset `ds` to `store_map`. The metadata and the
+        variables that are not dask arrays are written first, and then every
+        chunk of the dask arrays (a whole shard, if the arrays are sharded)
+        is passed through the pipeline. If a checksum manifest is given, the
+        readers add the hash of each chunk to it.
+        """
+        ds.to_zarr(
+            store=store_map,
+            mode="w",
+            consolidated=False,
+            compute=False,
+            zarr_format=zarr_format,
+        )
+
+        metadata = {key: store_map[key] for key in store_map if _is_metadata(key)}
+        write_id = uuid.uuid4().hex
+
+        tasks = (
+            (name, region)
+            for name, variable in ds.variables.items()
+            if variable.chunks is not None
+            for region in iter_chunk_regions(variable)
+        )
+
+        encoders = self._get_encoders()
+        tasks_lock = threading.Lock()
+        slots = threading.BoundedSemaphore(self._max_chunks)
+        errors = []
+
+        def fail(exc):
+            errors.append(exc)
+            slots.release()
+
+        def on_uploaded(future):
+            if future.exception():
+                return fail(future.exception())
+            slots.release()
+
+        def on_encoded(future):
+            if future.exception():
+                return fail(future.exception())
+
+            chunks = future.result()
+            if not chunks:
+                return slots.release()
+
+            self._uploaders.submit(_upload, store_map, chunks).add_done_callback(
+                on_uploaded
+            )
+
+        def read():
+            while not errors:
+                with tasks_lock:
+                    task = next(tasks, None)
+
+                if task is None:
+                    return
+
+                name, region = task
+                slots.acquire()
+
+                try:
+                    variable = (
+                        ds.variables[name].isel(region).load(scheduler="synchronous")
+                    )
+                    if checksums is not None:
+                        checksums.add_values(name, variable.dims, region, variable.values)
+
+                    # The encoding (including codecs, which cannot always be
+                    # pickled) is read from the metadata by the encoder
+                    variable.encoding = {}
+                    future = encoders.submit(
+                        encode_chunk, write_id, metadata, name, variable, region
+                    )
+                except Exception as exc:
+                    return fail(exc)
+
+                future.add_done_callback(on_encoded)
+
+        readers = [threading.Thread(target=read) for _ in range(self._n_readers)]
+
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+
+        # Wait for every chunk still in the pipeline
+        for _ in range(self._max_chunks):
+            slots.acquire()
+        for _ in range(self._max_chunks):
+            slots.release()
+
+        if errors:
+            if isinstance(errors[0], BrokenProcessPool):
+                self._drop_encoders(encoders)
+            raise errors[0]
+
+        zarr.consolidate_metadata(store_map)
@@ -1,12 +1,23 @@
+import glob
+import json
 import os
+import socket
+import threading
+from contextlib import closing
 
+import psycopg2
 from abcunit_backend.database_handler import DataBaseHandler
+from psycopg2.extras import execute_values
 
 from .. import logging
 from ..config import CONFIG, get_from_proj_or_workflow
+from .sqlite_handler import SQLiteHandler
 
 LOGGER = logging.getLogger(__file__)
 
+SUCCESS = "success"
+RESULTS_BACKENDS = ("abcunit", "sqlite")
+
 
 def _setup_env(project):
 
@@ -23,16 +34,320 @@ def _setup_env(project):
                  '(warning - may contain secrets - comment out this line in production')
     
     os.environ[varname] = value
+    return value
 
 
-    
-def get_results_store(project):
+# abcunit creates tables whose results are up to 255 characters long
+ABCUNIT_MAX_RESULT_LENGTH = 255
+
+
+class AbcunitHandler(DataBaseHandler):
+    """
+    DataBaseHandler that can also insert and look up many results in one
+    query, on the database given by `db_settings`.
+    """
+
+    def __init__(self, db_settings, table_name):
+        self._db_settings = db_settings
+        super().__init__(table_name=table_name)
+
+    def _connect(self):
+        return closing(psycopg2.connect(self._db_settings))
+
+    def bulk_insert(self, records):
+        """
+        Inserts or replaces all of the (identifier, result) `records` in a
+        single transaction.
+        """
+        values = [
+            (identifier, result[:ABCUNIT_MAX_RESULT_LENGTH]) for identifier, result in records
+        ]
+        query = (
+            f"INSERT INTO {self.table_name} (id, result) VALUES %s "
+            "ON CONFLICT (id) DO UPDATE SET result = EXCLUDED.result;"
+        )
+
+        with self._connect() as conn:
+            with conn, conn.cursor() as cur:
+                execute_values(cur, query, values)
+
+    def get_successes(self, identifiers):
+        "Returns which of `identifiers` ran successfully, in one query."
+        query = f"SELECT id FROM {self.table_name} WHERE result=%s AND id = ANY(%s);"
+
+        with self._connect() as conn:
+            with conn, conn.cursor() as cur:
+                cur.execute(query, (SUCCESS, list(identifiers)))
+                return [row[0] for row in cur]
+
+
+def _get_abcunit_handler(project, table_name):
+
+    return AbcunitHandler(_setup_env(project), table_name)
+
+
+def _get_sqlite_handler(project, table_name):
+
+    db_file = get_from_proj_or_workflow('sqlite_results_file', project)
+    if not db_file:
+        raise ValueError('sqlite_results_file must be set to use the sqlite results backend')
+
+    return SQLiteHandler(db_file.format(project=project), table_name=table_name)
+
+
+def _get_handler(project, table_name, backend=None):
+
+    backend = backend or get_from_proj_or_workflow('results_backend', project)
+
+    if backend == 'abcunit':
+        return _get_abcunit_handler(project, table_name)
+    elif backend == 'sqlite':
+        return _get_sqlite_handler(project, table_name)
+    else:
+        raise ValueError(f'unsupported results backend {backend}')
+
+
+def get_results_store(project, backend=None):
+
+    return _get_handler(project, f'{project}_zarr_records', backend=backend)
+
+
+def get_verification_store(project, backend=None):
+
+    return _get_handler(project, f'{project}_zarr_verify_records', backend=backend)
+
+
+def get_stats_store(project, backend=None):
+
+    return _get_handler(project, f'{project}_zarr_stats', backend=backend)
+
+
+def get_checksum_store(project, backend=None):
+
+    return _get_handler(project, f'{project}_zarr_checksums', backend=backend)
+
+
+def sync_results(project):
+    """
+    Pushes all results (conversion, verification, stats and checksums)
+    recorded in the local SQLite database for the project to the central
+    abcunit database. Returns the number of results pushed.
+    """
+    n_results = 0
+
+    for get_store in (
+        get_results_store,
+        get_verification_store,
+        get_stats_store,
+        get_checksum_store,
+    ):
+        local_store = get_store(project, backend='sqlite')
+        records = list(local_store.get_all_results().items())
+
+        if records:
+            bulk_insert(get_store(project, backend='abcunit'), records)
+            n_results += len(records)
+
+        LOGGER.info(f'Pushed {len(records)} results from {local_store.table_name}')
+
+    return n_results
+
+
+def bulk_insert(results_store, records):
+    """
+    Writes all of the (identifier, result) `records` to the results store,
+    where a result is either "success" or an error message.
+    """
+    if hasattr(results_store, "bulk_insert"):
+        return results_store.bulk_insert(records)
+
+    for identifier, result in records:
+        if result == SUCCESS:
+            results_store.insert_success(identifier)
+        else:
+            results_store.insert_failure(identifier, result)
+
+
+class BufferedResultsStore(object):
+    """
+    Wraps a results store so that ZarrWriter does not make several database
+    round trips per dataset:
+
+     - which of the dataset IDs of a batch were successful is loaded in one
+       query and checked in memory by `ran_successfully` (any other ID is
+       looked up on its own, the first time it is checked)
+     - results are buffered and written in bulk every `flush_size` results
+       (and on `flush`, which ZarrWriter calls after every success)
+     - if the database cannot be reached, buffered results are appended to a
+       local file in the log directory, and replayed into the database the
+       next time a BufferedResultsStore is created for the project.
+
+    Other methods are passed through to the wrapped results store. The
+    buffer is locked, so a BufferedResultsStore can be shared by threads.
+    """
+
+    def __init__(self, results_store, project, flush_size=None, fallback_name="pending_results"):
+        self._store = results_store
+        self._project = project
+        self._flush_size = flush_size or get_from_proj_or_workflow(
+            "results_flush_size", project
+        )
+
+        self._lock = threading.RLock()
+        self._pending = {}
+        # Successes among the IDs whose results have been loaded
+        self._successes = set()
+        self._loaded = set()
+
+        self._fallback_dir = os.path.join(
+            CONFIG["log"]["log_base_dir"], project, fallback_name
+        )
+        self._replay_fallback()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._store, name)
+
+    def _get_successes(self, dataset_ids):
+        if hasattr(self._store, "get_successes"):
+            return set(self._store.get_successes(dataset_ids))
+
+        return {ds_id for ds_id in dataset_ids if self._store.ran_successfully(ds_id)}
+
+    def preload(self, dataset_ids):
+        "Loads which of `dataset_ids` were successful, in one query."
+        dataset_ids = set(dataset_ids)
+        successes = self._get_successes(dataset_ids)
+
+        with self._lock:
+            self._successes -= dataset_ids
+            self._successes |= successes
+            self._loaded |= dataset_ids
+
+        LOGGER.info(f"Preloaded {len(successes)} successful results")
+
+    def ran_successfully(self, identifier):
+        with self._lock:
+            if identifier in self._pending:
+                return self._pending[identifier] == SUCCESS
+            loaded = identifier in self._loaded
+
+        if not loaded:
+            self.preload([identifier])
+
+        with self._lock:
+            return identifier in self._successes
+
+    def delete_result(self, identifier):
+        "Deletes the result straight away, along with any buffered one."
+        with self._lock:
+            self._pending.pop(identifier, None)
+            self._successes.discard(identifier)
+            self._loaded.add(identifier)
+
+        try:
+            self._store.delete_result(identifier)
+        except Exception as exc:
+            LOGGER.warning(f"Could not delete result for {identifier}: {exc}")
+
+    def insert_success(self, identifier):
+        self._insert(identifier, SUCCESS)
+
+    def insert_failure(self, identifier, error_type="failure"):
+        self._insert(identifier, error_type)
+
+    def insert_result(self, identifier, result):
+        self._insert(identifier, result)
+
+    def _insert(self, identifier, result):
+        with self._lock:
+            self._pending[identifier] = result
+            self._loaded.add(identifier)
+
+            if result == SUCCESS:
+                self._successes.add(identifier)
+            else:
+                self._successes.discard(identifier)
+
+            should_flush = len(self._pending) >= self._flush_size
+
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        "Writes all buffered results to the results store."
+        with self._lock:
+            records = list(self._pending.items())
+            self._pending.clear()
+
+        if not records:
+            return
+
+        try:
+            bulk_insert(self._store, records)
+            LOGGER.info(f"Wrote {len(records)} results")
+        except Exception as exc:
+            LOGGER.error(f"Could not write results ({exc}), saving them locally")
+            self._write_fallback(records)
+
+    def _get_fallback_file(self):
+        name = f"{socket.gethostname()}_{os.getpid()}.jsonl"
+        return os.path.join(self._fallback_dir, name)
+
+    def _write_fallback(self, records):
+        if not os.path.isdir(self._fallback_dir):
+            os.makedirs(self._fallback_dir, exist_ok=True)
+
+        fallback_file = self._get_fallback_file()
+
+        with open(fallback_file, "a") as writer:
+            for identifier, result in records:
+                writer.write(json.dumps([identifier, result]) + "\n")
+            writer.flush()
+            os.fsync(writer.fileno())
+
+        LOGGER.warning(f"Saved {len(records)} results to: {fallback_file}")
+
+    def _replay_fallback(self):
+        """
+        Writes results saved locally by earlier runs to the results store.
+        Each file is renamed before it is read so that only one process
+        replays it.
+        """
+        for fallback_file in sorted(glob.glob(f"{self._fallback_dir}/*.jsonl")):
+            claimed_file = f"{fallback_file}.replay.{os.getpid()}"
+
+            try:
+                os.rename(fallback_file, claimed_file)
+            except OSError:
+                continue
+
+            with open(claimed_file) as reader:
+                records = [json.loads(line) for line in reader if line.strip()]
+
+            try:
+                bulk_insert(self._store, records)
+            except Exception as exc:
+                LOGGER.error(f"Could not replay results from {fallback_file}: {exc}")
+                os.rename(claimed_file, fallback_file)
+                return
+
+            os.remove(claimed_file)
+            LOGGER.info(f"Replayed {len(records)} results from: {fallback_file}")
+
+
+def get_buffered_results_store(project):
+    return BufferedResultsStore(get_results_store(project), project)
 
-    _setup_env(project)
-    return DataBaseHandler(table_name=f'{project}_zarr_records')
 
+def get_buffered_stats_store(project):
+    return BufferedResultsStore(
+        get_stats_store(project), project, fallback_name="pending_stats"
+    )
 
-def get_verification_store(project):
 
-    _setup_env(project)
-    return DataBaseHandler(table_name=f'{project}_zarr_verify_records')
+def get_buffered_checksum_store(project):
+    return BufferedResultsStore(
+        get_checksum_store(project), project, fallback_name="pending_checksums"
+    )
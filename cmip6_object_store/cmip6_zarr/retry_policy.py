@@ -0,0 +1,274 @@
+"""
+Retry policy for object store operations.
+
+Errors are classified before deciding whether to retry, by their S3 error
+code if it is known and otherwise by their HTTP status:
+
+ - "fatal": retrying cannot help (e.g. access denied, no such bucket), so
+            the error is raised straight away.
+ - "throttle": the store asked us to slow down (e.g. 503 SlowDown), so the
+            backoff starts from a longer delay.
+ - "transient": anything else (connection errors, timeouts, 500s).
+
+Retries use exponential backoff with "full jitter" (a random delay between
+zero and the exponential cap), so that many array jobs failing at the same
+moment do not retry in lockstep.
+
+The number of calls, retries and failures and the time spent in each
+operation are recorded in RETRY_STATS, which can be logged or written to a
+JSON file to help tune the `retries` and `retry_*` settings in config.ini.
+"""
+
+import asyncio
+import errno
+import json
+import random
+import threading
+import time
+from functools import wraps
+
+from botocore.exceptions import ClientError
+
+from .. import logging
+from ..config import CONFIG
+
+LOGGER = logging.getLogger(__file__)
+
+FATAL, THROTTLE, TRANSIENT = "fatal", "throttle", "transient"
+
+FATAL_CODES = {
+    "AccessDenied",
+    "AllAccessDisabled",
+    "InvalidAccessKeyId",
+    "InvalidBucketName",
+    "MethodNotAllowed",
+    "NoSuchBucket",
+    "NoSuchKey",
+    "NoSuchBucketPolicy",
+    "SignatureDoesNotMatch",
+}
+THROTTLE_CODES = {
+    "RequestLimitExceeded",
+    "ServiceUnavailable",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequests",
+}
+# Sent with statuses that are otherwise fatal (e.g. 400 RequestTimeout)
+TRANSIENT_CODES = {
+    "InternalError",
+    "OperationAborted",
+    "RequestTimeout",
+    "RequestTimeoutException",
+}
+FATAL_STATUS_CODES = {400, 403, 404, 405}
+THROTTLE_STATUS_CODES = {429, 503}
+
+# Python exceptions that s3fs translates fatal S3 errors into
+FATAL_EXCEPTIONS = (
+    PermissionError,
+    FileNotFoundError,
+    FileExistsError,
+    NotADirectoryError,
+    IsADirectoryError,
+)
+
+
+def _classify_client_error(exc):
+    code = exc.response.get("Error", {}).get("Code")
+    status = exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+
+    if code in THROTTLE_CODES:
+        return THROTTLE
+    if code in FATAL_CODES:
+        return FATAL
+    if code in TRANSIENT_CODES:
+        return TRANSIENT
+
+    if status in THROTTLE_STATUS_CODES:
+        return THROTTLE
+    if status in FATAL_STATUS_CODES:
+        return FATAL
+    return TRANSIENT
+
+
+def classify_error(exc):
+    """
+    Returns FATAL, THROTTLE or TRANSIENT for the exception, looking through
+    the chain of exceptions that caused it.
+    """
+    seen = set()
+
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+
+        if isinstance(exc, ClientError):
+            return _classify_client_error(exc)
+        if isinstance(exc, FATAL_EXCEPTIONS):
+            return FATAL
+        # s3fs raises OSError(EBUSY) for SlowDown and ServiceUnavailable
+        if isinstance(exc, OSError) and exc.errno == errno.EBUSY:
+            return THROTTLE
+
+        exc = exc.__cause__ or exc.__context__
+
+    return TRANSIENT
+
+
+class RetryStats(object):
+    "Thread-safe counts and timings of store operations, by operation name."
+
+    FIELDS = ("calls", "retries", "throttled", "failures", "total_time", "max_time")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _get(self, operation):
+        return self._stats.setdefault(operation, dict.fromkeys(self.FIELDS, 0))
+
+    def record_retry(self, operation, error_class):
+        with self._lock:
+            stats = self._get(operation)
+            stats["retries"] += 1
+            if error_class == THROTTLE:
+                stats["throttled"] += 1
+
+    def record_call(self, operation, duration, failed=False):
+        with self._lock:
+            stats = self._get(operation)
+            stats["calls"] += 1
+            stats["total_time"] += duration
+            stats["max_time"] = max(stats["max_time"], duration)
+            if failed:
+                stats["failures"] += 1
+
+    def report(self):
+        "Returns a copy of the stats, with the mean time per call added."
+        with self._lock:
+            report = {}
+
+            for operation, stats in sorted(self._stats.items()):
+                report[operation] = dict(stats)
+                report[operation]["mean_time"] = (
+                    stats["total_time"] / stats["calls"] if stats["calls"] else 0
+                )
+
+            return report
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def log_summary(self):
+        for operation, stats in self.report().items():
+            LOGGER.info(
+                f"Store operation {operation}: {stats['calls']} calls, "
+                f"{stats['retries']} retries ({stats['throttled']} throttled), "
+                f"{stats['failures']} failures, "
+                f"mean {stats['mean_time']:.3f}s, max {stats['max_time']:.3f}s"
+            )
+
+    def write(self, path):
+        with open(path, "w") as writer:
+            json.dump(self.report(), writer, indent=4)
+
+
+RETRY_STATS = RetryStats()
+
+
+class RetryPolicy(object):
+    def __init__(self, tries=None, base_delay=None, max_delay=None, throttle_factor=4):
+        workflow = CONFIG["workflow"]
+
+        self.tries = tries or workflow["retries"]
+        self.base_delay = base_delay or workflow["retry_base_delay"]
+        self.max_delay = max_delay or workflow["retry_max_delay"]
+        self.throttle_factor = throttle_factor
+
+    def get_delay(self, attempt, error_class):
+        "Returns the (jittered) delay before retry number `attempt`."
+        base_delay = self.base_delay
+
+        if error_class == THROTTLE:
+            base_delay *= self.throttle_factor
+
+        cap = min(self.max_delay, base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, cap)
+
+    def _should_retry(self, operation, exc, attempt):
+        error_class = classify_error(exc)
+
+        if error_class == FATAL or attempt == self.tries:
+            return None
+
+        delay = self.get_delay(attempt, error_class)
+        RETRY_STATS.record_retry(operation, error_class)
+        LOGGER.warning(
+            f"{operation} failed ({error_class}): {exc}, "
+            f"retrying in {delay:.1f} seconds..."
+        )
+        return delay
+
+    def call(self, operation, func, *args, **kwargs):
+        start = time.time()
+
+        for attempt in range(1, self.tries + 1):
+            try:
+                result = func(*args, **kwargs)
+            except Exception as exc:
+                delay = self._should_retry(operation, exc, attempt)
+                if delay is None:
+                    RETRY_STATS.record_call(operation, time.time() - start, failed=True)
+                    raise
+
+                time.sleep(delay)
+            else:
+                RETRY_STATS.record_call(operation, time.time() - start)
+                return result
+
+    async def call_async(self, operation, func, *args, **kwargs):
+        start = time.time()
+
+        for attempt in range(1, self.tries + 1):
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as exc:
+                delay = self._should_retry(operation, exc, attempt)
+                if delay is None:
+                    RETRY_STATS.record_call(operation, time.time() - start, failed=True)
+                    raise
+
+                await asyncio.sleep(delay)
+            else:
+                RETRY_STATS.record_call(operation, time.time() - start)
+                return result
+
+
+def with_retries(policy=None):
+    "Decorates a function so that it is called according to the retry policy."
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return (policy or RetryPolicy()).call(func.__name__, func, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def with_async_retries(policy=None):
+    "Coroutine equivalent of `with_retries`."
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await (policy or RetryPolicy()).call_async(
+                func.__name__, func, *args, **kwargs
+            )
+
+        return wrapper
+
+    return decorator
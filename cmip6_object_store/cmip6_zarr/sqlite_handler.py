@@ -0,0 +1,178 @@
+"""
+Results store backed by a local SQLite database, with the same interface as
+the abcunit DataBaseHandler, so that runs do not need a network database.
+
+The database is opened in WAL mode so that readers do not block the writer,
+and the table is indexed on the dataset ID (primary key) and on the status
+of each result: "success", or the type of error (see `get_status`). Each
+result also records when it was last updated.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from abcunit_backend.base_handler import BaseHandler
+
+SUCCESS = "success"
+FAILURE = "failure"
+
+
+def get_status(result):
+    """
+    Returns the status of a result: "success", or the type of error, which is
+    the first line of the error message up to any colon (e.g. "Failed to
+    write to Zarr").
+    """
+    if result == SUCCESS:
+        return SUCCESS
+
+    lines = result.strip().splitlines()
+    status = lines[0].split(":")[0].strip() if lines else ""
+    return status or FAILURE
+
+
+class SQLiteHandler(BaseHandler):
+
+    _max_result_length = 255
+    _max_query_ids = 500
+
+    def __init__(self, db_file, table_name="results"):
+        """
+        :param db_file: (str) Path to the SQLite database file
+        :param table_name: (str) Name of the table results are inserted into
+        """
+        db_dir = os.path.dirname(db_file)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+
+        self.db_file = db_file
+        self.table_name = table_name
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        self._create_table()
+
+    def _create_table(self):
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table_name} "
+                "(id TEXT PRIMARY KEY, result TEXT NOT NULL, "
+                "status TEXT NOT NULL, updated REAL NOT NULL);"
+            )
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table_name}_status "
+                f"ON {self.table_name} (status);"
+            )
+
+    def _query(self, query, params=()):
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    def _write(self, query, params_list):
+        with self._lock, self._conn:
+            self._conn.executemany(query, params_list)
+
+    def get_result(self, identifier):
+        rows = self._query(
+            f"SELECT result FROM {self.table_name} WHERE id=?;", (identifier,)
+        )
+        return rows[0][0] if rows else None
+
+    def get_all_results(self):
+        return dict(self._query(f"SELECT id, result FROM {self.table_name};"))
+
+    def get_successful_runs(self, since=None):
+        """
+        :param since: (float) Optional time stamp, to only return those that
+            succeeded after it
+        """
+        query = f"SELECT id FROM {self.table_name} WHERE status=?"
+        params = (SUCCESS,)
+
+        if since is not None:
+            query += " AND updated>?"
+            params += (since,)
+
+        return [row[0] for row in self._query(query + ";", params)]
+
+    def get_successes(self, identifiers):
+        "Returns which of `identifiers` ran successfully."
+        identifiers = list(identifiers)
+        successes = []
+
+        # Stay within SQLite's limit on the number of query parameters
+        for start in range(0, len(identifiers), self._max_query_ids):
+            batch = identifiers[start : start + self._max_query_ids]
+            placeholders = ", ".join("?" * len(batch))
+
+            rows = self._query(
+                f"SELECT id FROM {self.table_name} "
+                f"WHERE status=? AND id IN ({placeholders});",
+                (SUCCESS, *batch),
+            )
+            successes.extend(row[0] for row in rows)
+
+        return successes
+
+    def get_failed_runs(self):
+        """
+        :return: (dict) Dictionary of job identifiers mapped to their errors
+        """
+        return dict(
+            self._query(
+                f"SELECT id, result FROM {self.table_name} WHERE status<>?;", (SUCCESS,)
+            )
+        )
+
+    def delete_result(self, identifier):
+        self._write(f"DELETE FROM {self.table_name} WHERE id=?;", [(identifier,)])
+
+    def delete_all_results(self):
+        self._write(f"DELETE FROM {self.table_name};", [()])
+
+    def ran_successfully(self, identifier):
+        return self.get_result(identifier) == SUCCESS
+
+    def _count(self, where="", params=()):
+        return self._query(f"SELECT COUNT(*) FROM {self.table_name} {where};", params)[0][0]
+
+    def count_results(self):
+        return self._count()
+
+    def count_successes(self):
+        return self._count("WHERE status=?", (SUCCESS,))
+
+    def count_failures(self):
+        return self._count("WHERE status<>?", (SUCCESS,))
+
+    def insert_success(self, identifier):
+        self.bulk_insert([(identifier, SUCCESS)])
+
+    def insert_failure(self, identifier, error_type=FAILURE):
+        self.bulk_insert([(identifier, error_type)])
+
+    def bulk_insert(self, records):
+        """
+        Inserts or replaces all of the (identifier, result) `records` in a
+        single transaction.
+        """
+        now = time.time()
+        params_list = [
+            (
+                identifier,
+                result[: self._max_result_length],
+                get_status(result)[: self._max_result_length],
+                now,
+            )
+            for identifier, result in records
+        ]
+
+        self._write(
+            f"INSERT OR REPLACE INTO {self.table_name} "
+            "(id, result, status, updated) VALUES (?, ?, ?, ?);",
+            params_list,
+        )
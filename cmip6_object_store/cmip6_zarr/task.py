@@ -1,34 +1,215 @@
+import multiprocessing
 import os
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 from .. import logging
-from ..config import CONFIG
+from ..config import CONFIG, get_from_proj_or_workflow
 from .batch import BatchManager
+from .batch_planner import duration_to_seconds, write_runtime
 from .lotus import Lotus
+from .lotus_resources import estimate_batch_resources, group_batches_by_resources
+from .retry_policy import RETRY_STATS
 from .utils import create_dir
+from .work_queue import get_work_queue, get_worker_id
 from .zarr_writer import ZarrWriter
 
 LOGGER = logging.getLogger(__file__)
 
+DATASET_POOLS = ("thread", "process")
+SCHEDULING_MODES = ("static", "queue")
+
+# ZarrWriter belonging to each process in a dataset process pool
+_WORKER_WRITER = None
+
+
+def _init_worker(writer_class, batch, project, dataset_ids):
+    global _WORKER_WRITER
+    _WORKER_WRITER = writer_class(batch, project)
+    _WORKER_WRITER.preload_results(dataset_ids)
+
+
+def _convert_in_worker(dataset_id):
+    # Pool processes are not told when they are shut down, so write the
+    # result straight away
+    try:
+        _WORKER_WRITER.convert(dataset_id)
+    finally:
+        _WORKER_WRITER.flush_results()
+
 
 class ConversionTask(object):
     def __init__(self, batch_number, project):
         self._batch_number = batch_number
         self._project = project
 
-    #    @profile(precision=1)
     def run(self):
         batch = self._batch_number
         LOGGER.info(f"Running conversion locally: {batch}")
+        start = time.time()
 
         batch_manager = BatchManager(self._project)
         dataset_ids = batch_manager.get_batch(batch)
-        zarr_writer = ZarrWriter(batch, self._project)
 
-        for dataset_id in dataset_ids:
-            zarr_writer.convert(dataset_id)
+        n_workers = get_from_proj_or_workflow("dataset_workers", self._project)
+        pool_type = get_from_proj_or_workflow("dataset_pool", self._project)
+
+        if pool_type not in DATASET_POOLS:
+            raise ValueError(f"unsupported dataset pool {pool_type}")
+
+        if n_workers > 1 and len(dataset_ids) > 1:
+            self._run_pool(dataset_ids, pool_type, n_workers)
+        else:
+            zarr_writer = ZarrWriter(batch, self._project)
+            zarr_writer.preload_results(dataset_ids)
+
+            try:
+                for dataset_id in dataset_ids:
+                    zarr_writer.convert(dataset_id)
+            finally:
+                zarr_writer.close()
 
         LOGGER.info(f"{len(dataset_ids)} datasets processed in batch {batch}")
+        self._write_retry_stats()
+
+        totals = batch_manager.get_batch_totals(batch)
+        if totals:
+            write_runtime(self._project, batch, time.time() - start, totals)
+
+    def _write_retry_stats(self):
+        """
+        Logs the retry counts and timings of store operations in this
+        process, and writes them to the log directory for the project.
+        """
+        RETRY_STATS.log_summary()
+
+        stats_dir = os.path.join(
+            CONFIG["log"]["log_base_dir"], self._project, "retry_stats"
+        )
+        create_dir(stats_dir)
+        RETRY_STATS.write(os.path.join(stats_dir, f"batch_{self._batch_number:04d}.json"))
+
+    def _run_pool(self, dataset_ids, pool_type, n_workers):
+        """
+        Converts the datasets of the batch concurrently in a pool of
+        `n_workers` threads or processes. Each dataset still records its own
+        success or failure; anything that escapes `ZarrWriter.convert`
+        (including a worker process dying) is recorded as a failure here,
+        through the buffered results of this process's ZarrWriter.
+
+        Threads share a single ZarrWriter, which passes the write scheduler
+        to each computation and locks its result buffers; each process has
+        its own.
+        """
+        batch = self._batch_number
+        LOGGER.info(f"Converting with a {pool_type} pool of {n_workers} workers")
+
+        zarr_writer = ZarrWriter(batch, self._project)
+
+        if pool_type == "thread":
+            zarr_writer.preload_results(dataset_ids)
+            executor = ThreadPoolExecutor(max_workers=n_workers)
+            convert = zarr_writer.convert
+        else:
+            executor = ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(ZarrWriter, batch, self._project, dataset_ids),
+            )
+            convert = _convert_in_worker
+
+        try:
+            with executor:
+                futures = {
+                    executor.submit(convert, dataset_id): dataset_id
+                    for dataset_id in dataset_ids
+                }
+
+                for future in as_completed(futures):
+                    dataset_id = futures[future]
+
+                    try:
+                        future.result()
+                    except Exception:
+                        error = f"Conversion aborted for: {dataset_id}:\n{traceback.format_exc()}"
+                        zarr_writer.insert_failure(dataset_id, error)
+                        LOGGER.error(f"FAILED TO COMPLETE FOR: {dataset_id}\n{error}")
+        finally:
+            zarr_writer.close()
+
+
+
+class QueueWorker(object):
+    """
+    Converts datasets claimed from the project's work queue, until there are
+    none left to claim. Leases are renewed in the background while the
+    datasets are converted.
+    """
+
+    def __init__(self, project, worker_id=None):
+        self._project = project
+        self._worker_id = worker_id or get_worker_id()
+        self._queue = get_work_queue(project)
+
+        self._claimed = []
+        self._stop = threading.Event()
 
+    def _renew_leases(self):
+        while not self._stop.wait(self._queue.lease_time / 3):
+            try:
+                self._queue.renew(self._worker_id, list(self._claimed))
+            except Exception as exc:
+                LOGGER.warning(f"Failed to renew leases: {exc}")
+
+    def run(self):
+        LOGGER.info(f"Starting queue worker: {self._worker_id}")
+        claim_size = get_from_proj_or_workflow("queue_claim_size", self._project)
+
+        renewer = threading.Thread(target=self._renew_leases, daemon=True)
+        renewer.start()
+
+        zarr_writer = ZarrWriter(None, self._project)
+        n_converted = 0
+
+        try:
+            while True:
+                self._claimed = self._queue.claim(self._worker_id, claim_size)
+                if not self._claimed:
+                    break
+
+                for dataset_id in self._claimed:
+                    try:
+                        zarr_writer.convert(dataset_id)
+                    except Exception:
+                        error = f"Conversion aborted for: {dataset_id}:\n{traceback.format_exc()}"
+                        zarr_writer.insert_failure(dataset_id, error)
+                        LOGGER.error(f"FAILED TO COMPLETE FOR: {dataset_id}\n{error}")
+
+                    zarr_writer.flush_results()
+                    if not self._queue.complete(
+                        self._worker_id,
+                        dataset_id,
+                        success=zarr_writer.ran_successfully(dataset_id),
+                    ):
+                        LOGGER.warning(f"Lease on {dataset_id} was lost before completion")
+                    n_converted += 1
+        finally:
+            self._stop.set()
+            self._queue.release(self._worker_id)
+            zarr_writer.close()
+
+        LOGGER.info(
+            f"Queue worker {self._worker_id} processed {n_converted} datasets, "
+            f"queue is now: {self._queue.counts()}"
+        )
+        RETRY_STATS.log_summary()
+
+
+def _run_queue_worker(project):
+    QueueWorker(project).run()
 
 
 class TaskManager(object):
@@ -39,6 +220,8 @@ class TaskManager(object):
         datasets=None,
         run_mode="lotus",
         ignore_complete=True,
+        scheduling="static",
+        n_workers=None,
     ):
 
         self._project = project
@@ -46,16 +229,19 @@ class TaskManager(object):
         self._datasets = datasets
         self._run_mode = run_mode
 
+        if scheduling not in SCHEDULING_MODES:
+            raise ValueError(f"unsupported scheduling mode {scheduling}")
+
+        self._scheduling = scheduling
+        self._n_workers = n_workers or get_from_proj_or_workflow("queue_workers", project)
+
         self._ignore_complete = ignore_complete
         self._batch_manager = BatchManager(project)
         self._setup()
 
     def _setup(self):
         
-        allowed_batch_numbers = [
-            self._batch_manager.batch_file_to_batch_number(batch_file_path)
-            for batch_file_path in self._batch_manager.get_batch_files()
-        ]
+        allowed_batch_numbers = self._batch_manager.get_batch_numbers()
 
         # Overwrite batch
         if self._datasets:
@@ -80,19 +266,9 @@ class TaskManager(object):
         """Works out which batches relate to those in self._datasets.
         Overwrites the value of self._batches accordingly.
         """
-        batches = []
-        datasets = set(self._datasets)
-
-        for batch_file_path in self._batch_manager.get_batch_files():
-            datasets_in_batch = set(open(batch_file_path).read().strip().split())
-
-            if datasets & datasets_in_batch:
-                batch_number = self._batch_manager.batch_file_to_batch_number(
-                    batch_file_path
-                )
-                batches.append(batch_number)
-
-        self._batches = sorted(batches)
+        self._batches = self._batch_manager.get_batches_for_datasets(
+            self._datasets
+        )
 
     def _filter_datasets(self):
         base_dir = CONFIG["log"]["log_base_dir"]
@@ -111,7 +287,10 @@ class TaskManager(object):
             LOGGER.warn("Nothing to run!")
             return
 
-        if self._run_mode == 'local':
+        if self._scheduling == "queue":
+            self._run_queue()
+
+        elif self._run_mode == 'local':
             for batch in self._batches:
                 task = ConversionTask(batch, project=self._project)
                 task.run()
@@ -124,6 +303,53 @@ class TaskManager(object):
             raise ValueError(f"unsupported run mode {self._run_mode}")
             
             
+    def _fill_queue(self):
+        """
+        Adds the datasets of the selected batches (or just the selected
+        datasets) to the work queue.
+        """
+        dataset_ids = self._batch_manager.get_datasets_in_batches(self._batches)
+
+        if self._datasets:
+            selected = set(self._datasets)
+            dataset_ids = [ds_id for ds_id in dataset_ids if ds_id in selected]
+
+        queue = get_work_queue(self._project)
+        n_added = queue.add(dataset_ids)
+
+        LOGGER.info(f"Queued {n_added} datasets, queue is now: {queue.counts()}")
+
+    def _run_queue(self):
+        self._fill_queue()
+        n_workers = self._n_workers
+
+        if self._run_mode == "local":
+            LOGGER.info(f"Running {n_workers} local queue workers")
+
+            with ProcessPoolExecutor(
+                max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                futures = [
+                    executor.submit(_run_queue_worker, self._project)
+                    for _ in range(n_workers)
+                ]
+
+                for future in as_completed(futures):
+                    future.result()
+
+            LOGGER.info(f"Queue is now: {get_work_queue(self._project).counts()}")
+
+        elif self._run_mode == "lotus":
+            LOGGER.info(f"Submitting {n_workers} queue workers to Lotus")
+            cmd = (
+                f"./cmip6_object_store/cmip6_zarr/cli.py "
+                f"run --queue-worker -p {self._project}"
+            )
+            self._submit_lotus(cmd, f"1-{n_workers}")
+
+        else:
+            raise ValueError(f"unsupported run mode {self._run_mode}")
+
     def _run_tasks_lotus(self, batches):
 
         #batch_spec = ",".join(batches)
@@ -131,14 +357,45 @@ class TaskManager(object):
 
         LOGGER.debug(f"Raw batch list: " f"{batches}")
         LOGGER.info(f"Submitting conversion to Lotus: " f"{batch_spec}")
+        self._log_predicted_runtimes(batches)
         cmd = (
             f"./cmip6_object_store/cmip6_zarr/cli.py "
             f"run --slurm-array-member -r local "
             f"-p {self._project}"
         )
 
-        duration = CONFIG["workflow"]["max_duration"]
-        memory = CONFIG["workflow"]["memory"]
+        if CONFIG["workflow"]["adaptive_resources"]:
+            resources = estimate_batch_resources(
+                self._batch_manager.get_batch_rows(batches), self._project
+            )
+
+            if resources:
+                groups = group_batches_by_resources(resources)
+
+                for (memory, duration), group in groups.items():
+                    LOGGER.info(
+                        f"Submitting {len(group)} batches with {memory} memory "
+                        f"for {duration}"
+                    )
+                    self._submit_lotus(
+                        cmd,
+                        self._get_short_batch_spec(group),
+                        memory=memory,
+                        duration=duration,
+                    )
+                return
+
+            LOGGER.warning("Cannot estimate batch resources, using the defaults")
+
+        self._submit_lotus(cmd, batch_spec)
+
+    def _submit_lotus(self, cmd, array_spec, memory=None, duration=None):
+        """
+        Submits `cmd` to Lotus as a job array of the members in `array_spec`,
+        with the default `memory` and `duration` unless given.
+        """
+        duration = duration or CONFIG["workflow"]["max_duration"]
+        memory = memory or CONFIG["workflow"]["memory"]
         job_limit = CONFIG["workflow"]["job_limit"]
         lotus_log_dir = os.path.join(
             CONFIG["log"]["log_base_dir"], self._project, "lotus"
@@ -149,7 +406,7 @@ class TaskManager(object):
         stderr = f"{lotus_log_dir}/%A_%a.err"
 
         partition = CONFIG["workflow"]["job_queue"]
-        array = f"{batch_spec}%{job_limit}"
+        array = f"{array_spec}%{job_limit}"
 
         lotus = Lotus()
         lotus.run(
@@ -163,6 +420,29 @@ class TaskManager(object):
         )
 
 
+    def _log_predicted_runtimes(self, batches):
+        """
+        Logs the predicted runtime of the batches being submitted, warning
+        about any that are predicted to take longer than `max_duration`.
+        """
+        runtimes = self._batch_manager.get_predicted_runtimes(batches)
+        if not runtimes:
+            return
+
+        max_duration = duration_to_seconds(CONFIG["workflow"]["max_duration"])
+        LOGGER.info(
+            f"Predicted runtime of longest batch: {max(runtimes.values()) / 3600:.2f} hours"
+        )
+
+        for batch, runtime in runtimes.items():
+            LOGGER.debug(f"Predicted runtime of batch {batch}: {runtime / 3600:.2f} hours")
+
+            if runtime > max_duration:
+                LOGGER.warning(
+                    f"Batch {batch} is predicted to take {runtime / 3600:.2f} hours, "
+                    f"more than the max duration of {CONFIG['workflow']['max_duration']}"
+                )
+
     def _get_short_batch_spec(self, batches):
         """
         turn a list of batch numbers into a comma separated string such as 4-6,8,10
@@ -6,7 +6,10 @@ import s3fs
 import xarray as xr
 
 from ..config import CONFIG, get_from_proj_or_workflow
+from .caringo_store import get_filesystem
 
+# Credentials already read, by file path
+_CREDENTIALS = {}
 
 
 def get_credentials(creds_file=None):
@@ -14,10 +17,11 @@ def get_credentials(creds_file=None):
     if not creds_file:
         creds_file = CONFIG["store"]["credentials_file"]
 
-    with open(creds_file) as f:
-        creds = json.load(f)
+    if creds_file not in _CREDENTIALS:
+        with open(creds_file) as f:
+            _CREDENTIALS[creds_file] = json.load(f)
 
-    return creds
+    return _CREDENTIALS[creds_file]
 
 
 def get_uuid():
@@ -76,16 +80,28 @@ def get_zarr_path(dataset_id, project, join=False):
         return (bucket, zarr_file)
 
 
-def read_zarr(path, project, **kwargs):
+def open_zarr_store(store, **kwargs):
+    """
+    Opens a Zarr store, in Zarr format 2 or 3 (including sharded arrays), as
+    an Xarray dataset. Consolidated metadata is used if the store has it,
+    as it is not part of the Zarr format 3 specification.
+    """
+    kwargs.setdefault("consolidated", None)
+    return xr.open_zarr(store=store, **kwargs)
+
+
+def get_read_store_map(path, project):
+    "Returns an anonymous, read-only mapping of the Zarr store of a dataset."
     dataset_id = to_dataset_id(path, project)
     zarr_path = get_zarr_path(dataset_id, project, join=True)
-    endpoint_url = CONFIG["store"]["endpoint_url"]
-    jasmin_s3 = s3fs.S3FileSystem(
-        anon=True, client_kwargs={"endpoint_url": endpoint_url}
-    )
+    jasmin_s3 = get_filesystem(anon=True)
 
-    s3_store = s3fs.S3Map(root=zarr_path, s3=jasmin_s3)
-    ds = xr.open_zarr(store=s3_store, consolidated=True, **kwargs)
+    return s3fs.S3Map(root=zarr_path, s3=jasmin_s3)
+
+
+def read_zarr(path, project, **kwargs):
+    s3_store = get_read_store_map(path, project)
+    ds = open_zarr_store(s3_store, **kwargs)
     return ds
 
 
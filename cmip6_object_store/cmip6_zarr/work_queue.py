@@ -0,0 +1,185 @@
+"""
+Shared queue of datasets to convert, for pull-based scheduling.
+
+Instead of each worker converting a fixed batch, workers (local processes or
+LOTUS array members) repeatedly claim the next datasets from the queue until
+it is empty, so that no worker sits idle while others work through slow
+batches.
+
+The queue is a SQLite database in the data directory. Every transaction is
+also made while holding a FileLock, as SQLite's own locking cannot be relied
+on across hosts on shared filesystems.
+
+A claimed dataset is leased to the worker for `queue_lease_time`. Workers
+renew their leases while converting; the lease of a worker that crashed
+expires, and the dataset is then claimed by another worker, up to
+`queue_max_attempts` times before it is marked as failed.
+"""
+
+import os
+import socket
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from .. import logging
+from ..config import CONFIG
+from .batch_planner import duration_to_seconds
+from .file_lock import FileLock
+
+LOGGER = logging.getLogger(__file__)
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue(object):
+    def __init__(self, path, lease_time=None, max_attempts=None):
+        """
+        :param path: (str) Path to the SQLite database of the queue
+        :param lease_time: (float) Seconds that a claimed dataset is leased for
+        :param max_attempts: (int) Number of times a dataset can be claimed
+        """
+        workflow = CONFIG["workflow"]
+
+        self._path = path
+        self._lock_path = f"{path}.lock"
+        self.lease_time = lease_time or duration_to_seconds(workflow["queue_lease_time"])
+        self._max_attempts = max_attempts or workflow["queue_max_attempts"]
+
+        with self._transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS queue "
+                "(dataset_id TEXT PRIMARY KEY, state TEXT NOT NULL, worker TEXT, "
+                "lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0);"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS queue_state ON queue (state);")
+
+    @contextmanager
+    def _transaction(self):
+        with FileLock(self._lock_path, timeout=300, stale_after=120):
+            conn = sqlite3.connect(self._path, timeout=60, isolation_level=None)
+
+            try:
+                conn.execute("BEGIN IMMEDIATE;")
+
+                # Only roll back once the transaction has begun, so that an
+                # error in BEGIN (e.g. the database is locked) is raised
+                try:
+                    yield conn
+                    conn.execute("COMMIT;")
+                except Exception:
+                    conn.execute("ROLLBACK;")
+                    raise
+            finally:
+                conn.close()
+
+    def add(self, dataset_ids):
+        """
+        Adds datasets to the queue. Datasets already in the queue are left as
+        they are, except failed ones, which are queued again.
+        """
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT INTO queue (dataset_id, state) VALUES (?, ?) "
+                "ON CONFLICT (dataset_id) DO UPDATE SET state=excluded.state, "
+                "worker=NULL, lease_expires=NULL, attempts=0 WHERE state=?;",
+                [(dataset_id, PENDING, FAILED) for dataset_id in dataset_ids],
+            )
+            return conn.total_changes - before
+
+    def _expire_leases(self, conn, now):
+        conn.execute(
+            "UPDATE queue SET state=?, worker=NULL, lease_expires=NULL "
+            "WHERE state=? AND lease_expires<? AND attempts>=?;",
+            (FAILED, LEASED, now, self._max_attempts),
+        )
+        conn.execute(
+            "UPDATE queue SET state=?, worker=NULL, lease_expires=NULL "
+            "WHERE state=? AND lease_expires<?;",
+            (PENDING, LEASED, now),
+        )
+
+    def claim(self, worker, n=1):
+        "Leases up to `n` pending datasets to `worker`, and returns their IDs."
+        now = time.time()
+
+        with self._transaction() as conn:
+            self._expire_leases(conn, now)
+
+            dataset_ids = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT dataset_id FROM queue WHERE state=? ORDER BY rowid LIMIT ?;",
+                    (PENDING, n),
+                )
+            ]
+
+            conn.executemany(
+                "UPDATE queue SET state=?, worker=?, lease_expires=?, "
+                "attempts=attempts+1 WHERE dataset_id=?;",
+                [
+                    (LEASED, worker, now + self.lease_time, dataset_id)
+                    for dataset_id in dataset_ids
+                ],
+            )
+
+        return dataset_ids
+
+    def renew(self, worker, dataset_ids):
+        "Extends the leases that `worker` holds on `dataset_ids`."
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE queue SET lease_expires=? "
+                "WHERE dataset_id=? AND worker=? AND state=?;",
+                [
+                    (time.time() + self.lease_time, dataset_id, worker, LEASED)
+                    for dataset_id in dataset_ids
+                ],
+            )
+
+    def complete(self, worker, dataset_id, success=True):
+        """
+        Marks a dataset leased to `worker` as done or failed. Returns False if
+        `worker` no longer holds the lease (it expired and the dataset was
+        claimed again), in which case the dataset is left as it is.
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE queue SET state=?, worker=NULL, lease_expires=NULL "
+                "WHERE dataset_id=? AND worker=?;",
+                (DONE if success else FAILED, dataset_id, worker),
+            )
+            return cursor.rowcount > 0
+
+    def release(self, worker):
+        "Returns the datasets leased to `worker` to the queue, without an attempt."
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE queue SET state=?, worker=NULL, lease_expires=NULL, "
+                "attempts=attempts-1 WHERE worker=? AND state=?;",
+                (PENDING, worker, LEASED),
+            )
+
+    def counts(self):
+        "Returns the number of datasets in each state."
+        with self._transaction() as conn:
+            counts = dict(conn.execute("SELECT state, COUNT(*) FROM queue GROUP BY state;"))
+
+        return {state: counts.get(state, 0) for state in (PENDING, LEASED, DONE, FAILED)}
+
+
+def get_work_queue(project):
+    "Returns the work queue of the project, in the run version data directory."
+    version_dir = os.path.join(
+        CONFIG["workflow"]["data_dir"], CONFIG["workflow"]["run_version"]
+    )
+    if not os.path.isdir(version_dir):
+        os.makedirs(version_dir, exist_ok=True)
+
+    return WorkQueue(os.path.join(version_dir, f"{project}-work_queue.sqlite"))
+
@@ -3,7 +3,8 @@
 from urllib.parse import urlparse
 
 import s3fs
-import xarray as xr
+
+from cmip6_object_store.cmip6_zarr.utils import open_zarr_store
 
 eg_zarr_url = (
     "http://cmip6-zarr-o.s3.jc.rl.ac.uk/CMIP6.AerChemMIP.NIMS-KMA.UKESM1-0-LL/"
@@ -22,5 +23,5 @@ def open_zarr(zarr_url):
     jasmin_s3 = s3fs.S3FileSystem(anon=True, client_kwargs={"endpoint_url": endpoint})
 
     s3_store = s3fs.S3Map(root=zarr_path, s3=jasmin_s3)
-    ds = xr.open_zarr(store=s3_store, consolidated=True)
+    ds = open_zarr_store(s3_store)
     return ds
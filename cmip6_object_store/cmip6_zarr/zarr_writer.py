@@ -1,18 +1,40 @@
 import math
 import os
+import threading
 import traceback
+import warnings
 
-import dask
 import xarray as xr
+import zarr
 
 from .. import logging
 from ..config import CONFIG, get_from_proj_or_workflow
-from .caringo_store import CaringoStore
+from .archive_scanner import get_archive_scanner
+from .caringo_store import get_caringo_store
+from .checkpoint import WriteCheckpoint, truncate_dim
+from .checksums import ChecksumManifest
+from .conversion_stats import ConversionStats
+from .encoding import apply_codecs
+from .pipeline import ChunkPipeline
+from .chunk_planner import TIME_DIM, apply_chunk_plan, plan_chunks, plan_shards
 from .utils import get_credentials, get_var_id, get_zarr_path
-from .results_store import get_results_store
+from .results_store import (
+    get_buffered_checksum_store,
+    get_buffered_results_store,
+    get_buffered_stats_store,
+)
 
 LOGGER = logging.getLogger(__file__)
 
+WRITE_ENGINES = ("synchronous", "threads", "processes", "distributed")
+CONVERSION_MODES = ("mfdataset", "streaming", "pipeline")
+ZARR_FORMATS = (2, 3)
+
+# How the NetCDF files of a dataset are combined along time, in every
+# conversion mode: variables without a time axis are taken from the first
+# file rather than being given a time axis
+COMBINE_OPTIONS = {"data_vars": "minimal", "coords": "minimal", "compat": "override"}
+
 
 class ZarrWriter(object):
     def __init__(self, batch, project):
@@ -20,14 +42,58 @@ class ZarrWriter(object):
         self._project = project
 
         self._config = CONFIG[f"project:{project}"]
-        self._results_store = get_results_store(self._project)
-        
+        self._results_store = get_buffered_results_store(self._project)
+        self._stats_store = get_buffered_stats_store(self._project)
+        self._checksum_store = get_buffered_checksum_store(self._project)
+        self._client = None
+        self._pipeline = None
+        self._policy_buckets = set()
+        # Datasets may be converted concurrently by threads sharing the writer
+        self._lock = threading.Lock()
+
+    def preload_results(self, dataset_ids):
+        "Loads which of `dataset_ids` have already been converted, in one query."
+        self._results_store.preload(dataset_ids)
+
+    def flush_results(self):
+        self._results_store.flush()
+        self._stats_store.flush()
+        self._checksum_store.flush()
+
+    def ran_successfully(self, dataset_id):
+        return self._results_store.ran_successfully(dataset_id)
+
+    def insert_failure(self, dataset_id, error):
+        "Records a failure that escaped `convert`, with the other buffered results."
+        self._results_store.insert_failure(dataset_id, error)
+
+    def close(self):
+        """
+        Writes any buffered results and shuts down the local dask cluster and
+        the conversion pipeline if they were started.
+        """
+        self.flush_results()
+
+        if self._pipeline is not None:
+            self._pipeline.close()
+            self._pipeline = None
+
+        if self._client is not None:
+            cluster = self._client.cluster
+            self._client.close()
+            cluster.close()
+            self._client = None
+
     def _id_to_directory(self, dataset_id):
         archive_dir = self._config["archive_dir"]
         return os.path.join(archive_dir, dataset_id.replace(".", "/"))
 
     def convert(self, dataset_id):
 
+        conversion_mode = get_from_proj_or_workflow("conversion_mode", self._project)
+        if conversion_mode not in CONVERSION_MODES:
+            raise ValueError(f"unsupported conversion mode {conversion_mode}")
+
         if self._results_store.ran_successfully(dataset_id):
             LOGGER.info(f"Already converted to Zarr: {dataset_id}")
             return
@@ -36,9 +102,11 @@ class ZarrWriter(object):
         self._results_store.delete_result(dataset_id)
 
         LOGGER.info(f"Converting to Zarr: {dataset_id}")
+        stats = ConversionStats()
+        checksums = self._new_checksums()
 
         try:
-            store = CaringoStore(get_credentials())
+            store = get_caringo_store(get_credentials())
             bucket, zarr_file = get_zarr_path(dataset_id, self._project)
             zpath = f"{bucket}/{zarr_file}"
             LOGGER.info(f"Zarr path: {zpath}")
@@ -47,85 +115,494 @@ class ZarrWriter(object):
             store_map = store.get_store_map(zpath)
         except Exception:
             msg = f"Failed to create bucket for: {dataset_id}"
-            return self._wrap_exception(dataset_id, msg)
+            return self._wrap_exception(dataset_id, msg, stats)
 
-        # Load the data and ready it for processing
-        try:
-            ds = self._get_ds(dataset_id)
-        except Exception:
-            msg = f"Failed to get Xarray dataset: {dataset_id}"
-            return self._wrap_exception(dataset_id, msg)
+        if conversion_mode == "streaming":
+            # Reading, chunk planning and writing are interleaved, so are all
+            # counted as writing
+            try:
+                LOGGER.info(f"Streaming to: {zpath}")
+                stats.bytes_read = self._get_archive_size(dataset_id)
 
-        # Write to zarr
-        try:
-            if hasattr(ds, "time"):
-                ds_to_write = self._get_chunked_ds(dataset_id, ds, store_map)
-            else:
-                ds_to_write = ds
+                with stats.phase("write"):
+                    self._write_streaming(dataset_id, store_map, checksums)
+                    self._save_checksums(checksums, store_map)
+            except Exception:
+                msg = f"Failed to write to Zarr: {dataset_id}"
+                return self._wrap_exception(dataset_id, msg, stats)
+        else:
+            # Load the data and ready it for processing
+            try:
+                with stats.phase("open"):
+                    stats.bytes_read = self._get_archive_size(dataset_id)
+                    ds = self._get_ds(dataset_id)
+            except Exception:
+                msg = f"Failed to get Xarray dataset: {dataset_id}"
+                return self._wrap_exception(dataset_id, msg, stats)
 
-            LOGGER.info(f"Writing to: {zpath}")
-            self._write_zarr(ds_to_write, store_map)
-        except Exception:
-            msg = f"Failed to write to Zarr: {dataset_id}"
-            return self._wrap_exception(dataset_id, msg)
+            # Write to zarr
+            try:
+                with stats.phase("plan"):
+                    ds_to_write = self._get_chunked_ds(dataset_id, ds, store_map)
+
+                LOGGER.info(f"Writing to: {zpath}")
+                with stats.phase("write"):
+                    if conversion_mode == "pipeline":
+                        self._get_pipeline().write(
+                            ds_to_write,
+                            store_map,
+                            zarr_format=self._get_zarr_format(),
+                            checksums=checksums,
+                        )
+                    elif get_from_proj_or_workflow("resume_writes", self._project):
+                        self._write_resumable(
+                            dataset_id, ds_to_write, store_map, checksums
+                        )
+                    else:
+                        self._write_zarr(ds_to_write, store_map, checksums=checksums)
+
+                    self._save_checksums(checksums, store_map)
+                ds.close()
+            except Exception:
+                msg = f"Failed to write to Zarr: {dataset_id}"
+                return self._wrap_exception(dataset_id, msg, stats)
 
         try:
-            ds.close()
-            do_perms = get_from_proj_or_workflow("set_permissions", self._project)
-            if do_perms:
-                LOGGER.info("Setting read permissions")
-                store.set_permissions(zpath)
-            else:
-                LOGGER.info("Skipping setting permissions")
+            with stats.phase("permissions"):
+                objects = self._set_permissions(store, bucket, zpath)
 
-            LOGGER.info(f"Completed write for: {zpath}")
-            self._finalise(dataset_id, zpath)
+            with stats.phase("finalise"):
+                stats.objects_written, stats.bytes_written = self._get_written_size(
+                    store_map, objects
+                )
+                LOGGER.info(f"Completed write for: {zpath}")
+                self._finalise(dataset_id, zpath, stats, checksums)
         except Exception:
             msg = f"Finalisation failed for: {dataset_id}"
-            return self._wrap_exception(dataset_id, msg)
+            return self._wrap_exception(dataset_id, msg, stats)
+
+    def _set_permissions(self, store, bucket, zpath):
+        """
+        Sets read permissions on the Zarr store, or on its bucket. Returns the
+        listing of the objects in the store if it was made, otherwise None.
+        """
+        do_perms = get_from_proj_or_workflow("set_permissions", self._project)
+
+        if do_perms and get_from_proj_or_workflow("bucket_policy", self._project):
+            if bucket not in self._policy_buckets:
+                LOGGER.info(f"Setting read policy on bucket: {bucket}")
+                store.set_bucket_policy(bucket)
+                self._policy_buckets.add(bucket)
+        elif do_perms:
+            LOGGER.info("Setting read permissions")
+            n_workers = get_from_proj_or_workflow("permission_workers", self._project)
+            return store.set_permissions(zpath, n_workers=n_workers)
+        else:
+            LOGGER.info("Skipping setting permissions")
+
+        return None
+
+    def _get_archive_size(self, dataset_id):
+        "Returns the total size (in bytes) of the NetCDF files of the dataset."
+        return sum(os.path.getsize(nc_file) for nc_file in self._get_nc_files(dataset_id))
+
+    def _get_written_size(self, store_map, objects=None):
+        """
+        Returns the number and total size (in bytes) of the objects written,
+        from the listing `objects` ({path: info}) if one was already made
+        when setting permissions, so that the store is only listed once.
+        """
+        if objects is None:
+            store_map.fs.invalidate_cache(store_map.root)
+            objects = store_map.fs.find(store_map.root, detail=True)
+
+        return len(objects), sum(info.get("size", 0) for info in objects.values())
 
     def _get_ds(self, dataset_id):
 
         dr = self._id_to_directory(dataset_id)
         LOGGER.info(f"Reading data from: {dr}")
 
-        file_pattern = f"{dr}/*.nc"
-        ds = xr.open_mfdataset(file_pattern, use_cftime=True, combine="by_coords")
+        nc_files = self._get_nc_files(dataset_id)
+        if not nc_files:
+            raise Exception(f"No NetCDF files found for: {dataset_id}")
+
+        ds = xr.open_mfdataset(
+            nc_files, use_cftime=True, combine="by_coords", **COMBINE_OPTIONS
+        )
         return ds
 
-    def _get_chunked_ds(self, dataset_id, ds, store_map):
-        LOGGER.info(f"Processing: {dataset_id}")
+    def _get_nc_files(self, dataset_id):
+        return get_archive_scanner(self._project).list_nc_files(dataset_id)
+
+    def _open_nc(self, nc_file, **kwargs):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return xr.open_dataset(nc_file, use_cftime=True, **kwargs)
+
+    def _get_chunk_plan(self, dataset_id, ds, sizes=None):
         var_id = get_var_id(dataset_id, project=self._project)
 
-        # Chunk by time
         chunk_size_bytes = get_from_proj_or_workflow("chunk_size", self._project) * (2 ** 20)
+        access_pattern = get_from_proj_or_workflow("access_pattern", self._project)
         LOGGER.info(f'Shape of variable "{var_id}": {ds[var_id].shape}')
-        n_bytes = ds[var_id].nbytes
+        LOGGER.info(f"Number of bytes in array: {ds[var_id].nbytes}")
+
+        chunk_plan = plan_chunks(
+            ds, var_id, chunk_size_bytes, access_pattern, sizes=sizes
+        )
+        LOGGER.info(f"Chunking for {access_pattern} access: {chunk_plan[var_id]}")
+        return chunk_plan
+
+    def _get_zarr_format(self):
+        zarr_format = get_from_proj_or_workflow("zarr_format", self._project)
+
+        if zarr_format not in ZARR_FORMATS:
+            raise ValueError(f"unsupported zarr format {zarr_format}")
+
+        return zarr_format
+
+    def _get_shard_plan(self, dataset_id, ds, chunk_plan, sizes=None):
+        """
+        Returns the shard plan of the dataset, or None if `shard_size` is 0
+        (one object per chunk).
+        """
+        shard_size = get_from_proj_or_workflow("shard_size", self._project)
+        if not shard_size:
+            return None
+
+        if self._get_zarr_format() != 3:
+            raise ValueError("sharding needs zarr_format = 3")
+
+        var_id = get_var_id(dataset_id, project=self._project)
+        access_pattern = get_from_proj_or_workflow("access_pattern", self._project)
+
+        shard_plan = plan_shards(
+            ds, var_id, chunk_plan, shard_size * (2 ** 20), access_pattern, sizes=sizes
+        )
+        LOGGER.info(f"Sharding: {shard_plan[var_id]}")
+        return shard_plan
 
-        LOGGER.info(f"Number of bytes in array: {n_bytes}")
-        chunk_length = math.ceil(len(ds.time) / math.ceil(n_bytes / chunk_size_bytes))
-        chunk_rule = {"time": chunk_length}
+    def _apply_plans(self, ds, chunk_plan, shard_plan=None):
+        "Returns `ds` chunked, sharded and with the codecs set, ready to write."
+        return apply_codecs(
+            apply_chunk_plan(ds, chunk_plan, shard_plan),
+            self._project,
+            zarr_format=self._get_zarr_format(),
+        )
 
-        LOGGER.info(f"Chunking into chunks of {chunk_length} time steps")
-        chunked_ds = ds.chunk(chunk_rule)
-        chunked_ds[var_id].unify_chunks()
+    def _get_chunked_ds(self, dataset_id, ds, store_map):
+        LOGGER.info(f"Processing: {dataset_id}")
+
+        chunk_plan = self._get_chunk_plan(dataset_id, ds)
+        shard_plan = self._get_shard_plan(dataset_id, ds, chunk_plan)
+        chunked_ds = self._apply_plans(ds, chunk_plan, shard_plan)
 
         LOGGER.info(f"Chunks: {chunked_ds.chunks}")
         return chunked_ds
 
-    def _write_zarr(self, ds, store_map):
-        with dask.config.set(scheduler="synchronous"):
-            delayed_obj = ds.to_zarr(
-                store=store_map, mode="w", consolidated=True, compute=False
+    def _write_engine(self):
+        """
+        Returns the keyword arguments of `compute` that run dask computations
+        with the write engine and number of workers configured for the
+        project, so that many chunks are uploaded to the object store
+        concurrently. They are passed to each computation rather than set in
+        the (process-wide) dask config, as datasets converted by different
+        threads would otherwise change each other's scheduler.
+        """
+        engine = get_from_proj_or_workflow("write_engine", self._project)
+        n_workers = get_from_proj_or_workflow("write_workers", self._project)
+
+        if engine not in WRITE_ENGINES:
+            raise ValueError(f"unsupported write engine {engine}")
+
+        if engine == "distributed":
+            with self._lock:
+                if self._client is None:
+                    from dask.distributed import Client, LocalCluster
+
+                    cluster = LocalCluster(
+                        n_workers=n_workers, threads_per_worker=1, dashboard_address=None
+                    )
+                    self._client = Client(cluster)
+
+            return {"scheduler": self._client}
+
+        return {"scheduler": engine, "num_workers": n_workers}
+
+    def _get_pipeline(self):
+        with self._lock:
+            if self._pipeline is None:
+                self._pipeline = ChunkPipeline(
+                    n_readers=get_from_proj_or_workflow("pipeline_readers", self._project),
+                    n_encoders=get_from_proj_or_workflow("pipeline_encoders", self._project),
+                    n_uploaders=get_from_proj_or_workflow("write_workers", self._project),
+                    max_chunks=get_from_proj_or_workflow(
+                        "pipeline_max_chunks", self._project
+                    ),
+                )
+
+            return self._pipeline
+
+    def _new_checksums(self):
+        "Returns an empty checksum manifest, or None if `write_checksums` is off."
+        if get_from_proj_or_workflow("write_checksums", self._project):
+            return ChecksumManifest()
+
+        return None
+
+    def _save_checksums(self, checksums, store_map):
+        if checksums is not None:
+            checksums.save(store_map)
+            LOGGER.debug(f"Saved checksums of {checksums.n_blocks} blocks")
+
+    def _write_zarr(
+        self,
+        ds,
+        store_map,
+        mode="w",
+        consolidated=True,
+        checksums=None,
+        offsets=None,
+        **kwargs,
+    ):
+        """
+        Writes `ds` to the store. If a checksum manifest is given, the blocks
+        are hashed as they are written, at `offsets` ({dim: start}) in the
+        store.
+        """
+        compute_kwargs = self._write_engine()
+        delayed_obj = ds.to_zarr(
+            store=store_map,
+            mode=mode,
+            consolidated=consolidated,
+            compute=False,
+            zarr_format=self._get_zarr_format(),
+            **kwargs,
+        )
+
+        if checksums is None:
+            delayed_obj.compute(**compute_kwargs)
+        else:
+            checksums.add_blocks(ds, offsets, delayed_obj, **compute_kwargs)
+
+    def _get_static_vars(self, ds):
+        "Returns the names of variables in `ds` that have no time axis."
+        return [name for name, variable in ds.variables.items() if TIME_DIM not in variable.dims]
+
+    def _write_resumable(self, dataset_id, ds, store_map, checksums=None):
+        """
+        Writes the chunked dataset `ds` in regions of `checkpoint_chunks` time
+        chunks, recording each completed region in a checkpoint in the store.
+        If a checkpoint for the same write plan is found, only the missing
+        regions are written (and the checksums of the others are kept).
+        """
+        var_id = get_var_id(dataset_id, project=self._project)
+
+        if TIME_DIM not in ds[var_id].dims:
+            return self._write_zarr(ds, store_map, checksums=checksums)
+
+        chunks = {dim: sizes[0] for dim, sizes in ds[var_id].chunksizes.items()}
+        n_chunks = get_from_proj_or_workflow("checkpoint_chunks", self._project)
+        region_length = chunks[TIME_DIM] * n_chunks
+
+        n_times = ds.sizes[TIME_DIM]
+        n_regions = math.ceil(n_times / region_length)
+
+        signature = {
+            "mode": "mfdataset",
+            "sizes": dict(ds[var_id].sizes),
+            "chunks": chunks,
+            "region_length": region_length,
+        }
+        checkpoint = WriteCheckpoint(store_map, signature)
+
+        if checkpoint.resume():
+            LOGGER.info(f"Resuming write: {checkpoint.n_done} of {n_regions} regions done")
+
+            if checksums is not None:
+                checksums.resume(store_map)
+        else:
+            # Write the metadata and the variables without a time axis
+            ds.to_zarr(
+                store=store_map,
+                mode="w",
+                consolidated=False,
+                compute=False,
+                zarr_format=self._get_zarr_format(),
             )
-            delayed_obj.compute()
 
-    def _finalise(self, dataset_id, zpath):
+            static_ds = ds[self._get_static_vars(ds)]
+            if static_ds.variables:
+                self._write_zarr(
+                    static_ds, store_map, mode="a", consolidated=False, checksums=checksums
+                )
+
+            checkpoint.start()
+
+        time_ds = ds.drop_vars(self._get_static_vars(ds))
+
+        for region in range(n_regions):
+            if checkpoint.is_done(region):
+                continue
+
+            time_slice = slice(region * region_length, min(n_times, (region + 1) * region_length))
+            LOGGER.info(f"Writing region {region + 1} of {n_regions}: {time_slice}")
+
+            self._write_zarr(
+                time_ds.isel({TIME_DIM: time_slice}),
+                store_map,
+                mode="r+",
+                consolidated=False,
+                region={TIME_DIM: time_slice},
+                checksums=checksums,
+                offsets={TIME_DIM: time_slice.start},
+            )
+            self._save_checksums(checksums, store_map)
+            checkpoint.mark_done(region)
+
+        zarr.consolidate_metadata(store_map)
+        checkpoint.clear()
+
+    def _iter_time_blocks(self, nc_files, block_length):
+        """
+        Yields the dataset spread across `nc_files` as consecutive blocks of
+        `block_length` time steps (the last block may be shorter). Blocks are
+        lazy; time steps left over at the end of one file are loaded and
+        joined to the start of the next so that each file can be closed as
+        soon as it has been read.
+        """
+        leftover = None
+
+        for nc_file in nc_files:
+            LOGGER.info(f"Reading data from: {nc_file}")
+            nc_ds = self._open_nc(nc_file)
+            ds = nc_ds
+
+            if leftover is not None:
+                ds = xr.concat([leftover, ds], dim=TIME_DIM, **COMBINE_OPTIONS)
+
+            n_times, start = ds.sizes[TIME_DIM], 0
+
+            while n_times - start >= block_length:
+                yield ds.isel({TIME_DIM: slice(start, start + block_length)})
+                start += block_length
+
+            leftover = ds.isel({TIME_DIM: slice(start, None)}).load()
+            nc_ds.close()
+
+        if leftover is not None and leftover.sizes[TIME_DIM]:
+            yield leftover
+
+    def _write_streaming(self, dataset_id, store_map, checksums=None):
+        """
+        Writes the dataset to Zarr one output chunk (along time) at a time,
+        reading the NetCDF files in order. The store is initialised from the
+        first block and each following block is appended, so that peak memory
+        is bounded by an output chunk rather than by the whole dataset.
+        """
+        var_id = get_var_id(dataset_id, project=self._project)
+        nc_files = self._get_nc_files(dataset_id)
+
+        if not nc_files:
+            raise Exception(f"No NetCDF files found for: {dataset_id}")
+
+        first_ds = self._open_nc(nc_files[0])
+
+        if TIME_DIM not in first_ds[var_id].dims:
+            first_ds.close()
+            ds = self._get_ds(dataset_id)
+            self._write_zarr(
+                self._get_chunked_ds(dataset_id, ds, store_map),
+                store_map,
+                checksums=checksums,
+            )
+            ds.close()
+            return
+
+        # Only read the headers to get the full length of the time axis
+        n_times = 0
+        for nc_file in nc_files:
+            with self._open_nc(nc_file, decode_times=False) as nc_ds:
+                n_times += nc_ds.sizes[TIME_DIM]
+
+        chunk_plan = self._get_chunk_plan(
+            dataset_id, first_ds, sizes={TIME_DIM: n_times}
+        )
+        shard_plan = self._get_shard_plan(
+            dataset_id, first_ds, chunk_plan, sizes={TIME_DIM: n_times}
+        )
+        first_ds.close()
+
+        # Blocks are whole shards, if sharded, so that each is written once
+        block_length = (shard_plan or chunk_plan)[var_id][TIME_DIM]
+        LOGGER.info(f"Streaming {n_times} time steps in blocks of {block_length}")
+
+        checkpoint = None
+        n_done = 0
+
+        if get_from_proj_or_workflow("resume_writes", self._project):
+            signature = {"mode": "streaming", "n_times": n_times, "chunks": chunk_plan[var_id]}
+            if shard_plan is not None:
+                signature["shards"] = shard_plan[var_id]
+
+            checkpoint = WriteCheckpoint(store_map, signature)
+
+            if checkpoint.resume() and checkpoint.n_done:
+                # Blocks are appended in order, so drop anything appended
+                # after the last block that was recorded as complete
+                n_done = checkpoint.n_done
+                LOGGER.info(f"Resuming write after {n_done} blocks")
+                truncate_dim(store_map, TIME_DIM, n_done * block_length)
+
+                if checksums is not None:
+                    checksums.resume(store_map)
+
+        for i, block in enumerate(self._iter_time_blocks(nc_files, block_length)):
+            if i < n_done:
+                continue
+
+            block = self._apply_plans(block, chunk_plan, shard_plan)
+
+            if i == 0:
+                self._write_zarr(block, store_map, consolidated=False, checksums=checksums)
+            else:
+                block = block.drop_vars(self._get_static_vars(block))
+                self._write_zarr(
+                    block,
+                    store_map,
+                    mode="a",
+                    consolidated=False,
+                    checksums=checksums,
+                    offsets={TIME_DIM: i * block_length},
+                    append_dim=TIME_DIM,
+                )
+
+            if checkpoint is not None:
+                self._save_checksums(checksums, store_map)
+                checkpoint.mark_done(i)
+
+        zarr.consolidate_metadata(store_map)
+
+        if checkpoint is not None:
+            checkpoint.clear()
+
+    def _finalise(self, dataset_id, zpath, stats=None, checksums=None):
         self._results_store.insert_success(dataset_id)
+        if stats is not None:
+            self._stats_store.insert_result(dataset_id, stats.to_json(success=True))
+        if checksums is not None:
+            self._checksum_store.insert_result(dataset_id, checksums.digest())
+
+        # Write successes straight away, so that none are lost if the job is
+        # killed
+        self.flush_results()
         LOGGER.info(f"Wrote result for: {dataset_id}")
 
-    def _wrap_exception(self, dataset_id, msg):
+    def _wrap_exception(self, dataset_id, msg, stats=None):
         tb = traceback.format_exc()
         error = f"{msg}:\n{tb}"
         self._results_store.insert_failure(dataset_id, error)
+        if stats is not None:
+            self._stats_store.insert_result(dataset_id, stats.to_json(success=False))
         LOGGER.error(f"FAILED TO COMPLETE FOR: {dataset_id}\n{error}")
@@ -0,0 +1,94 @@
+import os
+import threading
+
+from cmip6_object_store.cmip6_zarr import archive_scanner
+from cmip6_object_store.cmip6_zarr.archive_scanner import ArchiveScanner, ScanCache
+from cmip6_object_store.cmip6_zarr.file_lock import FileLock
+
+
+def _make_archive(tmp_path, monkeypatch, n_datasets):
+    monkeypatch.setattr(
+        archive_scanner, "get_archive_path", lambda dataset_id, project: str(tmp_path / dataset_id)
+    )
+
+    for i in range(n_datasets):
+        directory = tmp_path / f"ds{i}"
+        directory.mkdir()
+
+        for name in ("b_200001-200912.nc", "a_199001-199912.nc", ".hidden.nc", "notes.txt"):
+            (directory / name).write_text("")
+
+    return [f"ds{i}" for i in range(n_datasets)]
+
+
+def _count_scans(monkeypatch):
+    scanned = []
+    scan_dir = archive_scanner.scan_dir
+
+    def counting_scan_dir(directory):
+        scanned.append(os.path.basename(directory))
+        return scan_dir(directory)
+
+    monkeypatch.setattr(archive_scanner, "scan_dir", counting_scan_dir)
+    return scanned
+
+
+def test_ArchiveScanner_scan(tmp_path, monkeypatch):
+    dataset_ids = _make_archive(tmp_path, monkeypatch, 5)
+    scanned = _count_scans(monkeypatch)
+    cache_file = str(tmp_path / "scan.sqlite")
+
+    scanner = ArchiveScanner("cmip6", cache=ScanCache(cache_file), n_workers=3)
+    nc_files = scanner.scan(dataset_ids + ["missing"])
+
+    assert [os.path.basename(path) for path in nc_files["ds2"]] == [
+        "a_199001-199912.nc",
+        "b_200001-200912.nc",
+    ]
+    assert nc_files["missing"] == []
+    assert sorted(scanned) == dataset_ids
+
+    # The cache persists, and only changed directories are listed again
+    scanned.clear()
+    (tmp_path / "ds3" / "c_201001-201412.nc").write_text("")
+    os.utime(tmp_path / "ds3", ns=(0, 10 ** 18))
+
+    scanner = ArchiveScanner("cmip6", cache=ScanCache(cache_file), n_workers=3)
+    nc_files = scanner.scan(dataset_ids)
+
+    assert scanned == ["ds3"]
+    assert len(nc_files["ds3"]) == 3
+    assert scanner.list_nc_files("ds1") == nc_files["ds1"]
+
+
+def test_ArchiveScanner_memory_cache(tmp_path, monkeypatch):
+    dataset_ids = _make_archive(tmp_path, monkeypatch, 2)
+    scanned = _count_scans(monkeypatch)
+
+    scanner = ArchiveScanner("cmip6", cache=ScanCache(), n_workers=2)
+    scanner.scan(dataset_ids)
+    scanner.scan(dataset_ids)
+
+    assert sorted(scanned) == dataset_ids
+
+
+def test_ScanCache_write_lock(tmp_path):
+    cache_file = str(tmp_path / "scan.sqlite")
+    cache, other_cache = ScanCache(cache_file), ScanCache(cache_file)
+
+    # Writes wait for the lock held by another process
+    lock = FileLock(f"{cache_file}.lock")
+    lock.acquire()
+
+    writer = threading.Thread(target=cache.put_many, args=([("ds0", 1, ["a.nc"])],))
+    writer.start()
+
+    try:
+        writer.join(0.5)
+        assert writer.is_alive()
+        assert other_cache.get_many(["ds0"]) == {}
+    finally:
+        lock.release()
+
+    writer.join()
+    assert other_cache.get_many(["ds0"]) == {"ds0": (1, ["a.nc"])}
@@ -0,0 +1,218 @@
+import asyncio
+
+import pytest
+from botocore.exceptions import ClientError
+
+from cmip6_object_store.cmip6_zarr import async_store
+from cmip6_object_store.cmip6_zarr.async_store import (
+    DELETE_BATCH_SIZE,
+    AsyncCaringoStore,
+    run_on_buckets,
+)
+from cmip6_object_store.cmip6_zarr.retry_policy import FATAL, classify_error
+from cmip6_object_store.config import CONFIG
+
+CREDS = {"token": "a-token", "secret": "a-secret"}
+
+
+def _client_error(code, status, operation):
+    response = {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}}
+    return ClientError(response, operation)
+
+
+class FakePaginator(object):
+    def __init__(self, client):
+        self._client = client
+
+    async def paginate(self, Bucket, Prefix):
+        keys = sorted(key for key in self._client.buckets[Bucket] if key.startswith(Prefix))
+
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            yield {"Contents": [{"Key": key} for key in keys[start : start + DELETE_BATCH_SIZE]]}
+
+
+class FakeS3Client(object):
+    """
+    Stand-in for an aiobotocore S3 client, with buckets kept in memory. Each
+    call is recorded, and the first `failures[method]` calls of a method
+    fail with the error given in `errors[method]` (by default a transient
+    500 error).
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or {}
+        self.calls = []
+        self.failures = {}
+        self.errors = {}
+
+    def _record(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+
+        if self.failures.get(method, 0) > 0:
+            self.failures[method] -= 1
+            raise self.errors.get(method, _client_error("InternalError", 500, method))
+
+    def _get_bucket(self, bucket, method):
+        if bucket not in self.buckets:
+            raise _client_error("NoSuchBucket", 404, method)
+        return self.buckets[bucket]
+
+    def n_calls(self, method):
+        return len([name for name, _ in self.calls if name == method])
+
+    async def head_bucket(self, Bucket):
+        self._record("head_bucket", Bucket=Bucket)
+        if Bucket not in self.buckets:
+            raise _client_error("404", 404, "HeadBucket")
+
+    async def list_objects_v2(self, Bucket, Prefix, MaxKeys):
+        self._record("list_objects_v2", Bucket=Bucket, Prefix=Prefix)
+        keys = [key for key in self._get_bucket(Bucket, "ListObjectsV2") if key.startswith(Prefix)]
+        return {"KeyCount": min(len(keys), MaxKeys)}
+
+    async def create_bucket(self, Bucket):
+        self._record("create_bucket", Bucket=Bucket)
+        self.buckets[Bucket] = set()
+
+    async def delete_objects(self, Bucket, Delete):
+        self._record("delete_objects", Bucket=Bucket, n_keys=len(Delete["Objects"]))
+        self._get_bucket(Bucket, "DeleteObjects").difference_update(
+            item["Key"] for item in Delete["Objects"]
+        )
+
+    async def delete_bucket(self, Bucket):
+        self._record("delete_bucket", Bucket=Bucket)
+        del self.buckets[Bucket]
+
+    async def put_object_acl(self, Bucket, Key, ACL):
+        self._record("put_object_acl", Bucket=Bucket, Key=Key, ACL=ACL)
+
+    async def put_bucket_policy(self, Bucket, Policy):
+        self._record("put_bucket_policy", Bucket=Bucket)
+        self._get_bucket(Bucket, "PutBucketPolicy")
+
+    def get_paginator(self, method):
+        assert method == "list_objects_v2"
+        return FakePaginator(self)
+
+
+class FakeClientCreator(object):
+    def __init__(self, client):
+        self._client = client
+
+    async def __aenter__(self):
+        return self._client
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class FakeSession(object):
+    def __init__(self, client):
+        self._client = client
+
+    def create_client(self, service_name, **kwargs):
+        assert service_name == "s3"
+        assert kwargs["aws_access_key_id"] == CREDS["token"]
+        return FakeClientCreator(self._client)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    "Makes AsyncCaringoStores use a FakeS3Client, without delays between retries."
+    monkeypatch.setitem(CONFIG["workflow"], "retries", 3)
+    monkeypatch.setitem(CONFIG["workflow"], "retry_base_delay", 0.001)
+    monkeypatch.setitem(CONFIG["workflow"], "retry_max_delay", 0.001)
+
+    fake_client = FakeS3Client()
+    monkeypatch.setattr(async_store, "get_session", lambda: FakeSession(fake_client))
+    return fake_client
+
+
+def _run(operation_name, *args):
+    async def _run_operation():
+        async with AsyncCaringoStore(CREDS) as store:
+            return await getattr(store, operation_name)(*args)
+
+    return asyncio.run(_run_operation())
+
+
+def test_AsyncCaringoStore_exists(client):
+    client.buckets["a-bucket"] = {"test.zarr/.zgroup"}
+
+    assert _run("exists", "a-bucket")
+    assert _run("exists", "a-bucket/test.zarr")
+    assert not _run("exists", "a-bucket/other.zarr")
+    assert not _run("exists", "no-bucket")
+
+
+def test_AsyncCaringoStore_create_bucket(client):
+    _run("create_bucket", "a-bucket")
+    _run("create_bucket", "a-bucket")
+
+    assert client.buckets == {"a-bucket": set()}
+    assert client.n_calls("create_bucket") == 1
+
+    # Only the whole operation is retried, so a failing check that the
+    # bucket exists is not retried within each attempt
+    client.calls.clear()
+    client.failures["head_bucket"] = 10
+
+    with pytest.raises(ClientError):
+        _run("create_bucket", "b-bucket")
+
+    assert client.n_calls("head_bucket") == 3
+    assert client.n_calls("create_bucket") == 0
+
+
+def test_AsyncCaringoStore_delete(client):
+    keys = {f"test.zarr/tas/{i}.0" for i in range(2 * DELETE_BATCH_SIZE + 1)}
+    client.buckets["a-bucket"] = set(keys)
+    client.buckets["b-bucket"] = set(keys)
+
+    # A transient failure of one batch is retried
+    client.failures["delete_objects"] = 1
+    _run("delete", "a-bucket")
+
+    assert "a-bucket" not in client.buckets
+    assert client.n_calls("delete_objects") == 4
+
+    # A fatal error is raised straight away, with its cause
+    client.calls.clear()
+    client.failures["delete_bucket"] = 1
+    client.errors["delete_bucket"] = _client_error("AccessDenied", 403, "DeleteBucket")
+
+    with pytest.raises(Exception, match="Cannot delete bucket: b-bucket") as exc_info:
+        _run("delete", "b-bucket")
+
+    assert exc_info.value.__cause__ is client.errors["delete_bucket"]
+    assert classify_error(exc_info.value) == FATAL
+    assert client.n_calls("delete_bucket") == 1
+
+
+def test_AsyncCaringoStore_set_permissions(client):
+    client.buckets["a-bucket"] = {"test.zarr/.zgroup", "test.zarr/tas/0.0", "other.zarr/.zgroup"}
+    client.failures["put_object_acl"] = 1
+
+    _run("set_permissions", "a-bucket/test.zarr")
+
+    acl_calls = [kwargs for method, kwargs in client.calls if method == "put_object_acl"]
+    assert sorted(kwargs["Key"] for kwargs in acl_calls[1:]) == [
+        "test.zarr/.zgroup",
+        "test.zarr/tas/0.0",
+    ]
+    assert all(kwargs["ACL"] == "public-read" for kwargs in acl_calls)
+
+
+def test_run_on_buckets(client):
+    client.buckets = {"a-bucket": set(), "b-bucket": set()}
+
+    failures = run_on_buckets(CREDS, "set_bucket_policy", ["a-bucket", "b-bucket", "c-bucket"])
+
+    assert list(failures) == ["c-bucket"]
+    assert classify_error(failures["c-bucket"]) == FATAL
+    assert client.n_calls("put_bucket_policy") == 3
+
+    failures = run_on_buckets(CREDS, "delete", ["a-bucket", "b-bucket"])
+    assert failures == {}
+    assert client.buckets == {}
@@ -1,4 +1,6 @@
+from cmip6_object_store.cmip6_zarr import batch
 from cmip6_object_store.cmip6_zarr.batch import BatchManager
+from cmip6_object_store.config import CONFIG
 
 
 def test_BatchManager():
@@ -7,3 +9,61 @@ def test_BatchManager():
     batch = bm.get_batch(1)
 
     assert batch[0].startswith("CMIP6.")
+
+
+class _DoneStore(object):
+    def get_successful_runs(self):
+        return ["CMIP6.ds.2"]
+
+
+def test_create_batches(monkeypatch, tmp_path):
+    datasets_file = tmp_path / "datasets.csv"
+    datasets_file.write_text(
+        "dataset_id, num_files, size_mb\n"
+        + "".join(f"CMIP6.ds.{i}, 1, {size}\n" for i, size in enumerate([600, 600, 500, 3000, 100, 200]))
+    )
+
+    monkeypatch.setitem(CONFIG["datasets"], "datasets_file", str(datasets_file))
+    monkeypatch.setitem(CONFIG["workflow"], "data_dir", str(tmp_path))
+    monkeypatch.setitem(CONFIG["workflow"], "batch_volume_limit", 1)
+    monkeypatch.setattr(batch, "get_results_store", lambda project: _DoneStore())
+
+    bm = BatchManager("cmip6")
+    bm.create_batches()
+
+    assert bm.get_batch_numbers() == [1, 2, 3]
+    assert bm.get_batch(1) == ["CMIP6.ds.0", "CMIP6.ds.1"]
+    assert bm.get_batch(2) == ["CMIP6.ds.3"]
+    assert bm.get_batch(3) == ["CMIP6.ds.4", "CMIP6.ds.5"]
+    assert bm.get_batches_for_datasets(["CMIP6.ds.5", "CMIP6.ds.0"]) == [1, 3]
+
+    # Text files are exported alongside the table
+    assert len(bm.get_batch_files()) == 3
+    assert open(bm.get_batch_files()[2]).read().split() == bm.get_batch(3)
+
+
+def test_batch_index(monkeypatch, tmp_path):
+    datasets_file = tmp_path / "datasets.csv"
+    datasets_file.write_text(
+        "dataset_id, num_files, size_mb\n"
+        + "".join(f"CMIP6.ds.{i}, 2, 512\n" for i in range(2000))
+    )
+
+    monkeypatch.setitem(CONFIG["datasets"], "datasets_file", str(datasets_file))
+    monkeypatch.setitem(CONFIG["workflow"], "data_dir", str(tmp_path))
+    monkeypatch.setitem(CONFIG["workflow"], "batch_volume_limit", 1)
+    monkeypatch.setitem(CONFIG["workflow"], "write_batch_files", False)
+
+    BatchManager("cmip6", exclude_done=False).create_batches()
+
+    bm = BatchManager("cmip6", exclude_done=False)
+    assert bm.get_batch_files() == []
+    assert bm._get_batch_index() is not None
+
+    assert bm.get_batch_numbers() == list(range(1, 1001))
+    assert bm.get_batch(2) == ["CMIP6.ds.2", "CMIP6.ds.3"]
+
+    dataset_ids = [f"CMIP6.ds.{i}" for i in range(0, 2000, 4)]
+    assert bm.get_batches_for_datasets(dataset_ids) == list(range(1, 1001, 2))
+    assert bm.get_batch_totals(2) == {"n_datasets": 2, "num_files": 4, "size_mb": 1024}
+    assert len(bm.get_predicted_runtimes(range(1, 1001))) == 1000
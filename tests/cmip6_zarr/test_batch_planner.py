@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+from cmip6_object_store.cmip6_zarr.batch_planner import (
+    RuntimeModel,
+    plan_binpack,
+    plan_sequential,
+    read_runtimes,
+    write_runtime,
+)
+from cmip6_object_store.config import CONFIG
+
+
+def _datasets(sizes, num_files=None):
+    return pd.DataFrame(
+        {
+            "dataset_id": [f"CMIP6.ds.{i}" for i in range(len(sizes))],
+            "num_files": num_files or [1] * len(sizes),
+            "size_mb": sizes,
+        }
+    )
+
+
+def test_plan_sequential():
+    df = _datasets([600, 600, 3000, 100, 200])
+    assert list(plan_sequential(df, 1024)) == [1, 1, 2, 3, 3]
+
+
+def test_plan_binpack_balances_batches():
+    # One large dataset followed by many small ones
+    df = _datasets([900] + [10] * 90)
+    batches = plan_binpack(df, {"size_mb": 1000})
+
+    volumes = df.groupby(batches)["size_mb"].sum()
+    assert len(volumes) == 2
+    assert volumes.max() <= 1000
+    assert volumes.max() - volumes.min() <= 10
+
+
+def test_plan_binpack_respects_all_limits():
+    rng = np.random.default_rng(0)
+    df = _datasets(
+        list(rng.uniform(1, 500, 200)), num_files=list(rng.integers(1, 300, 200))
+    )
+    limits = {"size_mb": 2000, "num_files": 1000}
+    batches = plan_binpack(df, limits)
+
+    totals = df.groupby(batches)[["size_mb", "num_files"]].sum()
+    assert (totals["size_mb"] <= 2000).all()
+    assert (totals["num_files"] <= 1000).all()
+    assert sorted(set(batches)) == list(range(1, len(totals) + 1))
+
+
+def test_plan_binpack_oversized_dataset():
+    df = _datasets([5000, 100, 100])
+    batches = plan_binpack(df, {"size_mb": 1000})
+
+    assert batches[0] not in batches[1:]
+
+
+def test_RuntimeModel_fit(monkeypatch, tmp_path):
+    monkeypatch.setitem(CONFIG["log"], "log_base_dir", str(tmp_path))
+    coeffs = {"n_datasets": 30.0, "num_files": 2.0, "size_mb": 0.1}
+
+    # Too few runtimes recorded to fit the model
+    assert RuntimeModel.for_project("cmip6").coeffs["size_mb"] == CONFIG["workflow"]["runtime_per_mb"]
+
+    rng = np.random.default_rng(1)
+    for batch in range(1, 11):
+        totals = {
+            "n_datasets": int(rng.integers(1, 100)),
+            "num_files": int(rng.integers(1, 2000)),
+            "size_mb": float(rng.uniform(100, 20000)),
+        }
+        duration = sum(coeffs[key] * totals[key] for key in coeffs)
+        write_runtime("cmip6", batch, duration, totals)
+
+    assert len(read_runtimes("cmip6")) == 10
+
+    model = RuntimeModel.for_project("cmip6")
+    for key, value in coeffs.items():
+        assert abs(model.coeffs[key] - value) < 1e-6
+
+    df = _datasets([1000], num_files=[10])
+    assert abs(model.predict(df)[0] - 150) < 1e-6
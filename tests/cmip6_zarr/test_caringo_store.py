@@ -1,7 +1,69 @@
+import json
+import threading
+
+import pytest
+import s3fs
 import xarray as xr
 
-from cmip6_object_store.cmip6_zarr.caringo_store import CaringoStore
+from cmip6_object_store.cmip6_zarr import caringo_store
+from cmip6_object_store.cmip6_zarr.caringo_store import (
+    PUBLIC_READ_POLICY,
+    CaringoStore,
+    clear_store_cache,
+    get_caringo_store,
+    get_filesystem,
+)
 from cmip6_object_store.cmip6_zarr.utils import get_credentials
+from cmip6_object_store.config import CONFIG
+
+
+class FakeS3FileSystem(object):
+    """
+    Stand-in for s3fs that records the S3 calls made, failing the first
+    `failures[key]` calls on each key with a (transient) connection error.
+    """
+
+    def __init__(self, paths, failures=None):
+        self.paths = paths
+        self.failures = dict(failures or {})
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def invalidate_cache(self, path):
+        pass
+
+    def find(self, path, detail=False):
+        found = [item for item in self.paths if item.startswith(f"{path}/")]
+        return {item: {"name": item, "size": 10} for item in found} if detail else found
+
+    def chmod(self, path, acl):
+        bucket, key = path.split("/", 1)
+        self.call_s3("put_object_acl", Bucket=bucket, Key=key, ACL=acl)
+
+    def call_s3(self, method, **kwargs):
+        key = kwargs.get("Key", kwargs["Bucket"])
+
+        with self._lock:
+            self.calls.append((method, kwargs))
+
+            if self.failures.get(key, 0) > 0:
+                self.failures[key] -= 1
+                raise ConnectionError(f"connection reset: {key}")
+
+
+@pytest.fixture
+def fake_fs(monkeypatch):
+    "Returns a function that makes CaringoStores use a FakeS3FileSystem."
+    monkeypatch.setitem(CONFIG["workflow"], "retries", 3)
+    monkeypatch.setitem(CONFIG["workflow"], "retry_base_delay", 0.001)
+    monkeypatch.setitem(CONFIG["workflow"], "retry_max_delay", 0.001)
+
+    def use_fake_fs(*args, **kwargs):
+        fs = FakeS3FileSystem(*args, **kwargs)
+        monkeypatch.setattr(caringo_store, "get_filesystem", lambda creds: fs)
+        return fs
+
+    return use_fake_fs
 
 
 def test_CaringoStore():
@@ -25,3 +87,67 @@ def test_CaringoStore():
     ds.close()
 
     store.set_permissions(zpath)
+
+
+def test_shared_filesystems(monkeypatch):
+    creds = {"token": "a-token", "secret": "a-secret"}
+
+    store = get_caringo_store(creds)
+    assert get_caringo_store(dict(creds)) is store
+    assert get_filesystem(creds) is store._fs
+
+    anon_fs = get_filesystem(anon=True)
+    assert get_filesystem(anon=True) is anon_fs
+    assert anon_fs is not store._fs
+
+    # Only the filesystem that opened a session has it closed
+    closed = []
+    monkeypatch.setattr(
+        s3fs.S3FileSystem,
+        "close_session",
+        staticmethod(lambda loop, s3creator: closed.append(s3creator)),
+    )
+    store._fs._s3creator = "a-session"
+
+    clear_store_cache()
+    assert closed == ["a-session"]
+    assert get_caringo_store(creds) is not store
+
+
+def test_CaringoStore_set_permissions(fake_fs):
+    zpath = "a-bucket/test.zarr"
+    paths = [f"{zpath}/.zgroup", f"{zpath}/tas/0.0", f"{zpath}/tas/1.0"]
+    # One object succeeds on its second try, one never does
+    fs = fake_fs(paths, failures={"test.zarr/tas/0.0": 1, "test.zarr/tas/1.0": 10})
+
+    with pytest.raises(Exception, match=f"1 of 3 objects under {zpath}, e.g.: {paths[2]}"):
+        CaringoStore({}).set_permissions(zpath, n_workers=2)
+
+    acl_calls = [kwargs["Key"] for method, kwargs in fs.calls if method == "put_object_acl"]
+    assert sorted(acl_calls) == sorted(
+        ["test.zarr/.zgroup"] + ["test.zarr/tas/0.0"] * 2 + ["test.zarr/tas/1.0"] * 3
+    )
+    assert all(kwargs["ACL"] == "public-read" for _, kwargs in fs.calls)
+
+    # All objects set
+    fs = fake_fs(paths, failures={"test.zarr/tas/0.0": 2})
+    objects = CaringoStore({}).set_permissions(zpath, permission="private")
+
+    assert sorted(objects) == paths
+
+    assert len(fs.calls) == 5
+    assert {kwargs["ACL"] for _, kwargs in fs.calls} == {"private"}
+
+
+def test_CaringoStore_set_bucket_policy(fake_fs):
+    fs = fake_fs([], failures={"a-bucket": 1})
+    CaringoStore({}).set_bucket_policy("a-bucket")
+
+    assert [method for method, _ in fs.calls] == ["put_bucket_policy"] * 2
+    assert json.loads(fs.calls[-1][1]["Policy"]) == PUBLIC_READ_POLICY
+
+    fs = fake_fs([], failures={"a-bucket": 10})
+    with pytest.raises(ConnectionError):
+        CaringoStore({}).set_bucket_policy("a-bucket")
+
+    assert len(fs.calls) == 3
@@ -0,0 +1,58 @@
+import fsspec
+import numpy as np
+import xarray as xr
+
+from cmip6_object_store.cmip6_zarr.checkpoint import (
+    CHECKPOINT_KEY,
+    WriteCheckpoint,
+    truncate_dim,
+)
+
+
+def _get_store_map(name):
+    store_map = fsspec.get_mapper(f"memory://checkpoint-test/{name}")
+    store_map.clear()
+    return store_map
+
+
+def test_WriteCheckpoint_resume():
+    store_map = _get_store_map("resume")
+    signature = {"mode": "streaming", "chunks": {"time": 10}}
+
+    checkpoint = WriteCheckpoint(store_map, signature)
+    assert not checkpoint.resume()
+
+    checkpoint.start()
+    checkpoint.mark_done(0)
+    checkpoint.mark_done(1)
+
+    resumed = WriteCheckpoint(store_map, signature)
+    assert resumed.resume()
+    assert resumed.n_done == 2
+    assert resumed.is_done(1) and not resumed.is_done(2)
+
+    # A different write plan does not resume from the checkpoint
+    assert not WriteCheckpoint(store_map, {"mode": "mfdataset"}).resume()
+
+    checkpoint.clear()
+    assert CHECKPOINT_KEY not in store_map
+
+
+def test_truncate_dim():
+    store_map = _get_store_map("truncate")
+
+    ds = xr.Dataset(
+        {
+            "tas": (("time", "lat"), np.ones((10, 3))),
+            "lat_bnds": (("lat", "bnds"), np.zeros((3, 2))),
+        },
+        coords={"time": np.arange(10), "lat": [1.0, 2.0, 3.0]},
+    )
+    ds.to_zarr(store_map, mode="w", consolidated=False)
+
+    truncate_dim(store_map, "time", 6)
+
+    result = xr.open_zarr(store_map, consolidated=False)
+    assert result.tas.shape == (6, 3)
+    assert list(result.time.values) == list(range(6))
+    assert result.lat_bnds.shape == (3, 2)
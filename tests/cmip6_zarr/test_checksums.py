@@ -0,0 +1,70 @@
+import fsspec
+import numpy as np
+import xarray as xr
+
+from cmip6_object_store.cmip6_zarr.checksums import (
+    MANIFEST_KEY,
+    ChecksumManifest,
+    hash_values,
+    load_manifest,
+)
+
+
+def _get_store_map(name):
+    store_map = fsspec.get_mapper(f"memory://checksums-test/{name}")
+    store_map.clear()
+    return store_map
+
+
+def _make_dataset():
+    return xr.Dataset(
+        {"tas": (("time", "lat"), np.arange(40.0).reshape(10, 4))},
+        coords={"time": np.arange(10), "lat": np.arange(4.0)},
+    ).chunk({"time": 4})
+
+
+def test_hash_values():
+    values = np.array([1.0, np.nan, 3.0], dtype="float32")
+    other_nan = values.copy()
+    other_nan.view("uint32")[1] = 0x7FC00001
+
+    assert hash_values(values) == hash_values(other_nan)
+    assert hash_values(values) != hash_values(values.astype("float64"))
+    assert hash_values(values) != hash_values(values.reshape(3, 1))
+
+
+def test_ChecksumManifest_add_blocks():
+    store_map = _get_store_map("add-blocks")
+    ds = _make_dataset()
+
+    checksums = ChecksumManifest()
+    checksums.add_blocks(ds, delayed_obj=ds.to_zarr(store_map, mode="w", compute=False))
+    assert checksums.n_blocks == 3
+
+    zarr_ds = xr.open_zarr(store_map)
+    for name, region, digest in checksums.iter_blocks():
+        assert hash_values(zarr_ds[name].isel(region).values) == digest
+
+    # Blocks written at an offset in the store
+    appended = ChecksumManifest()
+    appended.add_blocks(ds.isel(time=slice(4, 8)).chunk({"time": 4}), offsets={"time": 4})
+    assert [region["time"] for _, region, _ in appended.iter_blocks()] == [slice(4, 8)]
+
+
+def test_ChecksumManifest_save_and_resume():
+    store_map = _get_store_map("save")
+    assert load_manifest(store_map) is None
+
+    checksums = ChecksumManifest()
+    checksums.add_values("tas", ("time",), {"time": slice(0, 2)}, np.zeros(2))
+    checksums.save(store_map)
+    assert MANIFEST_KEY in store_map
+
+    loaded = load_manifest(store_map)
+    assert loaded.digest() == checksums.digest()
+
+    resumed = ChecksumManifest()
+    assert resumed.resume(store_map)
+    resumed.add_values("tas", ("time",), {"time": slice(2, 4)}, np.ones(2))
+    assert resumed.n_blocks == 2
+    assert resumed.digest() != checksums.digest()
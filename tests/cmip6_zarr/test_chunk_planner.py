@@ -0,0 +1,115 @@
+import fsspec
+import numpy as np
+import xarray as xr
+import zarr
+
+from cmip6_object_store.cmip6_zarr.chunk_planner import (
+    apply_chunk_plan,
+    plan_chunks,
+    plan_shards,
+    plan_var_chunks,
+)
+from cmip6_object_store.cmip6_zarr.utils import open_zarr_store
+
+MB = 2 ** 20
+
+
+def _get_ds(n_time=120, n_plev=8, n_lat=90, n_lon=180):
+    zg = np.zeros((n_time, n_plev, n_lat, n_lon), dtype="float32")
+    time_bnds = np.zeros((n_time, 2))
+    lat_bnds = np.zeros((n_lat, 2))
+
+    return xr.Dataset(
+        {
+            "zg": (("time", "plev", "lat", "lon"), zg),
+            "time_bnds": (("time", "bnds"), time_bnds),
+            "lat_bnds": (("lat", "bnds"), lat_bnds),
+        },
+        coords={
+            "time": np.arange(n_time),
+            "plev": np.arange(n_plev),
+            "lat": np.arange(n_lat),
+            "lon": np.arange(n_lon),
+        },
+    )
+
+
+def test_plan_var_chunks_map():
+    # 100 time steps of 1 MB each in chunks of 10 MB
+    chunks = plan_var_chunks(("time", "lat", "lon"), (100, 512, 512), 4, 10 * MB)
+    assert chunks == {"time": 10, "lat": 512, "lon": 512}
+
+
+def test_plan_var_chunks_map_splits_field_when_time_step_too_big():
+    # a single time step is 4 MB, so chunk size of 1 MB needs splitting
+    chunks = plan_var_chunks(
+        ("time", "plev", "lat", "lon"), (10, 4, 512, 512), 4, 1 * MB
+    )
+    assert chunks == {"time": 1, "plev": 1, "lat": 512, "lon": 512}
+
+
+def test_plan_var_chunks_timeseries():
+    chunks = plan_var_chunks(
+        ("time", "lat", "lon"), (1000, 100, 100), 4, 1 * MB, "timeseries"
+    )
+    assert chunks["time"] == 1000
+    assert chunks["lon"] == 100
+    assert chunks["lat"] * chunks["lon"] * chunks["time"] * 4 <= 1 * MB
+
+
+def test_plan_chunks_covers_all_variables():
+    ds = _get_ds()
+    chunk_plan = plan_chunks(ds, "zg", 2 * MB)
+
+    assert set(chunk_plan) == set(ds.variables)
+    assert chunk_plan["zg"] == {"time": 4, "plev": 8, "lat": 90, "lon": 180}
+    assert chunk_plan["time_bnds"] == {"time": 4, "bnds": 2}
+    assert chunk_plan["lat_bnds"] == {"lat": 90, "bnds": 2}
+    assert chunk_plan["time"] == {"time": 4}
+
+
+def test_apply_chunk_plan():
+    ds = _get_ds()
+    chunked_ds = apply_chunk_plan(ds, plan_chunks(ds, "zg", 2 * MB))
+
+    assert chunked_ds["zg"].chunks[0] == (4,) * 30
+    assert chunked_ds["time_bnds"].chunks[0] == (4,) * 30
+    assert chunked_ds["time"].encoding["chunks"] == (4,)
+
+
+def test_plan_shards():
+    ds = _get_ds()
+    chunk_plan = plan_chunks(ds, "zg", 2 * MB)
+
+    # 4 chunks of 2 MB (at most) in a shard
+    shard_plan = plan_shards(ds, "zg", chunk_plan, 8 * MB)
+    assert shard_plan["zg"] == {"time": 16, "plev": 8, "lat": 90, "lon": 180}
+    assert shard_plan["time_bnds"] == {"time": 16, "bnds": 2}
+    assert shard_plan["lat_bnds"] == {"lat": 90, "bnds": 2}
+
+    # A shard cannot hold more chunks along time than there are
+    shard_plan = plan_shards(ds, "zg", chunk_plan, 1000 * MB)
+    assert shard_plan["zg"]["time"] == 120
+
+
+def test_apply_chunk_plan_sharded():
+    ds = _get_ds(n_time=20, n_lat=10, n_lon=20)
+    chunk_plan = plan_chunks(ds, "zg", 8 * 10 * 20 * 4 * 2)
+    shard_plan = plan_shards(ds, "zg", chunk_plan, 8 * 10 * 20 * 4 * 16)
+
+    sharded_ds = apply_chunk_plan(ds, chunk_plan, shard_plan)
+
+    # Each dask chunk is a whole shard
+    assert sharded_ds["zg"].chunks[0] == (16, 4)
+    assert sharded_ds["zg"].encoding["chunks"] == (2, 8, 10, 20)
+    assert sharded_ds["zg"].encoding["shards"] == (16, 8, 10, 20)
+    assert sharded_ds["time"].encoding["shards"] == (16,)
+
+    store_map = fsspec.get_mapper("memory://test_chunk_planner/sharded.zarr")
+    sharded_ds.to_zarr(store_map, mode="w", zarr_format=3, consolidated=True)
+
+    # One object per shard
+    assert len([key for key in store_map if key.startswith("zg/c/")]) == 2
+    assert zarr.open_group(store_map, mode="r")["zg"].shards == (16, 8, 10, 20)
+
+    xr.testing.assert_identical(open_zarr_store(store_map).load(), ds)
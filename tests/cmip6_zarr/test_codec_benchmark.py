@@ -0,0 +1,21 @@
+import numpy as np
+import xarray as xr
+
+from cmip6_object_store.cmip6_zarr.codec_benchmark import benchmark_sample, summarise_benchmark
+
+
+def test_benchmark_sample():
+    # Compressible data: a smooth field
+    data = np.tile(np.linspace(0, 1, 100, dtype="float32"), (50, 20, 1))
+    sample = xr.Dataset({"tas": (("time", "lat", "lon"), data)}).chunk({"time": 10})
+
+    specs = ["none", "zstd,level=3", "blosc,cname=lz4,clevel=5,shuffle=1"]
+    df = benchmark_sample(sample, specs)
+
+    assert list(df["codecs"]) == specs
+    assert df.loc[df["codecs"] == "none", "ratio"].iloc[0] == 1
+    assert (df.loc[df["codecs"] != "none", "ratio"] > 2).all()
+    assert (df[["encode_mb_s", "decode_mb_s"]] > 0).all().all()
+
+    summary = summarise_benchmark(df.assign(dataset_id="ds").set_index(["dataset_id", "codecs"]))
+    assert summary.index[-1] == "none"
@@ -0,0 +1,207 @@
+import numpy as np
+import pytest
+import xarray as xr
+import zarr
+
+from cmip6_object_store.cmip6_zarr import compare
+from cmip6_object_store.cmip6_zarr.checksums import ChecksumManifest
+from cmip6_object_store.cmip6_zarr.compare import OpenDatasets, iter_blocks
+from cmip6_object_store.config import CONFIG
+
+DATASET_ID = "CMIP6.CMIP.MOHC.UKESM1-0-LL.historical.r1i1p1f2.Amon.tas.gn.v20190406"
+
+
+def test_iter_blocks():
+    # A file of 10 time steps starting at 25 in a store of blocks of 12
+    assert list(iter_blocks(10, 25, 12)) == [(slice(0, 10), slice(25, 35))]
+
+    blocks = list(iter_blocks(30, 10, 12))
+    assert [(nc.start, nc.stop) for nc, _ in blocks] == [(0, 2), (2, 14), (14, 26), (26, 30)]
+    assert [(z.start, z.stop) for _, z in blocks] == [(10, 12), (12, 24), (24, 36), (36, 40)]
+
+
+def _make_dataset(tmp_path):
+    time = xr.date_range("2000-01-01", periods=30, freq="D", use_cftime=True)
+    ds = xr.Dataset(
+        {
+            "tas": (("time", "lat"), np.random.rand(30, 4).astype("float32")),
+            "lat_bnds": (("lat", "bnds"), np.zeros((4, 2))),
+        },
+        coords={"time": time, "lat": np.arange(4.0)},
+    )
+    ds["tas"].attrs.update(units="K", long_name="Temperature")
+
+    nc_files = []
+    for i, start in enumerate(range(0, 30, 10)):
+        nc_file = str(tmp_path / f"tas_{i}.nc")
+        ds.isel(time=slice(start, start + 10)).to_netcdf(nc_file)
+        nc_files.append(nc_file)
+
+    zarr_path = str(tmp_path / "tas.zarr")
+    ds.chunk({"time": 7}).to_zarr(zarr_path, mode="w", consolidated=True)
+
+    return nc_files, zarr_path
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    nc_files, zarr_path = _make_dataset(tmp_path)
+
+    monkeypatch.setattr(compare, "_get_nc_files", lambda dataset_id, project: nc_files)
+    monkeypatch.setattr(
+        compare,
+        "_open_zarr",
+        lambda dataset_id, project: xr.open_zarr(zarr_path, use_cftime=True, chunks=None),
+    )
+    compare._OPEN_DATASETS.clear()
+
+    yield zarr_path
+
+    compare._OPEN_DATASETS.clear()
+
+
+def test_compare_dataset(archive):
+    # Blocks are split at the ends of files and of the Zarr chunks
+    n_blocks = compare._compare_dataset(DATASET_ID, "cmip6", n_workers=2, pool_type="thread")
+    assert n_blocks == 7
+
+
+def test_compare_dataset_finds_difference(archive):
+    zarr.open_group(archive, mode="r+")["tas"][23, 1] = -1
+
+    with pytest.raises(Exception, match="tas_2.nc"):
+        compare._compare_dataset(DATASET_ID, "cmip6", n_workers=2, pool_type="thread")
+
+
+def test_verify_checksums(archive, monkeypatch):
+    zarr_ds = xr.open_zarr(archive, use_cftime=True)
+    checksums = ChecksumManifest()
+    checksums.add_blocks(zarr_ds)
+
+    class ChecksumStore(object):
+        def get_result(self, dataset_id):
+            return checksums.digest()
+
+    monkeypatch.setattr(compare, "_load_manifest", lambda dataset_id, project: checksums)
+    monkeypatch.setattr(compare, "get_checksum_store", lambda project: ChecksumStore())
+
+    n_blocks = compare._verify_checksums(DATASET_ID, "cmip6", n_workers=2, pool_type="thread")
+    # Five time chunks of "tas" and one chunk of "lat_bnds"
+    assert n_blocks == 6
+
+    zarr.open_group(archive, mode="r+")["tas"][23, 1] = -1
+    compare._OPEN_DATASETS.clear()
+
+    with pytest.raises(Exception, match="time 21-28"):
+        compare._verify_checksums(DATASET_ID, "cmip6", n_workers=2, pool_type="thread")
+
+
+class _Dataset(object):
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    def close(self):
+        assert not self.closed
+        self.closed = True
+
+
+def test_OpenDatasets():
+    open_datasets = OpenDatasets(max_size=2)
+    opened = []
+
+    def opener(name):
+        def _open():
+            opened.append(_Dataset(name))
+            return opened[-1]
+
+        return _open
+
+    with open_datasets.open("ds.1", "a", opener("a")) as a:
+        with open_datasets.open("ds.1", "a", opener("a")) as reused:
+            assert reused is a
+
+        # Evicted while in use, so closed once no longer used
+        with open_datasets.open("ds.1", "b", opener("b")):
+            with open_datasets.open("ds.2", "c", opener("c")) as c:
+                assert not a.closed
+
+        assert not a.closed
+
+    assert a.closed
+    assert [ds.name for ds in opened] == ["a", "b", "c"]
+
+    # Only the datasets of the verification that ended are closed
+    open_datasets.clear("ds.1")
+    assert [ds.closed for ds in opened] == [True, True, False]
+
+    with open_datasets.open("ds.2", "c", opener("c")) as reused:
+        assert reused is c
+
+    open_datasets.clear()
+    assert c.closed
+
+
+def _make_dataset_id(institution, table, member):
+    return f"CMIP6.CMIP.{institution}.MODEL.historical.r{member}i1p1f1.{table}.tas.gn.v1"
+
+
+def test_stratified_sample():
+    dataset_ids = [
+        _make_dataset_id(institution, table, member)
+        for institution in ("MOHC", "IPSL")
+        for table in ("Amon", "day")
+        for member in range(1, 6 if institution == "MOHC" else 2)
+    ]
+
+    sample = compare.stratified_sample(dataset_ids, 4, [2, 6], seed=1)
+    assert len(set(sample)) == 4
+    assert {tuple(dataset_id.split(".")[i] for i in (2, 6)) for dataset_id in sample} == {
+        ("MOHC", "Amon"),
+        ("MOHC", "day"),
+        ("IPSL", "Amon"),
+        ("IPSL", "day"),
+    }
+
+    # Never more than there are
+    assert sorted(compare.stratified_sample(dataset_ids, 50, [2, 6])) == sorted(dataset_ids)
+
+
+class _Store(object):
+    def __init__(self, successes=()):
+        self.results = {dataset_id: "success" for dataset_id in successes}
+
+    def get_successful_runs(self):
+        return [key for key, result in self.results.items() if result == "success"]
+
+    def insert_success(self, identifier):
+        self.results[identifier] = "success"
+
+    def insert_failure(self, identifier, error_type="failure"):
+        self.results[identifier] = error_type
+
+
+def test_compare_zarrs_with_ncs(monkeypatch):
+    converted = [_make_dataset_id("MOHC", "Amon", member) for member in range(1, 5)]
+    verification_store = _Store(converted[:1])
+
+    monkeypatch.setattr(compare, "get_results_store", lambda project: _Store(converted))
+    monkeypatch.setattr(compare, "get_verification_store", lambda project: verification_store)
+
+    block_workers = set()
+
+    def fake_compare(dataset_id, project, n_workers=None):
+        block_workers.add(n_workers)
+        if dataset_id == converted[2]:
+            raise Exception("differs")
+        return 3
+
+    monkeypatch.setitem(CONFIG["workflow"], "verify_workers", 8)
+    monkeypatch.setattr(compare, "_compare_dataset", fake_compare)
+
+    # Only the 3 unverified datasets are sampled, without spinning forever
+    assert compare.compare_zarrs_with_ncs("cmip6", n_to_test=10, n_workers=2) == (2, 3)
+    assert verification_store.results[converted[2]] == "failed: differs"
+    # The block workers are shared by the datasets verified at once
+    assert block_workers == {4}
+    assert compare.compare_zarrs_with_ncs("cmip6", n_to_test=10, n_workers=2) == (0, 1)
@@ -0,0 +1,64 @@
+import json
+import time
+
+from cmip6_object_store.cmip6_zarr.conversion_stats import (
+    ConversionStats,
+    get_stats_table,
+    summarise_stats,
+)
+
+
+class _StatsStore(object):
+    def __init__(self, results):
+        self.results = results
+
+    def get_all_results(self):
+        return self.results
+
+
+def test_ConversionStats():
+    stats = ConversionStats()
+
+    with stats.phase("open"):
+        time.sleep(0.05)
+    with stats.phase("write"):
+        time.sleep(0.05)
+    with stats.phase("write"):
+        time.sleep(0.05)
+
+    stats.bytes_read = 3 * 2 ** 20
+    stats.objects_written = 12
+
+    result = stats.to_json(success=True)
+    # Must fit in the result column of the results store
+    assert len(result) < 255
+
+    record = json.loads(result)
+    assert record["ok"] == 1
+    assert record["open"] >= 0.05
+    assert record["write"] >= 0.1
+    assert record["total"] >= record["write"]
+    assert record["read_mb"] == 3.0
+    assert record["objects"] == 12
+    assert record["peak_rss_mb"] > 0
+
+
+def test_summarise_stats():
+    ok = {"ok": 1, "write": 10.0, "total": 20.0, "read_mb": 100.0, "peak_rss_mb": 500.0}
+    failed = dict(ok, ok=0, total=1.0)
+
+    store = _StatsStore(
+        {
+            "ds.1": json.dumps(ok),
+            "ds.2": json.dumps(dict(ok, total=40.0, peak_rss_mb=1500.0)),
+            "ds.3": json.dumps(failed),
+        }
+    )
+
+    df = get_stats_table(store)
+    assert list(df.index) == ["ds.1", "ds.2", "ds.3"]
+
+    summary = summarise_stats(df)
+    assert summary.loc["total", "count"] == 2
+    assert summary.loc["peak_rss_mb", "max"] == 1500.0
+    assert summary.loc["read_mb_per_s", "max"] == 5.0
@@ -0,0 +1,75 @@
+import fsspec
+import numcodecs
+import numpy as np
+import pytest
+import xarray as xr
+import zarr
+
+from cmip6_object_store.config import CONFIG
+from cmip6_object_store.cmip6_zarr.encoding import apply_codecs, get_codecs, parse_codec_spec
+
+
+def test_parse_codec_spec():
+    assert parse_codec_spec("default") is None
+    assert parse_codec_spec("none") == []
+
+    assert parse_codec_spec("delta+blosc,cname=zstd,clevel=5,shuffle=1") == [
+        ("delta", {}),
+        ("blosc", {"cname": "zstd", "clevel": 5, "shuffle": 1}),
+    ]
+
+
+@pytest.mark.parametrize(
+    "spec", ["zstd+delta", "zstd+zlib", "unknown,level=1"]
+)
+def test_parse_codec_spec_invalid(spec):
+    with pytest.raises(ValueError):
+        parse_codec_spec(spec)
+
+
+def test_get_codecs_zarr_v2():
+    codecs = get_codecs("shuffle+blosc,cname=lz4,clevel=3", "f4", zarr_format=2)
+
+    assert codecs["filters"] == [numcodecs.Shuffle(elementsize=4)]
+    assert codecs["compressors"] == [numcodecs.Blosc(cname="lz4", clevel=3)]
+
+    # Delta is skipped for floats, which it cannot encode losslessly
+    codecs = get_codecs("delta+zstd,level=3", "f4", zarr_format=2)
+    assert codecs["filters"] is None
+
+
+@pytest.mark.parametrize("zarr_format", [2, 3])
+def test_apply_codecs_round_trip(zarr_format):
+    ds = xr.Dataset(
+        {
+            "tas": (("time", "lat"), np.random.rand(20, 5).astype("float32")),
+            "count": (("time",), np.arange(20, dtype="int32")),
+        },
+        coords={"time": np.arange(20), "lat": np.arange(5.0)},
+    )
+    ds["tas"].encoding["_FillValue"] = 1e20
+
+    workflow = CONFIG["workflow"]
+    codecs, variable_codecs = workflow["codecs"], workflow["variable_codecs"]
+    workflow["codecs"] = "blosc,cname=zstd,clevel=5,shuffle=2"
+    workflow["variable_codecs"] = {"count": "delta+zlib,level=4"}
+
+    try:
+        encoded = apply_codecs(ds, "cmip6", zarr_format=zarr_format)
+    finally:
+        workflow["codecs"], workflow["variable_codecs"] = codecs, variable_codecs
+
+    # The encoding read from the source is kept, and `ds` is unchanged
+    assert encoded["tas"].encoding["_FillValue"] == 1e20
+    assert "compressors" in encoded["time"].encoding
+    assert "compressors" not in ds["tas"].encoding
+
+    store_map = fsspec.get_mapper(f"memory://test_encoding/v{zarr_format}.zarr")
+    encoded.to_zarr(store_map, mode="w", zarr_format=zarr_format)
+
+    result = xr.open_zarr(store_map)
+    xr.testing.assert_identical(result.load(), ds)
+    assert result["tas"].encoding["_FillValue"] == np.float32(1e20)
+
+    group = zarr.open_group(store_map, mode="r")
+    assert group["count"].filters and "delta" in str(group["count"].filters[0]).lower()
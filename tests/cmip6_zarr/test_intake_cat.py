@@ -0,0 +1,109 @@
+import pandas as pd
+
+from cmip6_object_store.cmip6_zarr import intake_cat
+from cmip6_object_store.cmip6_zarr.intake_cat import IntakeCatalogue
+
+
+def _make_dataset_id(member):
+    return f"CMIP6.CMIP.MOHC.UKESM1-0-LL.historical.r{member}i1p1f2.Amon.tas.gn.v20190406"
+
+
+class _ResultsStore(object):
+    "Minimal in-memory results store."
+
+    def __init__(self):
+        self.results = {}
+
+    def insert_success(self, dataset_id):
+        self.results[dataset_id] = "success"
+
+    def insert_failure(self, dataset_id, error_type="failure"):
+        self.results[dataset_id] = error_type
+
+    def get_successful_runs(self):
+        return [dataset_id for dataset_id, result in self.results.items() if result == "success"]
+
+
+def _get_catalogue(tmp_path, monkeypatch, results_store, listed):
+    monkeypatch.setitem(
+        intake_cat.CONFIG,
+        "intake",
+        {
+            "csv_catalog": str(tmp_path / "cat-{project}.csv"),
+        },
+    )
+    monkeypatch.setattr(intake_cat, "get_results_store", lambda project: results_store)
+
+    class Scanner(object):
+        def scan(self, dataset_ids):
+            listed.extend(dataset_ids)
+            return {
+                dataset_id: [f"/archive/tas_Amon_{dataset_id[-9:]}_185001-201412.nc"]
+                for dataset_id in dataset_ids
+            }
+
+    monkeypatch.setattr(intake_cat, "get_archive_scanner", lambda project: Scanner())
+    return str(tmp_path / "cat-cmip6.csv")
+
+
+def test_IntakeCatalogue_incremental(tmp_path, monkeypatch):
+    results_store = _ResultsStore()
+    listed = []
+    csv_catalog = _get_catalogue(tmp_path, monkeypatch, results_store, listed)
+
+    for member in (1, 2, 3):
+        results_store.insert_success(_make_dataset_id(member))
+
+    IntakeCatalogue("cmip6")._create_csv()
+    assert len(pd.read_csv(csv_catalog)) == 3
+    assert len(listed) == 3
+
+    # Only new datasets are listed (a re-converted one keeps its row), and
+    # failed ones are dropped
+    listed.clear()
+    results_store.insert_success(_make_dataset_id(4))
+    results_store.insert_success(_make_dataset_id(1))
+    results_store.insert_failure(_make_dataset_id(2))
+
+    IntakeCatalogue("cmip6")._create_csv()
+    assert listed == [_make_dataset_id(4)]
+
+    df = pd.read_csv(csv_catalog, dtype=str, keep_default_na=False)
+    assert sorted(df["member_id"]) == ["r1i1p1f2", "r3i1p1f2", "r4i1p1f2"]
+    assert set(df["time_range"]) == {"185001-201412"}
+
+    # A full rebuild lists every dataset
+    listed.clear()
+    IntakeCatalogue("cmip6", full=True)._create_csv()
+    assert len(listed) == 3
+    pd.testing.assert_frame_equal(
+        pd.read_csv(csv_catalog, dtype=str, keep_default_na=False).sort_values("member_id"),
+        df.sort_values("member_id"),
+    )
+
+
+def test_IntakeCatalogue_limit(tmp_path, monkeypatch):
+    results_store = _ResultsStore()
+    listed = []
+    csv_catalog = _get_catalogue(tmp_path, monkeypatch, results_store, listed)
+
+    for member in (1, 2, 3):
+        results_store.insert_success(_make_dataset_id(member))
+
+    IntakeCatalogue("cmip6", limit=2)._create_csv()
+    assert len(pd.read_csv(csv_catalog)) == 2
+
+    # The limit applies to the whole catalogue, not only to the new datasets
+    results_store.insert_success(_make_dataset_id(4))
+    listed.clear()
+
+    IntakeCatalogue("cmip6", limit=2)._create_csv()
+    assert listed == []
+    assert len(pd.read_csv(csv_catalog)) == 2
+
+    IntakeCatalogue("cmip6", limit=1)._create_csv()
+    assert len(pd.read_csv(csv_catalog)) == 1
+
+    IntakeCatalogue("cmip6", limit=3)._create_csv()
+    assert len(listed) == 2
+    assert len(pd.read_csv(csv_catalog)) == 3
@@ -0,0 +1,108 @@
+import json
+
+import pandas as pd
+
+from cmip6_object_store.cmip6_zarr import lotus_resources
+from cmip6_object_store.cmip6_zarr.lotus_resources import (
+    MemoryModel,
+    estimate_batch_resources,
+    group_batches_by_resources,
+    memory_to_mb,
+    seconds_to_duration,
+)
+from cmip6_object_store.config import CONFIG
+
+
+class _StatsStore(object):
+    def __init__(self, results):
+        self.results = results
+
+    def get_all_results(self):
+        return self.results
+
+
+def _set_config(monkeypatch, stats=None):
+    workflow = CONFIG["workflow"]
+    for key, value in {
+        "chunk_size": 100,
+        "write_workers": 4,
+        "dataset_workers": 1,
+        "base_memory": 1000,
+        "memory_per_chunk": 2,
+        "memory_safety_factor": 1,
+        "runtime_safety_factor": 1,
+        "memory_classes": ["16G", "4G", "8G"],
+        "duration_classes": ["01:00:00", "24:00:00"],
+    }.items():
+        monkeypatch.setitem(workflow, key, value)
+
+    monkeypatch.setattr(
+        lotus_resources, "get_stats_store", lambda project: _StatsStore(stats or {})
+    )
+
+
+def test_conversions():
+    assert memory_to_mb("16G") == 16384
+    assert memory_to_mb("500M") == 500
+    assert seconds_to_duration(3661.2) == "01:01:02"
+
+
+def test_estimate_batch_resources(monkeypatch):
+    _set_config(monkeypatch)
+
+    rows = pd.DataFrame(
+        {
+            "batch": [1, 1, 2, 3],
+            "size_mb": [10, 50, 1000, 5000],
+            "predicted_runtime": [600, 600, 7200, 200000],
+        }
+    ).set_index("batch")
+
+    resources = estimate_batch_resources(rows, "cmip6")
+
+    # 1000 MB + 2 x (50 MB x 4 workers)
+    assert resources[1] == ("4G", "01:00:00")
+    # 1000 MB + 2 x (100 MB x 4 workers)
+    assert resources[2] == ("4G", "24:00:00")
+    # Needs more than the largest duration class
+    assert resources[3] == ("4G", "24:00:00")
+
+    assert group_batches_by_resources(resources) == {
+        ("4G", "01:00:00"): [1],
+        ("4G", "24:00:00"): [2, 3],
+    }
+
+    # Two large datasets converted at once need more memory
+    monkeypatch.setitem(CONFIG["workflow"], "base_memory", 2500)
+    assert estimate_batch_resources(rows, "cmip6")[1][0] == "4G"
+
+    monkeypatch.setitem(CONFIG["workflow"], "dataset_workers", 2)
+    assert estimate_batch_resources(rows, "cmip6")[1][0] == "8G"
+
+
+def test_MemoryModel_fit(monkeypatch):
+    stats = {
+        f"ds.{i}": json.dumps(
+            {"ok": 1, "read_mb": read_mb, "peak_rss_mb": 500 + 3 * min(read_mb, 100) * 4}
+        )
+        for i, read_mb in enumerate([5, 10, 20, 40, 60, 80, 100, 200, 300, 400, 500])
+    }
+    _set_config(monkeypatch, stats)
+
+    model = MemoryModel.for_project("cmip6")
+    assert abs(model.base_mb - 500) < 1e-6
+    assert abs(model.per_chunk_mb - 3) < 1e-6
+
+
+def test_MemoryModel_fit_rank_deficient(monkeypatch):
+    # All datasets are larger than a chunk, so have the same data in flight
+    stats = {
+        f"ds.{i}": json.dumps({"ok": 1, "read_mb": read_mb, "peak_rss_mb": 1500 + i})
+        for i, read_mb in enumerate(range(100, 1200, 100))
+    }
+    _set_config(monkeypatch, stats)
+
+    model = MemoryModel.for_project("cmip6")
+    assert model.base_mb == 1000
+    assert model.per_chunk_mb == 2
+
@@ -0,0 +1,75 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import fsspec
+import numpy as np
+import pytest
+import xarray as xr
+
+from cmip6_object_store.cmip6_zarr.pipeline import ChunkPipeline, iter_chunk_regions
+
+
+def _make_dataset():
+    ds = xr.Dataset(
+        {"tas": (("time", "lat", "lon"), np.random.rand(10, 4, 6).astype("float32"))},
+        coords={"time": np.arange(10), "lat": np.arange(4), "lon": np.arange(6)},
+    )
+    return ds.chunk({"time": 3, "lat": 4, "lon": 3})
+
+
+def test_iter_chunk_regions():
+    ds = _make_dataset()
+    regions = list(iter_chunk_regions(ds["tas"].variable))
+
+    # 4 chunks along time (3, 3, 3, 1) and 2 along lon
+    assert len(regions) == 8
+    assert regions[0] == {"time": slice(0, 3), "lat": slice(0, 4), "lon": slice(0, 3)}
+    assert regions[-1] == {"time": slice(9, 10), "lat": slice(0, 4), "lon": slice(3, 6)}
+
+
+def test_ChunkPipeline_write():
+    ds = _make_dataset()
+    store_map = fsspec.get_mapper("memory://test_pipeline/out.zarr")
+
+    pipeline = ChunkPipeline(n_readers=2, n_encoders=2, n_uploaders=2, max_chunks=3)
+
+    try:
+        pipeline.write(ds, store_map)
+    finally:
+        pipeline.close()
+
+    xr.testing.assert_identical(xr.open_zarr(store_map).load(), ds.load())
+
+
+def test_ChunkPipeline_broken_encoders(monkeypatch):
+    ds = _make_dataset()
+    store_map = fsspec.get_mapper("memory://test_pipeline/broken.zarr")
+
+    pipeline = ChunkPipeline(n_readers=2, n_encoders=2, n_uploaders=2, max_chunks=3)
+
+    try:
+        # Threads starting writes at once share a single pool
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            pools = set(executor.map(lambda _: pipeline._get_encoders(), range(8)))
+        assert len(pools) == 1
+        broken = pools.pop()
+
+        shutdowns = []
+        shutdown = broken.shutdown
+        monkeypatch.setattr(broken, "shutdown", lambda **kwargs: shutdowns.append(shutdown(**kwargs)))
+
+        # An encoder process dies, so the pool is shut down and replaced
+        broken.submit(os._exit, 1).exception()
+
+        with pytest.raises(BrokenProcessPool):
+            pipeline.write(ds, store_map)
+
+        assert len(shutdowns) == 1
+
+        pipeline.write(ds, store_map)
+        assert pipeline._encoders is not broken
+    finally:
+        pipeline.close()
+
+    xr.testing.assert_identical(xr.open_zarr(store_map).load(), ds.load())
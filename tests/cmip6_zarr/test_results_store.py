@@ -0,0 +1,126 @@
+import os
+import threading
+
+from cmip6_object_store.cmip6_zarr.results_store import BufferedResultsStore
+from cmip6_object_store.config import CONFIG
+
+
+class DictResultsStore(object):
+    "Minimal in-memory results store with the DataBaseHandler interface."
+
+    def __init__(self):
+        self.results = {}
+        self.n_writes = 0
+        self.lookups = []
+        self.available = True
+
+    def ran_successfully(self, identifier):
+        self.lookups.append(identifier)
+        return self.results.get(identifier) == "success"
+
+    def delete_result(self, identifier):
+        self.results.pop(identifier, None)
+
+    def insert_success(self, identifier):
+        self.insert_failure(identifier, "success")
+
+    def insert_failure(self, identifier, error_type="failure"):
+        if not self.available:
+            raise ConnectionError("database unavailable")
+        self.results[identifier] = error_type
+        self.n_writes += 1
+
+
+def test_BufferedResultsStore(monkeypatch, tmp_path):
+    monkeypatch.setitem(CONFIG["log"], "log_base_dir", str(tmp_path))
+
+    store = DictResultsStore()
+    store.results = {"ds.1": "success", "ds.2": "failed: oops"}
+
+    buffered = BufferedResultsStore(store, "cmip6", flush_size=3)
+    buffered.preload(["ds.1", "ds.2", "ds.3"])
+
+    assert buffered.ran_successfully("ds.1")
+    assert not buffered.ran_successfully("ds.2")
+    # Only the preloaded IDs are looked up
+    assert sorted(store.lookups) == ["ds.1", "ds.2", "ds.3"]
+
+    buffered.insert_success("ds.2")
+    buffered.insert_failure("ds.3", "failed: again")
+
+    # Buffered, but visible to this process
+    assert store.n_writes == 0
+    assert buffered.ran_successfully("ds.2")
+
+    buffered.insert_success("ds.4")
+    assert store.n_writes == 3
+    assert store.results["ds.2"] == "success"
+    assert store.results["ds.3"] == "failed: again"
+
+
+def test_BufferedResultsStore_fallback(monkeypatch, tmp_path):
+    monkeypatch.setitem(CONFIG["log"], "log_base_dir", str(tmp_path))
+
+    store = DictResultsStore()
+    store.available = False
+
+    buffered = BufferedResultsStore(store, "cmip6", flush_size=10)
+    buffered.insert_success("ds.1")
+    buffered.flush()
+
+    fallback_dir = tmp_path / "cmip6" / "pending_results"
+    assert len(os.listdir(fallback_dir)) == 1
+    assert store.results == {}
+
+    # Results are replayed by the next store once the database is back
+    store.available = True
+    BufferedResultsStore(store, "cmip6")
+
+    assert store.results == {"ds.1": "success"}
+    assert os.listdir(fallback_dir) == []
+
+
+def test_BufferedResultsStore_threads(monkeypatch, tmp_path):
+    monkeypatch.setitem(CONFIG["log"], "log_base_dir", str(tmp_path))
+
+    store = DictResultsStore()
+    buffered = BufferedResultsStore(store, "cmip6", flush_size=7)
+
+    def insert(start):
+        for i in range(start, start + 50):
+            buffered.insert_success(f"ds.{i}")
+            assert buffered.ran_successfully(f"ds.{i}")
+
+    threads = [threading.Thread(target=insert, args=(start,)) for start in range(0, 200, 50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    buffered.flush()
+    assert len(store.results) == 200
+
+
+def test_BufferedResultsStore_lookups(monkeypatch, tmp_path):
+    monkeypatch.setitem(CONFIG["log"], "log_base_dir", str(tmp_path))
+
+    store = DictResultsStore()
+    store.results = {"ds.1": "success", "ds.2": "failed: oops", "ds.3": "success"}
+    buffered = BufferedResultsStore(store, "cmip6", flush_size=10)
+
+    # IDs that were not preloaded are looked up once, on their own
+    assert buffered.ran_successfully("ds.1")
+    assert buffered.ran_successfully("ds.1")
+    assert not buffered.ran_successfully("ds.2")
+    assert store.lookups == ["ds.1", "ds.2"]
+
+    # Deleting a result drops it from the buffer too
+    buffered.insert_success("ds.2")
+    buffered.delete_result("ds.2")
+    buffered.delete_result("ds.3")
+    buffered.flush()
+
+    assert not buffered.ran_successfully("ds.2")
+    assert not buffered.ran_successfully("ds.3")
+    assert store.results == {"ds.1": "success"}
+    assert store.lookups == ["ds.1", "ds.2"]
@@ -0,0 +1,90 @@
+import errno
+
+import pytest
+from botocore.exceptions import ClientError
+
+from cmip6_object_store.cmip6_zarr.retry_policy import (
+    FATAL,
+    RETRY_STATS,
+    THROTTLE,
+    TRANSIENT,
+    RetryPolicy,
+    classify_error,
+)
+
+
+def _client_error(code, status):
+    response = {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}}
+    return ClientError(response, "PutObject")
+
+
+def test_classify_error():
+    assert classify_error(_client_error("AccessDenied", 403)) == FATAL
+    assert classify_error(_client_error("NoSuchBucket", 404)) == FATAL
+    assert classify_error(_client_error("SlowDown", 503)) == THROTTLE
+    assert classify_error(_client_error("InternalError", 500)) == TRANSIENT
+
+    # The error code decides before the status
+    assert classify_error(_client_error("RequestTimeout", 400)) == TRANSIENT
+    assert classify_error(_client_error("InvalidArgument", 400)) == FATAL
+    assert classify_error(_client_error("NoSuchKey", 500)) == FATAL
+
+    assert classify_error(PermissionError("Access Denied")) == FATAL
+    assert classify_error(OSError(errno.EBUSY, "Please reduce your request rate")) == THROTTLE
+    assert classify_error(ConnectionError("reset by peer")) == TRANSIENT
+
+
+def test_classify_error_follows_cause():
+    try:
+        try:
+            raise FileNotFoundError("no such bucket")
+        except Exception:
+            raise Exception("Cannot delete bucket: a-bucket")
+    except Exception as exc:
+        assert classify_error(exc) == FATAL
+
+
+def test_get_delay_is_bounded():
+    policy = RetryPolicy(tries=5, base_delay=1, max_delay=10)
+
+    for attempt in range(1, 10):
+        delay = policy.get_delay(attempt, TRANSIENT)
+        assert 0 <= delay <= min(10, 2 ** (attempt - 1))
+
+    assert policy.get_delay(1, THROTTLE) <= 4
+
+
+def test_call_retries_transient_errors():
+    RETRY_STATS.reset()
+    policy = RetryPolicy(tries=3, base_delay=0.01, max_delay=0.01)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("reset by peer")
+        return "done"
+
+    assert policy.call("flaky", flaky) == "done"
+    assert len(attempts) == 3
+
+    stats = RETRY_STATS.report()["flaky"]
+    assert stats["calls"] == 1
+    assert stats["retries"] == 2
+    assert stats["failures"] == 0
+
+
+def test_call_does_not_retry_fatal_errors():
+    RETRY_STATS.reset()
+    policy = RetryPolicy(tries=3, base_delay=0.01, max_delay=0.01)
+    attempts = []
+
+    def denied():
+        attempts.append(1)
+        raise PermissionError("Access Denied")
+
+    with pytest.raises(PermissionError):
+        policy.call("denied", denied)
+
+    assert len(attempts) == 1
+    assert RETRY_STATS.report()["denied"]["failures"] == 1
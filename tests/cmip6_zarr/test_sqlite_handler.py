@@ -0,0 +1,61 @@
+import time
+
+from cmip6_object_store.cmip6_zarr.sqlite_handler import SQLiteHandler, get_status
+
+
+def test_SQLiteHandler(tmp_path):
+    handler = SQLiteHandler(str(tmp_path / "results.sqlite"), "cmip6_zarr_records")
+
+    handler.insert_success("ds.1")
+    handler.insert_failure("ds.2", "failed: no files")
+    handler.insert_failure("ds.3")
+
+    assert handler.ran_successfully("ds.1")
+    assert not handler.ran_successfully("ds.2")
+    assert not handler.ran_successfully("ds.4")
+
+    assert handler.get_successful_runs() == ["ds.1"]
+    assert handler.get_successes(["ds.1", "ds.2", "ds.4"]) == ["ds.1"]
+    assert handler.get_failed_runs() == {"ds.2": "failed: no files", "ds.3": "failure"}
+    assert handler.count_results() == 3
+    assert handler.count_successes() == 1
+    assert handler.count_failures() == 2
+    assert handler._query("SELECT id, status FROM cmip6_zarr_records ORDER BY id;") == [
+        ("ds.1", "success"),
+        ("ds.2", "failed"),
+        ("ds.3", "failure"),
+    ]
+
+    # Replaces the earlier failure
+    handler.insert_success("ds.2")
+    assert handler.get_result("ds.2") == "success"
+    assert handler.count_results() == 3
+
+    handler.delete_result("ds.3")
+    assert handler.get_all_results() == {"ds.1": "success", "ds.2": "success"}
+
+
+def test_SQLiteHandler_since(tmp_path):
+    handler = SQLiteHandler(str(tmp_path / "results.sqlite"), "results")
+
+    handler.bulk_insert([("ds.1", "success"), ("ds.2", "success")])
+    since = time.time()
+    handler.bulk_insert([("ds.3", "success"), ("ds.4", "error")])
+
+    assert handler.get_successful_runs(since=since) == ["ds.3"]
+
+
+def test_SQLiteHandler_get_successes(tmp_path):
+    handler = SQLiteHandler(str(tmp_path / "results.sqlite"), "results")
+
+    dataset_ids = [f"ds.{i}" for i in range(1200)]
+    handler.bulk_insert([(ds_id, "success") for ds_id in dataset_ids[::2]])
+
+    assert sorted(handler.get_successes(dataset_ids)) == sorted(dataset_ids[::2])
+
+
+def test_get_status():
+    assert get_status("success") == "success"
+    assert get_status("Failed to write to Zarr: ds.1:\nTraceback ...") == "Failed to write to Zarr"
+    assert get_status("failed: no files") == "failed"
+    assert get_status("") == "failure"
@@ -1,7 +1,11 @@
 import os
 import glob
 
-from cmip6_object_store.cmip6_zarr.task import TaskManager
+import pytest
+
+from cmip6_object_store.cmip6_zarr import task
+from cmip6_object_store.cmip6_zarr.sqlite_handler import SQLiteHandler
+from cmip6_object_store.cmip6_zarr.task import ConversionTask, TaskManager
 from cmip6_object_store.config import CONFIG
 
 
@@ -16,3 +20,41 @@ def test_TaskManager():
     num_batch = len(glob.glob(f"{version_dir}/batch_*.txt"))
 
     assert tm._batches == list(range(1, num_batch + 1))
+
+
+class StubWriter(object):
+    "Records successes in a SQLite file, which worker processes can share."
+
+    def __init__(self, batch, project):
+        self._results_store = SQLiteHandler(os.environ["STUB_RESULTS_FILE"])
+
+    def preload_results(self, dataset_ids):
+        pass
+
+    def convert(self, dataset_id):
+        if dataset_id.endswith("fail"):
+            raise Exception("conversion failed")
+        self._results_store.insert_success(dataset_id)
+
+    def insert_failure(self, dataset_id, error):
+        self._results_store.insert_failure(dataset_id, error)
+
+    def flush_results(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize("pool_type", ["thread", "process"])
+def test_ConversionTask_run_pool(pool_type, tmp_path, monkeypatch):
+    results_file = str(tmp_path / "results.sqlite")
+    monkeypatch.setenv("STUB_RESULTS_FILE", results_file)
+    monkeypatch.setattr(task, "ZarrWriter", StubWriter)
+
+    dataset_ids = ["ds.1", "ds.2.fail", "ds.3"]
+    ConversionTask(1, "cmip6")._run_pool(dataset_ids, pool_type, 2)
+
+    results_store = SQLiteHandler(results_file)
+    assert sorted(results_store.get_successful_runs()) == ["ds.1", "ds.3"]
+    assert results_store.get_failed_runs()["ds.2.fail"].startswith("Conversion aborted")
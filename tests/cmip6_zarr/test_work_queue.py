@@ -0,0 +1,159 @@
+import multiprocessing
+import sqlite3
+import time
+
+import pytest
+
+from cmip6_object_store.cmip6_zarr import task
+from cmip6_object_store.cmip6_zarr.work_queue import WorkQueue, get_work_queue
+from cmip6_object_store.config import CONFIG
+
+
+def _claim_all(path, worker, results):
+    queue = WorkQueue(path)
+    while True:
+        claimed = queue.claim(worker, 2)
+        if not claimed:
+            break
+        for dataset_id in claimed:
+            queue.complete(worker, dataset_id)
+        results.extend(claimed)
+
+
+def test_WorkQueue(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+    assert queue.add([f"ds.{i}" for i in range(5)]) == 5
+    assert queue.add(["ds.0", "ds.5"]) == 1
+
+    assert queue.claim("w1", 2) == ["ds.0", "ds.1"]
+    assert queue.claim("w2") == ["ds.2"]
+
+    assert queue.complete("w1", "ds.0")
+    assert queue.complete("w1", "ds.1", success=False)
+    # Not leased to this worker
+    assert not queue.complete("w1", "ds.2")
+    queue.release("w2")
+
+    assert queue.counts() == {"pending": 4, "leased": 0, "done": 1, "failed": 1}
+
+    # Failed datasets are queued again
+    queue.add(["ds.1"])
+    assert queue.counts()["pending"] == 5
+
+
+def test_WorkQueue_lease_expiry(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"), lease_time=0.1, max_attempts=2)
+    queue.add(["ds.0"])
+
+    # The first worker crashes, so its lease expires
+    assert queue.claim("w1") == ["ds.0"]
+    assert queue.claim("w2") == []
+    time.sleep(0.2)
+    assert queue.claim("w2") == ["ds.0"]
+
+    # Renewed leases do not expire
+    time.sleep(0.05)
+    queue.renew("w2", ["ds.0"])
+    time.sleep(0.07)
+    assert queue.claim("w3") == []
+
+    # Given up on after max_attempts
+    time.sleep(0.2)
+    assert queue.claim("w3") == []
+    assert queue.counts()["failed"] == 1
+
+
+def test_WorkQueue_complete_after_lease_lost(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"), lease_time=0.1, max_attempts=3)
+    queue.add(["ds.0"])
+
+    # The first worker is too slow, so the dataset is claimed by another
+    assert queue.claim("w1") == ["ds.0"]
+    time.sleep(0.2)
+    assert queue.claim("w2") == ["ds.0"]
+
+    # The first worker's result does not override the new lease
+    assert not queue.complete("w1", "ds.0", success=False)
+    assert queue.counts()["leased"] == 1
+
+    assert queue.complete("w2", "ds.0")
+    assert queue.counts()["done"] == 1
+
+
+def test_WorkQueue_locked(tmp_path, monkeypatch):
+    path = str(tmp_path / "queue.sqlite")
+    queue = WorkQueue(path)
+
+    connect = sqlite3.connect
+    monkeypatch.setattr(
+        sqlite3, "connect", lambda *args, **kwargs: connect(*args, **{**kwargs, "timeout": 0.1})
+    )
+
+    # Another host holds the SQLite lock, without the FileLock
+    other = connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE;")
+
+    try:
+        # The error from BEGIN is raised, not one from a ROLLBACK
+        with pytest.raises(sqlite3.OperationalError, match="locked"):
+            queue.counts()
+    finally:
+        other.execute("ROLLBACK;")
+        other.close()
+
+    assert queue.counts()["pending"] == 0
+
+
+def test_WorkQueue_concurrent_workers(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    WorkQueue(path).add([f"ds.{i}" for i in range(60)])
+
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Manager() as manager:
+        results = manager.list()
+        workers = [
+            ctx.Process(target=_claim_all, args=(path, f"w{i}", results)) for i in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        claimed = list(results)
+
+    assert sorted(claimed) == sorted(f"ds.{i}" for i in range(60))
+
+
+class _FakeWriter(object):
+    converted = []
+
+    def __init__(self, batch, project):
+        pass
+
+    def convert(self, dataset_id):
+        self.converted.append(dataset_id)
+
+    def ran_successfully(self, dataset_id):
+        return dataset_id != "ds.bad"
+
+    def flush_results(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_QueueWorker(monkeypatch, tmp_path):
+    monkeypatch.setitem(CONFIG["workflow"], "data_dir", str(tmp_path))
+    monkeypatch.setattr(task, "ZarrWriter", _FakeWriter)
+
+    get_work_queue("cmip6").add(["ds.1", "ds.bad", "ds.2"])
+    task.QueueWorker("cmip6").run()
+
+    assert _FakeWriter.converted == ["ds.1", "ds.bad", "ds.2"]
+    assert get_work_queue("cmip6").counts() == {
+        "pending": 0,
+        "leased": 0,
+        "done": 2,
+        "failed": 1,
+    }
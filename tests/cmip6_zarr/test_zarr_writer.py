@@ -0,0 +1,275 @@
+import os
+
+import fsspec
+import numpy as np
+import pytest
+import xarray as xr
+
+from cmip6_object_store.cmip6_zarr import archive_scanner, zarr_writer
+from cmip6_object_store.cmip6_zarr.conversion_stats import get_stats_table
+from cmip6_object_store.cmip6_zarr.results_store import get_results_store, get_stats_store
+from cmip6_object_store.cmip6_zarr.zarr_writer import WRITE_ENGINES, ZarrWriter
+from cmip6_object_store.config import CONFIG
+
+DATASET_ID = "CMIP6.CMIP.MOHC.UKESM1-0-LL.historical.r1i1p1f2.Amon.tas.gn.v20190406"
+ZARR_PATH = "CMIP6.CMIP.MOHC.UKESM1-0-LL/historical.r1i1p1f2.Amon.tas.gn.v20190406.zarr"
+
+
+class MemoryStore(object):
+    "Caringo store stand-in that keeps the Zarr stores in memory."
+
+    fs = fsspec.filesystem("memory")
+
+    def create_bucket(self, bucket):
+        self.fs.mkdirs(bucket, exist_ok=True)
+
+    def get_store_map(self, path):
+        return fsspec.get_mapper(f"memory://{path}")
+
+    def set_permissions(self, data_path, n_workers=None):
+        return self.fs.find(data_path, detail=True)
+
+
+def _make_archive(archive_dir, file_lengths):
+    "Writes the dataset as NetCDF files of `file_lengths` time steps."
+    n_times = sum(file_lengths)
+    time = xr.date_range("2000-01-01", periods=n_times, freq="D", use_cftime=True)
+    rng = np.random.default_rng(0)
+
+    ds = xr.Dataset(
+        {
+            "tas": (("time", "lat", "lon"), rng.random((n_times, 6, 8)).astype("float32")),
+            "time_bnds": (("time", "bnds"), np.zeros((n_times, 2))),
+            "lat_bnds": (("lat", "bnds"), np.zeros((6, 2))),
+        },
+        coords={"time": time, "lat": np.linspace(-75, 75, 6), "lon": np.arange(0.0, 360, 45)},
+        attrs={"source_id": "UKESM1-0-LL"},
+    )
+    ds["tas"].attrs.update(units="K", long_name="Near-Surface Air Temperature")
+
+    dataset_dir = os.path.join(archive_dir, DATASET_ID.replace(".", "/"))
+    os.makedirs(dataset_dir)
+    start = 0
+
+    for i, length in enumerate(file_lengths):
+        part = ds.isel(time=slice(start, start + length))
+        part.time.encoding["units"] = "days since 1850-01-01"
+        part.to_netcdf(os.path.join(dataset_dir, f"tas_Amon_{i:02d}.nc"))
+        start += length
+
+    return os.path.join(dataset_dir, "*.nc")
+
+
+@pytest.fixture
+def writer_env(tmp_path, monkeypatch):
+    "Sets up a local archive, an in-memory store and SQLite results."
+    workflow = {
+        "results_backend": "sqlite",
+        "sqlite_results_file": str(tmp_path / "{project}-results.sqlite"),
+        "scan_cache_file": "",
+        "set_permissions": False,
+        "write_engine": "threads",
+        "write_workers": 16,
+        "write_checksums": False,
+        "zarr_format": 2,
+        "shard_size": 0,
+        "codecs": "default",
+        # Chunks of 7 time steps of "tas"
+        "chunk_size": 7 * 6 * 8 * 4 / 2 ** 20,
+        "access_pattern": "map",
+        "checkpoint_chunks": 1,
+    }
+    for key, value in workflow.items():
+        monkeypatch.setitem(CONFIG["workflow"], key, value)
+
+    monkeypatch.setitem(CONFIG["project:cmip6"], "archive_dir", str(tmp_path / "archive"))
+    monkeypatch.setitem(CONFIG["log"], "log_base_dir", str(tmp_path / "log"))
+    monkeypatch.setattr(archive_scanner, "_SCANNERS", {})
+    monkeypatch.setattr(zarr_writer, "get_caringo_store", lambda creds: MemoryStore())
+    monkeypatch.setattr(zarr_writer, "get_credentials", lambda: {})
+
+    MemoryStore.fs.store.clear()
+    yield str(tmp_path / "archive")
+    MemoryStore.fs.store.clear()
+
+
+def _convert(monkeypatch, conversion_mode="mfdataset", resume_writes=False):
+    monkeypatch.setitem(CONFIG["workflow"], "conversion_mode", conversion_mode)
+    monkeypatch.setitem(CONFIG["workflow"], "resume_writes", resume_writes)
+
+    writer = ZarrWriter(1, "cmip6")
+    try:
+        writer.convert(DATASET_ID)
+    finally:
+        writer.close()
+
+    return writer
+
+
+def _open_archive(file_pattern):
+    "Opens the archive the way it should be converted, with static variables untouched."
+    return xr.open_mfdataset(
+        file_pattern,
+        use_cftime=True,
+        combine="by_coords",
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+    )
+
+
+def _open_output():
+    return xr.open_zarr(MemoryStore().get_store_map(ZARR_PATH), use_cftime=True)
+
+
+@pytest.mark.parametrize("engine", WRITE_ENGINES)
+def test_ZarrWriter_write_engine(engine, writer_env, tmp_path, monkeypatch):
+    if engine == "distributed":
+        pytest.importorskip("distributed")
+
+    monkeypatch.setitem(CONFIG["workflow"], "write_engine", engine)
+    writer = ZarrWriter(1, "cmip6")
+
+    try:
+        compute_kwargs = writer._write_engine()
+
+        if engine == "distributed":
+            assert compute_kwargs == {"scheduler": writer._client}
+        else:
+            assert compute_kwargs == {"scheduler": engine, "num_workers": 16}
+
+        ds = xr.Dataset({"tas": ("time", np.arange(10.0))}).chunk({"time": 3})
+        # On disk, as the memory filesystem is not shared by processes
+        store_map = fsspec.get_mapper(str(tmp_path / "engine-test.zarr"), auto_mkdir=True)
+        writer._write_zarr(ds, store_map)
+
+        xr.testing.assert_identical(xr.open_zarr(store_map).load(), ds.load())
+    finally:
+        writer.close()
+
+
+def test_ZarrWriter_write_engine_unsupported(writer_env, monkeypatch):
+    monkeypatch.setitem(CONFIG["workflow"], "write_engine", "gpu")
+
+    with pytest.raises(ValueError, match="unsupported write engine gpu"):
+        ZarrWriter(1, "cmip6")._write_engine()
+
+
+def test_ZarrWriter_streaming(writer_env, monkeypatch):
+    # Files of 10, 5 and 11 time steps are written in chunks of 7
+    file_pattern = _make_archive(writer_env, [10, 5, 11])
+
+    writer = _convert(monkeypatch, "streaming")
+    assert writer.ran_successfully(DATASET_ID)
+
+    expected = _open_archive(file_pattern)
+    output = _open_output()
+
+    assert output["tas"].encoding["chunks"] == (7, 6, 8)
+    # Variables without a time axis are not given one
+    assert output["lat_bnds"].dims == ("lat", "bnds")
+    xr.testing.assert_identical(output.load(), expected.load())
+
+    expected.close()
+
+
+@pytest.mark.parametrize("resume_writes", [False, True])
+def test_ZarrWriter_streaming_matches_mfdataset(resume_writes, writer_env, tmp_path, monkeypatch):
+    _make_archive(writer_env, [10, 5, 11])
+
+    _convert(monkeypatch, "mfdataset", resume_writes)
+    mfdataset_output = _open_output().load()
+
+    # Convert again from scratch
+    MemoryStore.fs.store.clear()
+    monkeypatch.setitem(
+        CONFIG["workflow"], "sqlite_results_file", str(tmp_path / "{project}-streaming.sqlite")
+    )
+
+    _convert(monkeypatch, "streaming", resume_writes)
+    streaming_output = _open_output().load()
+
+    xr.testing.assert_identical(streaming_output, mfdataset_output)
+    assert streaming_output["tas"].encoding["chunks"] == mfdataset_output["tas"].encoding["chunks"]
+
+
+def test_ZarrWriter_writes_successes(writer_env):
+    _make_archive(writer_env, [10, 5])
+    results_store = get_results_store("cmip6")
+
+    # A failure recorded by an earlier run is replaced
+    results_store.insert_failure(DATASET_ID, "failed: oops")
+    writer = ZarrWriter(1, "cmip6")
+
+    try:
+        writer.convert(DATASET_ID)
+
+        # Written without waiting for the writer to be closed
+        assert results_store.get_all_results() == {DATASET_ID: "success"}
+        assert DATASET_ID in get_stats_store("cmip6").get_all_results()
+    finally:
+        writer.close()
+
+
+def test_ZarrWriter_resumable(writer_env, monkeypatch):
+    file_pattern = _make_archive(writer_env, [10, 5, 11])
+    regions = []
+    write_zarr = ZarrWriter._write_zarr
+
+    def interrupted_write_zarr(self, ds, store_map, *args, **kwargs):
+        region = kwargs.get("region")
+        if region is not None:
+            if len(regions) == 2:
+                raise IOError("connection lost")
+            regions.append(region["time"])
+
+        return write_zarr(self, ds, store_map, *args, **kwargs)
+
+    monkeypatch.setattr(ZarrWriter, "_write_zarr", interrupted_write_zarr)
+
+    # The write fails after 2 of the 4 regions of one chunk each
+    writer = _convert(monkeypatch, resume_writes=True)
+    assert not writer.ran_successfully(DATASET_ID)
+    assert regions == [slice(0, 7), slice(7, 14)]
+
+    regions.clear()
+
+    def recording_write_zarr(self, ds, store_map, *args, **kwargs):
+        if kwargs.get("region") is not None:
+            regions.append(kwargs["region"]["time"])
+        return write_zarr(self, ds, store_map, *args, **kwargs)
+
+    monkeypatch.setattr(ZarrWriter, "_write_zarr", recording_write_zarr)
+
+    writer = _convert(monkeypatch, resume_writes=True)
+    assert writer.ran_successfully(DATASET_ID)
+    assert regions == [slice(14, 21), slice(21, 26)]
+
+    expected = _open_archive(file_pattern)
+    xr.testing.assert_identical(_open_output().load(), expected.load())
+    expected.close()
+
+
+def test_ZarrWriter_written_size(writer_env, monkeypatch):
+    _make_archive(writer_env, [10, 5])
+    monkeypatch.setitem(CONFIG["workflow"], "set_permissions", True)
+    monkeypatch.setitem(CONFIG["workflow"], "bucket_policy", False)
+
+    listings = []
+    find = MemoryStore.fs.find
+
+    def recording_find(path, **kwargs):
+        if kwargs.get("detail"):
+            listings.append(path)
+        return find(path, **kwargs)
+
+    monkeypatch.setattr(MemoryStore.fs, "find", recording_find)
+    _convert(monkeypatch)
+
+    # The listing made when setting permissions is reused
+    assert listings == [ZARR_PATH]
+
+    objects = find(ZARR_PATH, detail=True)
+    stats = get_stats_table(get_stats_store("cmip6")).loc[DATASET_ID]
+    assert stats["objects"] == len(objects)
+    assert stats["written_mb"] == round(sum(info["size"] for info in objects.values()) / 2 ** 20, 1)